@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks
+    ~~~~~~~~~~
+
+    Microbenchmarks for tipfy's request hot path. Run them from the
+    repository root::
+
+        python -m benchmarks.run
+        python -m benchmarks.run --save baseline.json
+        python -m benchmarks.run --compare baseline.json --threshold 10
+
+    See :mod:`benchmarks.suite` for the available benchmarks.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import gc
+import time
+
+
+from werkzeug import create_environ
+
+
+def measure(func, number=None, repeat=5, min_time=0.1):
+    """Calls a function `number` times, `repeat` times, and returns the best
+    time per call in microseconds. The garbage collector is disabled while
+    timing to reduce noise.
+
+    :param func:
+        A callable without arguments.
+    :param number:
+        Number of calls per round. If not set, it is calibrated so that a
+        round takes at least `min_time` seconds.
+    :param repeat:
+        Number of rounds. The best one is used.
+    :param min_time:
+        Minimum duration of a round in seconds, used for calibration.
+    :returns:
+        Microseconds per call.
+    """
+    if number is None:
+        number = calibrate(func, min_time)
+
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            for j in xrange(number):
+                func()
+
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return best * 1000000.0 / number
+
+
+def calibrate(func, min_time=0.1):
+    """Returns how many calls of a function take at least `min_time`
+    seconds.
+
+    :param func:
+        A callable without arguments.
+    :param min_time:
+        Minimum duration in seconds.
+    :returns:
+        Number of calls.
+    """
+    # Warm up caches.
+    func()
+
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            func()
+
+        if time.time() - start >= min_time:
+            return number
+
+        number *= 2
+
+
+def wsgi_request(app, path='/', method='GET', status_code=200, **kwargs):
+    """Returns a function that calls a WSGI app in-process with a synthetic
+    environment and consumes the response.
+
+    :param app:
+        A WSGI application.
+    :param path:
+        Request path, optionally with a query string.
+    :param method:
+        Request method.
+    :param status_code:
+        Expected response status code.
+    :param kwargs:
+        Extra keyword arguments for ``werkzeug.create_environ()``.
+    :returns:
+        A callable without arguments that returns the response body.
+    """
+    environ = create_environ(path, method=method, **kwargs)
+    expected = str(status_code)
+    status = []
+
+    def start_response(status_line, headers, exc_info=None):
+        status.append(status_line)
+
+    def request():
+        del status[:]
+        app_iter = app(dict(environ), start_response)
+        try:
+            body = ''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+        assert status[0].startswith(expected), status[0]
+        return body
+
+    return request
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.middleware
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Measures handler dispatch cost as the middleware depth grows.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+from tipfy import Request, RequestHandler, Response, Rule, Tipfy
+
+from benchmarks import measure
+
+
+class NoopMiddleware(object):
+    def before_dispatch(self, handler):
+        pass
+
+    def after_dispatch(self, handler, response):
+        return response
+
+
+class PartialMiddleware(object):
+    def after_dispatch(self, handler, response):
+        return response
+
+
+def get_handler_class(depth):
+    middleware = []
+    for i in range(depth):
+        if i % 2:
+            middleware.append(PartialMiddleware())
+        else:
+            middleware.append(NoopMiddleware())
+
+    class Handler(RequestHandler):
+        def get(self, **kwargs):
+            return Response('Hello, World!')
+
+    Handler.middleware = middleware
+    return Handler
+
+
+def run(depths=(0, 1, 2, 4, 8, 16), number=5000):
+    results = []
+    for depth in depths:
+        handler_class = get_handler_class(depth)
+        app = Tipfy([Rule('/', name='home', handler=handler_class)])
+        request = Request.from_values('/')
+        handler = handler_class(app, request)
+
+        def dispatch():
+            handler('get')
+
+        results.append((depth, measure(dispatch, number=number)))
+
+    return results
+
+
+def main():
+    print '%-10s %12s' % ('depth', 'usec/call')
+    for depth, usec in run():
+        print '%-10d %12.2f' % (depth, usec)
+
+
+if __name__ == '__main__':
+    main()
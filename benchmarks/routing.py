@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.routing
+    ~~~~~~~~~~~~~~~~~~
+
+    Measures ``Router.match`` cost as the number of rules grows, with and
+    without the bound URL adapter cache.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+from tipfy import Request, RequestHandler, Response, Rule, Tipfy
+
+from benchmarks import measure
+
+
+class Handler(RequestHandler):
+    def get(self, **kwargs):
+        return Response('Hello, World!')
+
+
+def get_app(size, adapter_cache_size=100):
+    rules = []
+    for i in range(size / 2):
+        rules.append(Rule('/static/page-%d' % i, name='static-%d' % i,
+            handler=Handler))
+        rules.append(Rule('/dynamic-%d/<int:id>/<slug>' % i,
+            name='dynamic-%d' % i, handler=Handler))
+
+    return Tipfy(rules=rules, config={
+        'tipfy': {
+            'server_name':        'example.com',
+            'adapter_cache_size': adapter_cache_size,
+        },
+    })
+
+
+def run(sizes=(10, 100, 1000), number=5000):
+    """Returns a list of tuples ``(size, uncached, cached)`` with the
+    microseconds per ``Router.match`` call for each number of rules, matching
+    the last rule.
+    """
+    results = []
+    for size in sizes:
+        path = '/dynamic-%d/42/last-rule' % (size / 2 - 1)
+        row = [size]
+        for adapter_cache_size in (0, 100):
+            router = get_app(size, adapter_cache_size).router
+            request = Request.from_values(path,
+                base_url='http://example.com/')
+
+            def match():
+                router.match(request)
+
+            row.append(measure(match, number=number))
+
+        results.append(tuple(row))
+
+    return results
+
+
+def main():
+    print '%-10s %12s %12s' % ('rules', 'uncached', 'cached')
+    for size, uncached, cached in run():
+        print '%-10d %12.2f %12.2f' % (size, uncached, cached)
+
+
+if __name__ == '__main__':
+    main()
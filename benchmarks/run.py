@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.run
+    ~~~~~~~~~~~~~~
+
+    Command line interface to run benchmarks, save results as a JSON
+    baseline and compare results against a baseline::
+
+        python -m benchmarks.run [--save FILE] [--compare FILE]
+            [--threshold PERCENT] [name ...]
+
+    When comparing, the exit status is 1 if any benchmark got slower than
+    the baseline by more than the threshold.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import optparse
+import platform
+import sys
+
+from tipfy.utils import json_decode, json_encode
+
+from benchmarks import suite
+
+
+def compare(baseline, results, threshold=10.0):
+    """Compares results against a baseline.
+
+    :param baseline:
+        A dictionary of baseline results, as returned by
+        :func:`benchmarks.suite.run`.
+    :param results:
+        A dictionary of new results.
+    :param threshold:
+        Maximum accepted slowdown in percent.
+    :returns:
+        A list of tuples ``(name, baseline_usec, usec, change_percent,
+        is_regression)`` for benchmarks present in both.
+    """
+    rows = []
+    for name, _, _ in suite.benchmarks:
+        if name not in baseline or name not in results:
+            continue
+
+        old = baseline[name]['usec']
+        new = results[name]['usec']
+        change = (new - old) / old * 100
+        rows.append((name, old, new, change, change > threshold))
+
+    return rows
+
+
+def print_results(results):
+    print '%-24s %12s %12s' % ('benchmark', 'usec/call', 'req/s')
+    for name, _, _ in suite.benchmarks:
+        if name in results:
+            result = results[name]
+            rps = result['rps'] and '%.1f' % result['rps'] or '-'
+            print '%-24s %12.2f %12s' % (name, result['usec'], rps)
+
+
+def print_comparison(rows):
+    print '%-24s %12s %12s %9s' % ('benchmark', 'baseline', 'current',
+        'change')
+    for name, old, new, change, is_regression in rows:
+        flag = is_regression and '  REGRESSION' or ''
+        print '%-24s %12.2f %12.2f %+8.1f%%%s' % (name, old, new, change,
+            flag)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [name ...]')
+    parser.add_option('--save', dest='save', metavar='FILE',
+        help='save results as a JSON baseline')
+    parser.add_option('--compare', dest='compare', metavar='FILE',
+        help='compare results against a JSON baseline')
+    parser.add_option('--threshold', dest='threshold', type='float',
+        default=10.0, metavar='PERCENT',
+        help='slowdown in percent flagged as regression (default: 10)')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+        help='rounds per benchmark; the best is used (default: 5)')
+    options, names = parser.parse_args(argv)
+
+    results = suite.run(names, repeat=options.repeat)
+    print_results(results)
+
+    if options.save:
+        f = open(options.save, 'w')
+        try:
+            f.write(json_encode({
+                'python':  platform.python_version(),
+                'results': results,
+            }, indent=2, sort_keys=True))
+        finally:
+            f.close()
+
+    if options.compare:
+        f = open(options.compare, 'r')
+        try:
+            baseline = json_decode(f.read())['results']
+        finally:
+            f.close()
+
+        rows = compare(baseline, results, options.threshold)
+        print
+        print_comparison(rows)
+        if [row for row in rows if row[4]]:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
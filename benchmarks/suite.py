@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.suite
+    ~~~~~~~~~~~~~~~~
+
+    The benchmarks. Each one is a function that sets up an app and returns a
+    callable to be timed. Request benchmarks call ``Tipfy.wsgi_app``
+    in-process; the others call a subsystem directly. Nothing here requires
+    App Engine: sessions use secure cookies and templates are loaded from
+    memory.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import datetime
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.sessions import SessionMiddleware
+
+from benchmarks import measure, wsgi_request
+
+#: Registered benchmarks, in order: a list of tuples
+#: ``(name, setup_function, is_request)``.
+benchmarks = []
+
+#: Config used by all benchmark apps.
+config = {
+    'tipfy.sessions': {
+        'secret_key': 'benchmarks',
+    },
+}
+
+
+def benchmark(is_request=True):
+    """Registers a benchmark setup function.
+
+    :param is_request:
+        True if the benchmark performs a full request, so its result is also
+        reported in requests per second.
+    """
+    def decorator(func):
+        benchmarks.append((func.__name__, func, is_request))
+        return func
+
+    return decorator
+
+
+class HelloWorldHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response('Hello, World!')
+
+
+@benchmark()
+def hello_world():
+    app = Tipfy(rules=[
+        Rule('/', name='home', handler=HelloWorldHandler),
+    ], config=config)
+    return wsgi_request(app.wsgi_app, '/')
+
+
+@benchmark()
+def rule_map_500():
+    rules = []
+    for i in range(250):
+        rules.append(Rule('/static/page-%d' % i, name='static-%d' % i,
+            handler=HelloWorldHandler))
+        rules.append(Rule('/dynamic-%d/<int:id>/<slug>' % i,
+            name='dynamic-%d' % i, handler=HelloWorldHandler))
+
+    app = Tipfy(rules=rules, config=config)
+    return wsgi_request(app.wsgi_app, '/dynamic-249/42/last-rule')
+
+
+class NotFoundHandler(RequestHandler):
+    cache_error_response = True
+
+    def handle_exception(self, exception=None):
+        return Response('Not Found', status=404)
+
+
+@benchmark()
+def not_found_500():
+    rules = []
+    for i in range(500):
+        rules.append(Rule('/dynamic-%d/<int:id>/<slug>' % i,
+            name='dynamic-%d' % i, handler=HelloWorldHandler))
+
+    app = Tipfy(rules=rules, config=dict(config, tipfy={
+        'negative_cache_size': 1000,
+    }))
+    app.error_handlers[404] = NotFoundHandler
+    return wsgi_request(app.wsgi_app, '/wp-login.php', status_code=404)
+
+
+class UrlForHandler(RequestHandler):
+    def get(self, **kwargs):
+        urls = []
+        for i in range(100):
+            urls.append(self.url_for('item', id=i, page=i % 10))
+
+        return Response('\n'.join(urls))
+
+
+@benchmark()
+def url_for_100():
+    app = Tipfy(rules=[
+        Rule('/', name='home', handler=UrlForHandler),
+        Rule('/items/<int:id>', name='item', handler=HelloWorldHandler),
+    ], config=config)
+    return wsgi_request(app.wsgi_app, '/')
+
+
+class UrlForManyHandler(RequestHandler):
+    def get(self, **kwargs):
+        urls = self.url_for_many('item', [{'id': i, 'page': i % 10} for i in
+            range(100)])
+        return Response('\n'.join(urls))
+
+
+@benchmark()
+def url_for_many_100():
+    app = Tipfy(rules=[
+        Rule('/', name='home', handler=UrlForManyHandler),
+        Rule('/items/<int:id>', name='item', handler=HelloWorldHandler),
+    ], config=config)
+    return wsgi_request(app.wsgi_app, '/')
+
+
+class SessionHandler(RequestHandler):
+    middleware = [SessionMiddleware()]
+
+    def get(self, **kwargs):
+        session = self.session
+        session['counter'] = session.get('counter', 0) + 1
+        return Response('Hello, World!')
+
+
+@benchmark()
+def secure_cookie_session():
+    app = Tipfy(rules=[
+        Rule('/', name='home', handler=SessionHandler),
+    ], config=config)
+
+    # Get a valid session cookie first.
+    client = app.get_test_client()
+    cookie = client.get('/').headers['Set-Cookie'].split(';', 1)[0]
+    return wsgi_request(app.wsgi_app, '/', headers=[('Cookie', cookie)])
+
+
+@benchmark()
+def middleware_8():
+    from benchmarks.middleware import get_handler_class
+    app = Tipfy(rules=[
+        Rule('/', name='home', handler=get_handler_class(8)),
+    ], config=config)
+    return wsgi_request(app.wsgi_app, '/')
+
+
+@benchmark(is_request=False)
+def i18n_format():
+    from tipfy.i18n import I18nStore
+
+    app = Tipfy(rules=[
+        Rule('/', name='home', handler=HelloWorldHandler),
+    ], config=config)
+    date = datetime.datetime(2010, 10, 16, 12, 30)
+
+    handler_context = app.get_test_handler('/')
+    try:
+        i18n = I18nStore(handler_context.__enter__())
+        i18n.set_locale('pt_BR')
+    finally:
+        handler_context.__exit__(None, None, None)
+
+    def format():
+        i18n.format_datetime(date)
+        i18n.format_decimal(1234.5)
+        i18n.gettext('Hello, World!')
+
+    return format
+
+
+TEMPLATE_ITEMS = [{'name': 'Item %d' % i, 'price': i * 1.5} for i in
+    range(50)]
+
+
+@benchmark(is_request=False)
+def tipfy_template():
+    from tipfy.template import Template
+
+    template = Template('<ul>{% for item in items %}'
+        '<li>{{ item["name"] }}: {{ item["price"] }}</li>'
+        '{% end %}</ul>')
+
+    def render():
+        return template.generate(items=TEMPLATE_ITEMS)
+
+    return render
+
+
+@benchmark(is_request=False)
+def jinja2_template():
+    try:
+        from jinja2 import DictLoader
+        from tipfyext.jinja2 import Jinja2
+    except ImportError:
+        return None
+
+    jinja2_config = dict(config)
+    jinja2_config['tipfyext.jinja2'] = {
+        'environment_args': {
+            'autoescape': True,
+            'loader': DictLoader({
+                'list.html': '<ul>{% for item in items %}'
+                    '<li>{{ item.name }}: {{ item.price }}</li>'
+                    '{% endfor %}</ul>',
+            }),
+        },
+    }
+    app = Tipfy(config=jinja2_config)
+    jinja2 = Jinja2(app)
+
+    def render():
+        return jinja2.render('list.html', items=TEMPLATE_ITEMS)
+
+    return render
+
+
+def run(names=None, repeat=5, min_time=0.1):
+    """Runs benchmarks and returns the results.
+
+    :param names:
+        Names of the benchmarks to run. If not set, all are run.
+    :param repeat:
+        Number of rounds for each benchmark. The best one is used.
+    :param min_time:
+        Minimum duration of a round in seconds.
+    :returns:
+        A dictionary ``{name: {'usec': float, 'rps': float or None}}``.
+        Benchmarks that can't run, e.g., because a dependency is missing,
+        are not included.
+    """
+    results = {}
+    for name, setup, is_request in benchmarks:
+        if names and name not in names:
+            continue
+
+        func = setup()
+        if func is None:
+            continue
+
+        usec = measure(func, repeat=repeat, min_time=min_time)
+        rps = None
+        if is_request:
+            rps = 1000000.0 / usec
+
+        results[name] = {'usec': usec, 'rps': rps}
+
+    return results
@@ -14,3 +14,7 @@ class HandlerWithException(RequestHandler):
     def get(self, **kwargs):
         raise ValueError('ooops!')
 
+
+class ItemHandler(RequestHandler):
+    def show(self, **kwargs):
+        return Response('Item %d' % kwargs['id'])
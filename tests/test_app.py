@@ -4,9 +4,11 @@
 """
 from __future__ import with_statement
 
+import datetime
 import os
 import sys
 import unittest
+import zlib
 
 from . import BaseTestCase
 
@@ -405,6 +407,97 @@ class TestHandlerMiddleware(BaseTestCase):
         response = client.get('/')
         self.assertEqual(response.status_code, 500)
 
+    def test_pipeline_is_cached(self):
+        class MyMiddleware(object):
+            def before_dispatch(self, handler):
+                pass
+
+            def after_dispatch(self, handler, response):
+                return response
+
+        class MyHandler(RequestHandler):
+            middleware = [MyMiddleware()]
+
+            def get(self, **kwargs):
+                return Response('default')
+
+        pipeline = MyHandler.get_pipeline()
+        self.assertEqual(len(pipeline.before_dispatch), 1)
+        self.assertEqual(len(pipeline.handle_exception), 0)
+        self.assertEqual(len(pipeline.after_dispatch), 1)
+        self.assertEqual(MyHandler.get_pipeline() is pipeline, True)
+
+        # Replacing the middleware list rebuilds the pipeline.
+        MyHandler.middleware = []
+        self.assertEqual(MyHandler.get_pipeline() is pipeline, False)
+        self.assertEqual(MyHandler.get_pipeline().has_hooks, False)
+
+    def test_reset_pipeline(self):
+        res = 'Intercepted!'
+
+        class MyMiddleware(object):
+            def before_dispatch(self, handler):
+                return Response(res)
+
+        class MyHandler(RequestHandler):
+            middleware = []
+
+            def get(self, **kwargs):
+                return Response('default')
+
+        class MyChildHandler(MyHandler):
+            pass
+
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler=MyHandler),
+            Rule('/child', name='child', handler=MyChildHandler),
+        ])
+        client = app.get_test_client()
+        self.assertEqual(client.get('/').data, 'default')
+        self.assertEqual(client.get('/child').data, 'default')
+
+        MyHandler.middleware.append(MyMiddleware())
+        MyHandler.reset_pipeline()
+        self.assertEqual(client.get('/').data, res)
+        self.assertEqual(client.get('/child').data, res)
+
+    def test_instance_middleware(self):
+        res = 'Intercepted!'
+
+        class MyMiddleware(object):
+            def before_dispatch(self, handler):
+                return Response(res)
+
+        class MyHandler(RequestHandler):
+            def __init__(self, app, request):
+                RequestHandler.__init__(self, app, request)
+                self.middleware = [MyMiddleware()]
+
+            def get(self, **kwargs):
+                return Response('default')
+
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler=MyHandler),
+        ])
+        client = app.get_test_client()
+        self.assertEqual(client.get('/').data, res)
+        self.assertEqual(MyHandler.get_pipeline().has_hooks, False)
+
+    def test_valid_methods_are_cached(self):
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler=BrokenHandler),
+        ])
+        client = app.get_test_client()
+        response = client.put('/')
+        self.assertEqual(response.status_code, 405)
+        # HEAD is served by get().
+        self.assertEqual(sorted(response.headers.get('Allow').split(', ')),
+            ['GET', 'HEAD'])
+
+        pipeline = BrokenHandler.get_pipeline()
+        self.assertEqual(sorted(pipeline.valid_methods[app.allowed_methods]),
+            ['GET', 'HEAD'])
+
 
 class TestTipfy(BaseTestCase):
     def test_custom_error_handlers(self):
@@ -432,6 +525,66 @@ class TestTipfy(BaseTestCase):
         self.assertEqual(res.status_code, 500)
         self.assertEqual(res.data, '500 custom handler')
 
+    def test_error_handler_entries(self):
+        app = Tipfy([], debug=False)
+        app.error_handlers[404] = Handle404
+        client = app.get_test_client()
+
+        client.get('/a')
+        entry = app.error_entries[404]
+        client.get('/b')
+        self.assertEqual(app.error_entries[404] is entry, True)
+        self.assertEqual(entry[2], None)
+
+        # A new handler builds a new entry.
+        app.error_handlers[404] = Handle405
+        res = client.get('/c')
+        self.assertEqual(res.data, '405 custom handler')
+        self.assertEqual(app.error_entries[404] is entry, False)
+
+    def test_cached_error_response(self):
+        calls = []
+
+        class CachedHandle404(RequestHandler):
+            cache_error_response = True
+
+            def handle_exception(self, exception=None):
+                calls.append(exception)
+                response = Response('Not here', status=404)
+                response.headers['X-Error'] = 'yes'
+                return response
+
+        app = Tipfy([], debug=False)
+        app.error_handlers[404] = CachedHandle404
+        client = app.get_test_client()
+
+        for path in ('/a', '/b', '/c'):
+            res = client.get(path)
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(res.data, 'Not here')
+            self.assertEqual(res.headers['X-Error'], 'yes')
+
+        self.assertEqual(len(calls), 1)
+
+    def test_cached_error_response_with_cookie(self):
+        calls = []
+
+        class CookieHandle404(RequestHandler):
+            cache_error_response = True
+
+            def handle_exception(self, exception=None):
+                calls.append(exception)
+                response = Response('Not here', status=404)
+                response.set_cookie('foo', 'bar')
+                return response
+
+        app = Tipfy([], debug=False)
+        app.error_handlers[404] = CookieHandle404
+        client = app.get_test_client()
+        client.get('/a')
+        client.get('/b')
+        self.assertEqual(len(calls), 2)
+
     def test_store_classes(self):
         from tipfy.appengine.auth import AuthStore
         from tipfy.i18n import I18nStore
@@ -494,6 +647,450 @@ class TestTipfy(BaseTestCase):
         self.assertEqual(app.get_config('tipfy', 'foo'), 'bar')
 
 
+class TestConditional(BaseTestCase):
+    def get_app(self):
+        calls = self.calls = []
+        updated = datetime.datetime(2010, 6, 1, 12, 30, 15, 500)
+
+        def post_validator(handler, **kwargs):
+            return 'post-%s-v2' % kwargs['id'], updated
+
+        class PostHandler(RequestHandler):
+            def get(self, **kwargs):
+                calls.append(kwargs)
+                return 'Post %s' % kwargs['id']
+
+            def post(self, **kwargs):
+                calls.append(kwargs)
+                return 'Posted'
+
+        class VersionHandler(RequestHandler):
+            def validator(self, **kwargs):
+                return self.request.args.get('v'), None
+
+            def get(self, **kwargs):
+                calls.append(kwargs)
+                return 'Version'
+
+        return Tipfy(rules=[
+            Rule('/post/<id>', name='post', handler=PostHandler,
+                validator=post_validator),
+            Rule('/version', name='version', handler=VersionHandler),
+        ])
+
+    def test_etag(self):
+        client = self.get_app().get_test_client()
+
+        response = client.get('/post/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'Post 1')
+        self.assertEqual(response.headers['ETag'], 'w/"post-1-v2"')
+        self.assertEqual(response.headers['Last-Modified'],
+            'Tue, 01 Jun 2010 12:30:15 GMT')
+
+        response = client.get('/post/1', headers=[('If-None-Match',
+            'W/"post-1-v2"')])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['ETag'], 'w/"post-1-v2"')
+        self.assertEqual(len(self.calls), 1)
+
+        # Strong and weak etags are compared using weak comparison.
+        response = client.get('/post/1', headers=[('If-None-Match',
+            '"post-1-v2"')])
+        self.assertEqual(response.status_code, 304)
+
+        response = client.get('/post/2', headers=[('If-None-Match',
+            'W/"post-1-v2"')])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_last_modified(self):
+        client = self.get_app().get_test_client()
+
+        response = client.get('/post/1', headers=[('If-Modified-Since',
+            'Tue, 01 Jun 2010 12:30:15 GMT')])
+        self.assertEqual(response.status_code, 304)
+
+        response = client.get('/post/1', headers=[('If-Modified-Since',
+            'Tue, 01 Jun 2010 12:30:14 GMT')])
+        self.assertEqual(response.status_code, 200)
+
+        # If-None-Match takes precedence.
+        response = client.get('/post/1', headers=[
+            ('If-Modified-Since', 'Tue, 01 Jun 2010 12:30:15 GMT'),
+            ('If-None-Match', 'W/"post-1-v1"'),
+        ])
+        self.assertEqual(response.status_code, 200)
+
+    def test_handler_validator(self):
+        client = self.get_app().get_test_client()
+
+        response = client.get('/version?v=3', headers=[('If-None-Match',
+            'W/"3"')])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(self.calls), 0)
+
+        # No validator value: the handler runs without validator headers.
+        response = client.get('/version', headers=[('If-None-Match',
+            'W/"3"')])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get('ETag'), None)
+
+    def test_only_get_and_head(self):
+        client = self.get_app().get_test_client()
+
+        response = client.post('/post/1', headers=[('If-None-Match',
+            'W/"post-1-v2"')])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'Posted')
+
+    def test_aware_last_modified(self):
+        class UTC3(datetime.tzinfo):
+            def utcoffset(self, dt):
+                return datetime.timedelta(hours=3)
+
+            def dst(self, dt):
+                return datetime.timedelta(0)
+
+        class AwareHandler(RequestHandler):
+            def validator(self, **kwargs):
+                return None, datetime.datetime(2010, 6, 1, 15, 30, 15,
+                    tzinfo=UTC3())
+
+            def get(self, **kwargs):
+                return 'Aware'
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=AwareHandler)])
+        client = app.get_test_client()
+
+        response = client.get('/')
+        self.assertEqual(response.headers['Last-Modified'],
+            'Tue, 01 Jun 2010 12:30:15 GMT')
+
+        response = client.get('/', headers=[('If-Modified-Since',
+            'Tue, 01 Jun 2010 12:30:15 GMT')])
+        self.assertEqual(response.status_code, 304)
+
+    def test_with_middleware(self):
+        from tipfy.middleware import CompressionMiddleware, ETagMiddleware
+
+        class NameHandler(RequestHandler):
+            middleware = [CompressionMiddleware(min_size=0), ETagMiddleware()]
+
+            def validator(self, **kwargs):
+                return 'v1', datetime.datetime(2010, 6, 1)
+
+            def get(self, **kwargs):
+                return 'Hello %s' % self.request.args.get('user')
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=NameHandler)])
+        client = app.get_test_client()
+        headers = [('Accept-Encoding', 'deflate')]
+
+        # The validator etag doesn't identify the body, so compressed
+        # bodies are not shared.
+        for user in ('alice', 'bob'):
+            response = client.get('/?user=' + user, headers=headers)
+            self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+            self.assertEqual(zlib.decompress(response.data), 'Hello ' + user)
+
+        response = client.get('/?user=bob', headers=[('If-None-Match',
+            'W/"v1"')])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], 'w/"v1"')
+
+    def test_lazy_validator(self):
+        rule = Rule('/', name='home', handler=RequestHandler,
+            validator='tipfy.utils.json_encode')
+        self.assertEqual(rule.empty().validator, 'tipfy.utils.json_encode')
+
+
+class TestHead(BaseTestCase):
+    def get_app(self, config=None):
+        renders = self.renders = []
+
+        def render(title):
+            renders.append(title)
+            return u'<h1>%s</h1>' % title
+
+        class PageHandler(RequestHandler):
+            def validator(self, **kwargs):
+                return 'v1', None
+
+            def get(self, **kwargs):
+                response = self.make_deferred_response(render, u'Caf\xe9')
+                response.headers['X-Page'] = 'yes'
+                return response
+
+        class GetOnlyHandler(RequestHandler):
+            def get(self, **kwargs):
+                return self.make_deferred_response(render, u'Hello')
+
+        return Tipfy(rules=[
+            Rule('/page', name='page', handler=PageHandler),
+            Rule('/hello', name='hello', handler=GetOnlyHandler),
+        ], config=config)
+
+    def test_head_uses_get(self):
+        client = self.get_app().get_test_client()
+
+        response = client.head('/hello')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers.get('Content-Length'), None)
+        self.assertEqual(self.renders, [])
+
+        response = client.post('/hello')
+        self.assertEqual(response.status_code, 405)
+        self.assertTrue('HEAD' in response.headers['Allow'])
+
+    def test_deferred_body(self):
+        client = self.get_app().get_test_client()
+
+        response = client.get('/hello')
+        self.assertEqual(response.data, '<h1>Hello</h1>')
+        self.assertEqual(self.renders, ['Hello'])
+
+    def test_content_length_from_get(self):
+        client = self.get_app().get_test_client()
+
+        response = client.head('/page')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], 'w/"v1"')
+        self.assertEqual(response.headers['X-Page'], 'yes')
+        self.assertEqual(response.headers.get('Content-Length'), None)
+
+        response = client.get('/page')
+        self.assertEqual(response.data, '<h1>Caf\xc3\xa9</h1>')
+        self.assertEqual(self.renders, [u'Caf\xe9'])
+
+        response = client.head('/page')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['Content-Length'], '14')
+        self.assertEqual(self.renders, [u'Caf\xe9'])
+
+        # Another URL doesn't share the length.
+        response = client.head('/page?foo=bar')
+        self.assertEqual(response.headers.get('Content-Length'), None)
+
+    def test_length_cache_size(self):
+        app = self.get_app(config={'tipfy': {'length_cache_size': 1}})
+        client = app.get_test_client()
+
+        client.get('/page?a=1')
+        client.get('/page?a=2')
+        self.assertEqual(app.lengths.keys(),
+            [('http://localhost/page?a=2', ('v1', None))])
+
+        app = self.get_app(config={'tipfy': {'length_cache_size': 0}})
+        app.get_test_client().get('/page')
+        self.assertEqual(app.lengths, {})
+
+    def test_deferred_body_read(self):
+        app = self.get_app()
+        request = Request.from_values('/hello', method='HEAD')
+        handler = RequestHandler(app, request)
+        response = handler.make_deferred_response(lambda: 'Body')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.data, 'Body')
+
+
+class TestWarmup(BaseTestCase):
+    def get_app(self):
+        from tipfyext.jinja2 import Jinja2Mixin
+
+        class TemplateHandler(RequestHandler, Jinja2Mixin):
+            def get(self, **kwargs):
+                return 'Hello'
+
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+            Rule('/method', name='method',
+                handler='resources.handlers.HomeHandler:get'),
+            Rule('/template', name='template', handler=TemplateHandler),
+            Rule('/old', name='old', redirect_to='/'),
+            Rule('/warmup', name='warmup',
+                handler='tipfy.appengine.warmup.WarmupHandler'),
+        ], config={
+            'tipfy': {
+                'warmup_locales': ['pt_BR'],
+            },
+        })
+        app.error_handlers[404] = 'resources.handlers.HomeHandler'
+        return app
+
+    def test_warmup(self):
+        app = self.get_app()
+        timings = app.warmup()
+        self.assertEqual([step for step, seconds in timings], ['handlers',
+            'url_map', 'config', 'templates', 'translations'])
+
+        rules = dict((rule.name, rule) for rule in app.router.map.iter_rules())
+        HomeHandler = app.router.handlers['resources.handlers.HomeHandler']
+        self.assertEqual(HomeHandler.__name__, 'HomeHandler')
+        self.assertEqual(rules['home'].handler, HomeHandler)
+        self.assertEqual(rules['method'].handler, HomeHandler)
+        self.assertEqual(rules['method'].handler_method, 'get')
+        self.assertEqual(rules['old'].handler, 'old')
+        self.assertEqual(app.error_entries[404][1].handler, HomeHandler)
+
+        self.assertEqual('tipfyext.jinja2' in app.config.loaded, True)
+        self.assertEqual('jinja2' in app.registry, True)
+        self.assertEqual(app.registry['i18n.translations'].keys(), ['pt_BR'])
+
+    def test_warmup_handler(self):
+        client = self.get_app().get_test_client()
+        response = client.get('/warmup')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        lines = response.data.splitlines()
+        self.assertEqual([line.split(':')[0] for line in lines], ['handlers',
+            'url_map', 'config', 'templates', 'translations', 'total'])
+
+
+class TestStreaming(BaseTestCase):
+    def test_write(self):
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                self.write('Hello, ')
+                self.write(u'World!')
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=MyHandler)])
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'Hello, World!')
+
+    def test_write_with_return(self):
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                self.write('ignored')
+                return Response('returned')
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=MyHandler)])
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'returned')
+
+    def test_generator_method(self):
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                self.write('<ul>')
+                for i in range(3):
+                    self.write('<li>%d</li>' % i)
+                    yield
+
+                yield '</ul>'
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=MyHandler)])
+        request = Request.from_values('/')
+        response = app.router.dispatch(request, app.router.match(request))
+        self.assertEqual(response.is_streamed, True)
+        self.assertEqual(list(response.response), ['<ul><li>0</li>',
+            '<li>1</li>', '<li>2</li>', '</ul>'])
+
+    def test_generator_context(self):
+        from tipfy import current_handler
+        from tipfy.app import local
+
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                yield current_handler.url_for('home', _full=True)
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=MyHandler)])
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'http://localhost/')
+        self.assertRaises(AttributeError, getattr, local, 'current_handler')
+
+    def test_iterator(self):
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                return iter(['foo', 'bar'])
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=MyHandler)])
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'foobar')
+        self.assertEqual(response.headers.get('Content-Length'), None)
+
+    def test_make_response_iterable(self):
+        app = Tipfy()
+        request = Request.from_values()
+
+        def generate():
+            yield 'Hello, '
+            yield 'World!'
+
+        response = app.make_response(request, generate())
+        self.assertEqual(response.is_streamed, True)
+        self.assertEqual(response.data, 'Hello, World!')
+
+    def test_make_response_not_iterator(self):
+        app = Tipfy()
+        request = Request.from_values()
+
+        # Only iterators are streamed: a dict is not a body.
+        self.assertRaises(TypeError, app.make_response, request,
+            {'foo': 'bar'})
+        self.assertRaises(TypeError, app.make_response, request,
+            set(['foo']))
+
+    def test_headers_and_cookies_with_streaming(self):
+        class CookieMiddleware(object):
+            def after_dispatch(self, handler, response):
+                response.set_cookie('foo', 'bar')
+                return response
+
+        class MyHandler(RequestHandler):
+            middleware = [CookieMiddleware()]
+
+            def get(self, **kwargs):
+                yield 'foo'
+                yield 'bar'
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=MyHandler)])
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'foobar')
+        self.assertEqual(response.headers.get('Set-Cookie'), 'foo=bar; Path=/')
+
+    def test_cookie_before_first_yield(self):
+        from tipfy.sessions import SessionMiddleware
+
+        class MyHandler(RequestHandler):
+            middleware = [SessionMiddleware()]
+
+            def get(self, **kwargs):
+                self.session_store.set_cookie('foo', 'bar')
+                yield 'foo'
+                yield 'bar'
+
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler=MyHandler),
+        ], config={
+            'tipfy.sessions': {
+                'secret_key': 'secret',
+            },
+        })
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'foobar')
+        self.assertEqual(response.headers.get('Set-Cookie'), 'foo=bar; Path=/')
+
+    def test_abort_before_first_yield(self):
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                self.abort(404)
+                yield 'foo'
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=MyHandler)])
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.status_code, 404)
+
+
 class TestRequest(BaseTestCase):
     def test_json(self):
         class JsonHandler(RequestHandler):
@@ -508,3 +1105,52 @@ class TestRequest(BaseTestCase):
         client = app.get_test_client()
         response = client.get('/', content_type='application/json', data=data)
         self.assertEqual(response.data, 'bar')
+
+    def test_max_content_length(self):
+        class PostHandler(RequestHandler):
+            def post(self, **kwargs):
+                return Response(self.request.form.get('foo'))
+
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler=PostHandler),
+        ], config={
+            'tipfy': {
+                'max_content_length': 10,
+            },
+        })
+        client = app.get_test_client()
+
+        response = client.post('/', data={'foo': 'bar'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'bar')
+
+        response = client.post('/', data={'foo': 'a' * 100})
+        self.assertEqual(response.status_code, 413)
+
+    def test_upload_spooling(self):
+        from StringIO import StringIO
+
+        class UploadHandler(RequestHandler):
+            def post(self, **kwargs):
+                stream = self.request.files['file'].stream
+                rolled = getattr(stream, '_rolled', None)
+                return Response('%s:%s' % (rolled, len(stream.read())))
+
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler=UploadHandler),
+        ], config={
+            'tipfy': {
+                'upload_memory_threshold': 100,
+            },
+        })
+        client = app.get_test_client()
+
+        response = client.post('/', data={
+            'file': (StringIO('a' * 10), 'small.txt'),
+        })
+        self.assertEqual(response.data, 'False:10')
+
+        response = client.post('/', data={
+            'file': (StringIO('a' * 1000), 'big.txt'),
+        })
+        self.assertEqual(response.data, 'True:1000')
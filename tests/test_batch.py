@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.batch
+"""
+import base64
+import threading
+
+from . import BaseTestCase
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.batch import BatchHandler, ThreadPool
+from tipfy.utils import json_decode, json_encode
+
+
+class EchoHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response('%s %s' % (self.request.method,
+            self.request.args.get('q', '')))
+
+    def post(self, **kwargs):
+        return Response(self.request.data,
+            mimetype=self.request.mimetype or 'text/plain')
+
+
+class HeaderHandler(RequestHandler):
+    def get(self, **kwargs):
+        headers = self.request.headers
+        assert self.request.parent is not None
+        return Response('%s|%s' % (headers.get('Accept-Language'),
+            headers.get('X-Custom')))
+
+
+class SessionHandler(RequestHandler):
+    def get(self, **kwargs):
+        # Sub-requests share the session store of the batch request.
+        assert self.session_store is self.request.parent.session_store
+        return 'shared'
+
+
+class StoreIdHandler(RequestHandler):
+    def get(self, **kwargs):
+        return str(id(self.session_store))
+
+
+class BinaryHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response('\xff\xfe', mimetype='application/octet-stream')
+
+
+class BrokenHandler(RequestHandler):
+    def get(self, **kwargs):
+        raise ValueError('Boo!')
+
+
+class BlockingHandler(RequestHandler):
+    #: Released when two requests are being processed at the same time.
+    barrier = None
+
+    def get(self, **kwargs):
+        barrier = self.barrier
+        barrier[1].acquire()
+        try:
+            barrier[0] += 1
+            if barrier[0] == 2:
+                barrier[1].notifyAll()
+            else:
+                barrier[1].wait(5)
+
+            return str(barrier[0])
+        finally:
+            barrier[1].release()
+
+
+def get_app(config=None):
+    return Tipfy(rules=[
+        Rule('/batch', name='batch', handler=BatchHandler),
+        Rule('/echo', name='echo', handler=EchoHandler),
+        Rule('/headers', name='headers', handler=HeaderHandler),
+        Rule('/session', name='session', handler=SessionHandler),
+        Rule('/store-id', name='store-id', handler=StoreIdHandler),
+        Rule('/binary', name='binary', handler=BinaryHandler),
+        Rule('/broken', name='broken', handler=BrokenHandler),
+        Rule('/blocking', name='blocking', handler=BlockingHandler),
+    ], config=config)
+
+
+def post_batch(client, items, **kwargs):
+    return client.post('/batch', data=json_encode(items),
+        content_type='application/json', **kwargs)
+
+
+class TestBatchHandler(BaseTestCase):
+    def test_batch(self):
+        client = get_app().get_test_client()
+        response = post_batch(client, [
+            {'path': '/echo?q=foo'},
+            {'method': 'POST', 'path': '/echo', 'body': 'Hello'},
+            {'method': 'POST', 'path': '/echo', 'body': {'a': 1}},
+            {'method': 'HEAD', 'path': '/echo'},
+            {'path': '/not-found'},
+            {'path': '/broken'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+
+        results = json_decode(response.data)
+        self.assertEqual([r['status'] for r in results],
+            [200, 200, 200, 200, 404, 500])
+        self.assertEqual(results[0]['body'], 'GET foo')
+        self.assertEqual(results[1]['body'], 'Hello')
+        self.assertEqual(json_decode(results[2]['body']), {'a': 1})
+        self.assertTrue(['Content-Type', 'application/json']
+            in results[2]['headers'])
+        self.assertEqual(results[3]['body'], '')
+
+    def test_forward_headers(self):
+        client = get_app().get_test_client()
+        response = post_batch(client, [
+            {'path': '/headers'},
+            {'path': '/headers', 'headers': {'Accept-Language': 'pt-BR',
+                'X-Custom': 'foo'}},
+        ], headers=[('Accept-Language', 'en'), ('X-Custom', 'bar')])
+
+        results = json_decode(response.data)
+        self.assertEqual(results[0]['body'], 'en|None')
+        self.assertEqual(results[1]['body'], 'pt-BR|foo')
+
+    def test_shared_session_store(self):
+        app = get_app({'tipfy.sessions': {'secret_key': 'secret'}})
+        response = post_batch(app.get_test_client(), [{'path': '/session'}])
+        self.assertEqual(json_decode(response.data)[0]['body'], 'shared')
+
+    def test_parallel_shared_session_store(self):
+        app = get_app({'tipfy.sessions': {'secret_key': 'secret'}})
+        response = post_batch(app.get_test_client(),
+            [{'path': '/store-id', 'parallel': True}] * 4)
+        results = json_decode(response.data)
+        # Only one store is created for the batch.
+        self.assertEqual(len(set(r['body'] for r in results)), 1)
+
+    def test_binary_body(self):
+        client = get_app().get_test_client()
+        results = json_decode(post_batch(client, [{'path': '/binary'}]).data)
+        self.assertEqual(results[0]['encoding'], 'base64')
+        self.assertEqual(base64.b64decode(results[0]['body']), '\xff\xfe')
+
+    def test_invalid(self):
+        client = get_app().get_test_client()
+        for data in ('foo', '{}', '[1]', '[{"method": "GET"}]',
+            '[{"path": "http://example.com/"}]'):
+            response = client.post('/batch', data=data)
+            self.assertEqual(response.status_code, 400, data)
+
+        # Batches can't be nested.
+        results = json_decode(post_batch(client, [{'method': 'POST',
+            'path': '/batch', 'body': []}]).data)
+        self.assertEqual(results[0]['status'], 400)
+
+    def test_max_requests(self):
+        client = get_app({'tipfy.batch': {'max_requests': 2}}) \
+            .get_test_client()
+        response = post_batch(client, [{'path': '/echo'}] * 3)
+        self.assertEqual(response.status_code, 413)
+
+    def test_parallel(self):
+        BlockingHandler.barrier = [0, threading.Condition()]
+        client = get_app().get_test_client()
+        response = post_batch(client, [
+            {'path': '/echo?q=1'},
+            {'path': '/blocking', 'parallel': True},
+            {'path': '/blocking', 'parallel': True},
+            {'path': '/echo?q=2'},
+        ])
+        results = json_decode(response.data)
+        self.assertEqual([r['body'] for r in results], ['GET 1', '2', '2',
+            'GET 2'])
+
+    def test_parallel_disabled(self):
+        client = get_app({'tipfy.batch': {'max_workers': 0}}) \
+            .get_test_client()
+        response = post_batch(client, [
+            {'path': '/echo?q=1', 'parallel': True},
+            {'path': '/echo?q=2', 'parallel': True},
+        ])
+        results = json_decode(response.data)
+        self.assertEqual([r['body'] for r in results], ['GET 1', 'GET 2'])
+
+
+class TestThreadPool(BaseTestCase):
+    def test_map(self):
+        pool = ThreadPool(3)
+        self.assertEqual(pool.map(lambda x: x * 2, range(10)),
+            [x * 2 for x in range(10)])
+        self.assertEqual(len(pool.threads), 3)
+
+    def test_exception(self):
+        pool = ThreadPool(2)
+
+        def func(value):
+            if value == 3:
+                raise ValueError(value)
+
+            return value
+
+        self.assertRaises(ValueError, pool.map, func, range(5))
+        # The pool keeps working.
+        self.assertEqual(pool.map(func, [1, 2]), [1, 2])
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.cache
+"""
+from . import BaseTestCase
+
+from tipfy.cache import LRUCache
+
+
+class TestLRUCache(BaseTestCase):
+    def test_get_set(self):
+        cache = LRUCache()
+        self.assertEqual(cache.get('foo'), None)
+        cache.set('foo', 'bar')
+        self.assertEqual(cache.get('foo'), 'bar')
+        cache.set('foo', 'baz')
+        self.assertEqual(cache.get('foo'), 'baz')
+        self.assertEqual(len(cache), 1)
+
+    def test_add(self):
+        cache = LRUCache()
+        cache.add('foo', 'bar')
+        cache.add('foo', 'baz')
+        self.assertEqual(cache.get('foo'), 'bar')
+
+    def test_delete_and_clear(self):
+        cache = LRUCache()
+        cache.set('foo', 'bar')
+        cache.set('baz', 'ding')
+        cache.delete('foo')
+        cache.delete('foo')
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('baz'), 'ding')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # 'a' is now the most recently used.
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_timeout(self):
+        cache = LRUCache()
+        cache.set('foo', 'bar', timeout=-1)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(len(cache), 0)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for concurrent requests sharing an app
+"""
+import os
+import sys
+import threading
+
+from . import BaseTestCase
+
+from tipfy import Request, RequestHandler, Rule, Tipfy
+from tipfy.template import Loader
+
+current_dir = os.path.abspath(os.path.dirname(__file__))
+templates_dir = os.path.join(current_dir, 'resources', 'templates')
+
+
+class TestConcurrentRequests(BaseTestCase):
+    threads = 16
+    requests = 120
+
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.check_interval = sys.getcheckinterval()
+        # Switch threads as often as possible.
+        sys.setcheckinterval(1)
+
+    def tearDown(self):
+        sys.setcheckinterval(self.check_interval)
+        BaseTestCase.tearDown(self)
+
+    def get_app(self):
+        loader = Loader(templates_dir)
+
+        class TemplateHandler(RequestHandler):
+            def validator(self, **kwargs):
+                return 'v1', None
+
+            def get(self, **kwargs):
+                tpl = loader.load('template_tornado1.html')
+                return self.make_deferred_response(tpl.generate,
+                    students=[kwargs['name']])
+
+        rules = [
+            Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+            Rule('/template/<name>', name='template', handler=TemplateHandler),
+        ]
+        for i in range(50):
+            rules.append(Rule('/items/%d/<int:id>' % i, name='item-%d' % i,
+                handler='resources.handlers.ItemHandler:show'))
+
+        # Small caches, to be evicted concurrently.
+        return Tipfy(rules=rules, config={'tipfy': {
+            'negative_cache_size': 5,
+            'length_cache_size':   5,
+        }})
+
+    def get_request(self, n):
+        """Returns a tuple ``(method, path, status, body)`` for the nth
+        request of a thread.
+        """
+        kind = n % 5
+        if kind == 0:
+            return 'GET', '/', 200, 'Hello, World!'
+        elif kind == 1:
+            return 'GET', '/items/%d/%d' % (n % 50, n), 200, 'Item %d' % n
+        elif kind == 2:
+            return 'GET', '/missing/%d' % (n % 20), 404, None
+        elif kind == 3:
+            name = 'student%d' % (n % 10)
+            return 'GET', '/template/' + name, 200, self.templates[name]
+        else:
+            return 'HEAD', '/template/student%d' % (n % 10), 200, ''
+
+    def run_requests(self, app, start, errors):
+        client = app.get_test_client()
+        start.wait()
+        for n in range(self.requests):
+            method, path, status, body = self.get_request(n)
+            try:
+                response = client.open(path, method=method)
+                if response.status_code != status or (body is not None and
+                    response.data != body):
+                    errors.append((method, path, response.status_code,
+                        response.data))
+            except Exception, e:
+                errors.append((method, path, e))
+
+    def test_wsgi_app(self):
+        tpl = Loader(templates_dir).load('template_tornado1.html')
+        self.templates = dict(('student%d' % i, tpl.generate(
+            students=['student%d' % i])) for i in range(10))
+
+        app = self.get_app()
+        start = threading.Event()
+        errors = []
+        threads = [threading.Thread(target=self.run_requests,
+            args=(app, start, errors)) for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        router = app.router
+        self.assertEqual(sorted(router.handlers.keys()), [
+            'resources.handlers.HomeHandler',
+            'resources.handlers.ItemHandler'])
+        for rule in router.map.iter_rules('item-1'):
+            self.assertEqual(rule.handler.__name__, 'ItemHandler')
+            self.assertEqual(rule.handler_method, 'show')
+
+        self.assertTrue(len(router.negative_cache) <= 5)
+        self.assertTrue(len(app.lengths) <= 5)
+
+    def test_first_requests(self):
+        # The map was never matched: the first requests sort it and build
+        # its index while others are being matched. Rules are added in the
+        # opposite of match order, so an unsorted map matches the wrong one.
+        for attempt in range(10):
+            rules = []
+            for i in range(20):
+                rules.append(Rule('/items/%d/<name>' % i, name='item-%d' % i,
+                    handler='resources.handlers.HomeHandler'))
+                rules.append(Rule('/items/%d/new' % i, name='new-%d' % i,
+                    handler='resources.handlers.HomeHandler'))
+
+            app = Tipfy(rules=rules)
+            start = threading.Event()
+            errors = []
+
+            def match():
+                start.wait()
+                for i in range(20):
+                    request = Request.from_values('/items/%d/new' % i)
+                    try:
+                        rule = app.router.match(request)[0]
+                        if rule.name != 'new-%d' % i:
+                            errors.append(rule.name)
+                    except Exception, e:
+                        errors.append(e)
+
+            threads = [threading.Thread(target=match) for i in
+                range(self.threads)]
+            for thread in threads:
+                thread.start()
+
+            start.set()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+
+    def test_update_replaces_rule_lists(self):
+        app = self.get_app()
+        router = app.router
+        rules = router.map._rules
+        router.update()
+        self.assertTrue(router.map._rules is not rules)
+        self.assertEqual(len(router.map._rules), len(rules))
+
+        # Already sorted: nothing to do.
+        rules = router.map._rules
+        router.update()
+        self.assertTrue(router.map._rules is rules)
+
+        count = len(rules)
+        router.add(Rule('/new', name='new', handler='foo.Bar'))
+        app.get_test_client().get('/')
+        self.assertTrue(router.map._rules is not rules)
+        self.assertEqual(len(router.map._rules), count + 1)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.context
+"""
+import thread
+import threading
+
+from . import BaseTestCase
+
+from tipfy import (RequestHandler, Rule, Tipfy, get_current_app,
+    get_current_handler)
+from tipfy.app import local
+import tipfy.app
+import tipfy.context
+from tipfy.context import GreenletLocal, ThreadLocal
+
+
+class HomeHandler(RequestHandler):
+    def get(self, **kwargs):
+        assert get_current_handler() is self
+        assert get_current_app() is self.app
+        return 'Hello, World!'
+
+
+class BaseLocalTest(object):
+    def get_local(self):
+        raise NotImplementedError()
+
+    def test_set_get(self):
+        ctx = self.get_local()
+        ctx.foo = 'bar'
+        self.assertEqual(ctx.foo, 'bar')
+
+    def test_missing(self):
+        ctx = self.get_local()
+        self.assertRaises(AttributeError, getattr, ctx, 'foo')
+
+    def test_delete(self):
+        ctx = self.get_local()
+        ctx.foo = 'bar'
+        del ctx.foo
+        self.assertRaises(AttributeError, getattr, ctx, 'foo')
+        self.assertRaises(AttributeError, delattr, ctx, 'foo')
+
+    def test_release(self):
+        ctx = self.get_local()
+        ctx.foo = 'bar'
+        ctx.__release_local__()
+        self.assertRaises(AttributeError, getattr, ctx, 'foo')
+
+    def test_proxy(self):
+        ctx = self.get_local()
+        proxy = ctx('foo')
+        ctx.foo = [1, 2]
+        self.assertEqual(len(proxy), 2)
+        self.assertEqual(proxy[1], 2)
+
+    def test_isolation(self):
+        ctx = self.get_local()
+        ctx.foo = 'main'
+        values = []
+
+        def worker():
+            values.append(getattr(ctx, 'foo', None))
+            ctx.foo = 'worker'
+            values.append(ctx.foo)
+
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+
+        self.assertEqual(values, [None, 'worker'])
+        self.assertEqual(ctx.foo, 'main')
+
+
+class TestThreadLocal(BaseLocalTest, BaseTestCase):
+    def get_local(self):
+        return ThreadLocal()
+
+
+class TestGreenletLocal(BaseLocalTest, BaseTestCase):
+    def setUp(self):
+        # Use thread ids as context keys when greenlet is not installed.
+        self._get_current_greenlet = tipfy.context.get_current_greenlet
+        tipfy.context.get_current_greenlet = thread.get_ident
+        BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        tipfy.context.get_current_greenlet = self._get_current_greenlet
+        BaseTestCase.tearDown(self)
+
+    def get_local(self):
+        return GreenletLocal()
+
+
+class TestAccessors(BaseTestCase):
+    def test_no_handler(self):
+        local.__release_local__()
+        self.assertRaises(RuntimeError, get_current_handler)
+        self.assertRaises(RuntimeError, get_current_app)
+
+    def test_in_request(self):
+        app = Tipfy(rules=[Rule('/', name='home', handler=HomeHandler)])
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'Hello, World!')
+
+
+class StreamHandler(RequestHandler):
+    def get(self, **kwargs):
+        yield 'Hello, '
+        assert get_current_handler() is self
+        yield 'World!'
+
+
+class TestStreamingContext(BaseTestCase):
+    def setUp(self):
+        self._get_current_greenlet = tipfy.context.get_current_greenlet
+        self._local = tipfy.app.local
+        tipfy.context.get_current_greenlet = thread.get_ident
+        tipfy.app.local = GreenletLocal()
+        BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        tipfy.context.get_current_greenlet = self._get_current_greenlet
+        tipfy.app.local = self._local
+        BaseTestCase.tearDown(self)
+
+    def test_storage_released(self):
+        app = Tipfy(rules=[Rule('/', name='home', handler=StreamHandler)])
+        response = app.get_test_client().get('/')
+        self.assertEqual(response.data, 'Hello, World!')
+        # No empty storage is left behind for the context.
+        self.assertEqual(tipfy.app.local.__storage__, {})
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.deadline
+"""
+import time
+
+from . import BaseTestCase
+
+from tipfy import Request, RequestHandler, Rule, Tipfy
+from tipfy.app import local
+from tipfy.deadline import (Deadline, DeadlineExceeded, get_deadline,
+    get_timeout)
+from tipfy.tracing import timer
+
+
+class DeadlineHandler(RequestHandler):
+    def get(self, **kwargs):
+        deadline = self.request.deadline
+        if deadline is None:
+            return 'None'
+
+        assert get_deadline() is deadline
+        return '%s %.1f' % (deadline.timeout, get_timeout(100))
+
+
+class SlowHandler(RequestHandler):
+    def get(self, **kwargs):
+        time.sleep(0.02)
+        # Not enough time left to fetch something.
+        get_timeout(10)
+        return 'Done'
+
+
+def get_app(config=None):
+    return Tipfy(rules=[
+        Rule('/', name='home', handler=DeadlineHandler),
+        Rule('/short', name='short', handler=DeadlineHandler, deadline=2),
+        Rule('/slow', name='slow', handler=SlowHandler, deadline=0.01),
+    ], config=config)
+
+
+class TestDeadline(BaseTestCase):
+    def test_remaining(self):
+        deadline = Deadline(10)
+        self.assertTrue(9 < deadline.remaining() <= 10)
+        self.assertEqual(deadline.expired, False)
+        deadline.check()
+        self.assertEqual(deadline.get_timeout(5), 5)
+        self.assertTrue(9 < deadline.get_timeout(20) <= 10)
+
+    def test_expired(self):
+        deadline = Deadline(1, start=timer() - 2)
+        self.assertEqual(deadline.remaining(), 0)
+        self.assertEqual(deadline.expired, True)
+        self.assertRaises(DeadlineExceeded, deadline.check)
+        self.assertRaises(DeadlineExceeded, deadline.get_timeout, 5)
+
+    def test_get_timeout_without_request(self):
+        self.assertEqual(get_deadline(), None)
+        self.assertEqual(get_timeout(10), 10)
+
+    def test_get_timeout_with_request(self):
+        request = Request.from_values()
+        request.deadline = Deadline(3)
+        local.current_handler = RequestHandler(get_app(), request)
+        self.assertTrue(get_deadline() is request.deadline)
+        self.assertTrue(2 < get_timeout(10) <= 3)
+        self.assertEqual(get_timeout(1), 1)
+
+
+class TestRequestDeadline(BaseTestCase):
+    def test_no_deadline(self):
+        client = get_app().get_test_client()
+        self.assertEqual(client.get('/').data, 'None')
+
+    def test_config(self):
+        client = get_app({'tipfy': {'request_deadline': 10}}).get_test_client()
+        self.assertEqual(client.get('/').data, '10 10.0')
+
+    def test_rule_override(self):
+        client = get_app({'tipfy': {'request_deadline': 10}}).get_test_client()
+        self.assertEqual(client.get('/short').data, '2 2.0')
+
+        client = get_app().get_test_client()
+        self.assertEqual(client.get('/short').data, '2 2.0')
+
+    def test_exceeded(self):
+        client = get_app().get_test_client()
+        response = client.get('/slow')
+        self.assertEqual(response.status_code, 503)
+
+    def test_rule_copy(self):
+        rule = Rule('/', name='home', handler=DeadlineHandler, deadline=5)
+        self.assertEqual(rule.empty().deadline, 5)
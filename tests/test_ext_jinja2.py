@@ -64,6 +64,19 @@ class TestJinja2(unittest.TestCase):
         self.assertEqual(response.mimetype, 'text/html')
         self.assertEqual(response.data, message)
 
+    def test_render_response_head(self):
+        app = Tipfy(config={'tipfyext.jinja2': {'templates_dir': templates_dir}})
+        request = Request.from_values(method='HEAD')
+        local.current_handler = handler = RequestHandler(app, request)
+        jinja2 = Jinja2(app)
+
+        response = jinja2.render_response(handler, 'template1.html',
+            message='Hello, World!')
+        self.assertEqual(response.mimetype, 'text/html')
+        # The template is rendered only if the body is read.
+        self.assertEqual(response.is_streamed, True)
+        self.assertEqual(response.data, 'Hello, World!')
+
     def test_render_response_force_compiled(self):
         app = Tipfy(config={
             'tipfyext.jinja2': {
@@ -11,7 +11,10 @@ from gaetestbed import DataStoreTestCase
 
 from werkzeug.exceptions import NotFound
 
+from tipfy import Request, RequestHandler, Tipfy
+from tipfy.app import local
 from tipfy.appengine import db as ext_db
+from tipfy.deadline import Deadline
 
 
 class FooModel(db.Model):
@@ -532,6 +535,18 @@ class TestModel(DataStoreTestCase, unittest.TestCase):
         self.assertRaises(db.Timeout, test_timeout_3, counter=counter)
         self.assertEqual(counter[0], 3)
 
+    def test_retry_on_timeout_deadline(self):
+        request = Request.from_values()
+        request.deadline = Deadline(0.05)
+        local.current_handler = RequestHandler(Tipfy(), request)
+        try:
+            # Stops retrying when the wait would pass the deadline.
+            counter = [0]
+            self.assertRaises(db.Timeout, test_timeout_3, counter=counter)
+            self.assertEqual(counter[0], 1)
+        finally:
+            local.__release_local__()
+
     #===========================================================================
     # @db.load_entity
     #===========================================================================
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.lazy and the import profiler
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+from . import BaseTestCase
+
+from tipfy.lazy import LazyModule
+from tipfy.scripts.manage import profile_imports
+
+
+class TestLazyModule(BaseTestCase):
+    def test_not_loaded_until_accessed(self):
+        calls = []
+
+        def loader():
+            calls.append(1)
+            import string
+            return string
+
+        module = LazyModule(loader)
+        self.assertEqual(calls, [])
+        self.assertTrue('not loaded' in repr(module))
+
+        self.assertEqual(module.ascii_lowercase[:3], 'abc')
+        self.assertEqual(module.digits, '0123456789')
+        self.assertEqual(calls, [1])
+        self.assertFalse('not loaded' in repr(module))
+
+    def test_module_name(self):
+        module = LazyModule('os.path')
+        self.assertTrue(module.join is os.path.join)
+
+    def test_missing_attribute(self):
+        module = LazyModule('os.path')
+        self.assertRaises(AttributeError, getattr, module, 'foo_bar_baz')
+
+    def test_import_error(self):
+        module = LazyModule('tipfy.foo_bar_baz')
+        self.assertRaises(ImportError, getattr, module, 'foo')
+
+    def test_setattr(self):
+        import string
+        module = LazyModule('string')
+        original = string.digits
+        try:
+            module.digits = '42'
+            self.assertEqual(module.digits, '42')
+            self.assertEqual(string.digits, '42')
+        finally:
+            string.digits = original
+
+
+class TestProfileImports(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.path = tempfile.mkdtemp()
+        package = os.path.join(self.path, 'lazy_pkg')
+        os.mkdir(package)
+        open(os.path.join(package, '__init__.py'), 'w').close()
+        f = open(os.path.join(package, 'a.py'), 'w')
+        f.write('import lazy_pkg.b\nimport os\n')
+        f.close()
+        open(os.path.join(package, 'b.py'), 'w').close()
+        sys.path.insert(0, self.path)
+
+    def tearDown(self):
+        sys.path.remove(self.path)
+        for name in ('lazy_pkg', 'lazy_pkg.a', 'lazy_pkg.b', 'lazy_pkg.c'):
+            sys.modules.pop(name, None)
+
+        shutil.rmtree(self.path)
+        BaseTestCase.tearDown(self)
+
+    def test_profile_imports(self):
+        original_import = __import__
+        timings = profile_imports('lazy_pkg.a')
+        import __builtin__
+        self.assertTrue(__builtin__.__import__ is original_import)
+
+        modules = [t[0] for t in timings]
+        # The package is loaded in the same import as lazy_pkg.a.
+        self.assertEqual(sorted(modules), ['lazy_pkg.a', 'lazy_pkg.b'])
+
+        timings = dict((t[0], t) for t in timings)
+        # lazy_pkg.a includes the time spent importing lazy_pkg.b.
+        module, cumulative, own = timings['lazy_pkg.a']
+        self.assertTrue(cumulative >= timings['lazy_pkg.b'][1])
+        self.assertTrue(own <= cumulative)
+
+    def test_from_import(self):
+        f = open(os.path.join(self.path, 'lazy_pkg', 'c.py'), 'w')
+        f.write('from lazy_pkg import b\n')
+        f.close()
+        timings = profile_imports('lazy_pkg.c')
+        modules = [t[0] for t in timings]
+        self.assertEqual(sorted(modules), ['lazy_pkg.b', 'lazy_pkg.c'])
+
+    def test_already_imported(self):
+        self.assertEqual(profile_imports('os'), [])
@@ -0,0 +1,563 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.middleware
+"""
+import datetime
+import gzip
+import threading
+import time
+import zlib
+from StringIO import StringIO
+
+from . import BaseTestCase
+
+from tipfy import REQUEST_START_KEY, RequestHandler, Response, Rule, Tipfy
+from tipfy.middleware import (CompressionMiddleware, ETagMiddleware,
+    LoadSheddingMiddleware, ResponseCacheMiddleware)
+
+BODY = 'Hello, World! ' * 100
+
+
+def get_app(middleware):
+    class MyHandler(RequestHandler):
+        def get(self, **kwargs):
+            return Response('Hello, World!')
+
+    class StreamHandler(RequestHandler):
+        def get(self, **kwargs):
+            yield 'Hello, '
+            yield 'World!'
+
+    class BigHandler(RequestHandler):
+        def get(self, **kwargs):
+            return Response(BODY)
+
+    class ImageHandler(RequestHandler):
+        def get(self, **kwargs):
+            return Response(BODY, mimetype='image/png')
+
+    MyHandler.middleware = StreamHandler.middleware = middleware
+    BigHandler.middleware = ImageHandler.middleware = middleware
+    return Tipfy(rules=[
+        Rule('/', name='home', handler=MyHandler),
+        Rule('/stream', name='stream', handler=StreamHandler),
+        Rule('/big', name='big', handler=BigHandler),
+        Rule('/image', name='image', handler=ImageHandler),
+    ])
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+class TestETagMiddleware(BaseTestCase):
+    def test_etag(self):
+        app = get_app([ETagMiddleware()])
+        client = app.get_test_client()
+
+        response = client.get('/')
+        etag = response.headers.get('ETag')
+        self.assertNotEqual(etag, None)
+        self.assertEqual(response.data, 'Hello, World!')
+
+        response = client.get('/', headers=[('If-None-Match', etag)])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+
+    def test_streamed(self):
+        app = get_app([ETagMiddleware()])
+        client = app.get_test_client()
+
+        response = client.get('/stream')
+        self.assertEqual(response.headers.get('ETag'), None)
+        self.assertEqual(response.data, 'Hello, World!')
+
+    def test_streamed_buffered(self):
+        app = get_app([ETagMiddleware(buffer_streamed=True)])
+        client = app.get_test_client()
+
+        response = client.get('/stream')
+        etag = response.headers.get('ETag')
+        self.assertNotEqual(etag, None)
+        self.assertEqual(response.data, 'Hello, World!')
+
+        response = client.get('/stream', headers=[('If-None-Match', etag)])
+        self.assertEqual(response.status_code, 304)
+
+
+class TestCompressionMiddleware(BaseTestCase):
+    def test_gzip(self):
+        app = get_app([CompressionMiddleware()])
+        client = app.get_test_client()
+
+        response = client.get('/big', headers=[('Accept-Encoding', 'gzip')])
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(int(response.headers['Content-Length']),
+            len(response.data))
+        self.assertEqual(gunzip(response.data), BODY)
+
+    def test_preset_content_length(self):
+        class MyHandler(RequestHandler):
+            middleware = [CompressionMiddleware()]
+
+            def get(self, **kwargs):
+                response = Response(BODY)
+                response.headers['Content-Length'] = str(len(BODY))
+                return response
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=MyHandler)])
+        client = app.get_test_client()
+
+        response = client.get('/', headers=[('Accept-Encoding', 'gzip')])
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(int(response.headers['Content-Length']),
+            len(response.data))
+        self.assertEqual(gunzip(response.data), BODY)
+
+    def test_deflate(self):
+        app = get_app([CompressionMiddleware()])
+        client = app.get_test_client()
+
+        response = client.get('/big', headers=[('Accept-Encoding',
+            'gzip;q=0.5, deflate')])
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.data), BODY)
+
+    def test_not_accepted(self):
+        app = get_app([CompressionMiddleware()])
+        client = app.get_test_client()
+
+        for value in (None, 'identity', 'gzip;q=0, deflate;q=0', 'br'):
+            headers = value and [('Accept-Encoding', value)] or []
+            response = client.get('/big', headers=headers)
+            self.assertEqual(response.headers.get('Content-Encoding'), None)
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(response.data, BODY)
+
+    def test_skipped(self):
+        app = get_app([CompressionMiddleware()])
+        client = app.get_test_client()
+        headers = [('Accept-Encoding', 'gzip')]
+
+        # Too small.
+        response = client.get('/', headers=headers)
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(response.data, 'Hello, World!')
+
+        # Not in the mimetypes whitelist.
+        response = client.get('/image', headers=headers)
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(response.headers.get('Vary'), None)
+        self.assertEqual(response.data, BODY)
+
+    def test_streamed(self):
+        app = get_app([CompressionMiddleware()])
+        client = app.get_test_client()
+
+        response = client.get('/stream', headers=[('Accept-Encoding',
+            'gzip')])
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers.get('Content-Length'), None)
+        self.assertEqual(gunzip(response.data), 'Hello, World!')
+
+    def test_compress_iter(self):
+        middleware = CompressionMiddleware()
+        decompressor = zlib.decompressobj()
+        chunks = []
+        for chunk in middleware.compress_iter(iter(['foo', u'b\xe4r']),
+            zlib.MAX_WBITS):
+            # Each chunk can be decompressed as soon as it is received.
+            chunks.append(decompressor.decompress(chunk))
+
+        self.assertEqual(chunks, ['foo', 'b\xc3\xa4r', ''])
+
+    def test_etag(self):
+        middleware = CompressionMiddleware()
+        app = get_app([middleware, ETagMiddleware()])
+        client = app.get_test_client()
+        headers = [('Accept-Encoding', 'gzip')]
+
+        response = client.get('/big', headers=headers)
+        etag = response.headers['ETag']
+        self.assertEqual(etag.endswith('-gzip"'), True)
+        self.assertEqual(gunzip(response.data), BODY)
+        self.assertEqual(len(middleware.cache), 1)
+
+        # The compressed body comes from cache.
+        response = client.get('/big', headers=headers)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(gunzip(response.data), BODY)
+        self.assertEqual(len(middleware.cache), 1)
+
+        response = client.get('/big', headers=headers +
+            [('If-None-Match', etag)])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.data, '')
+
+        # The uncompressed representation has a different etag.
+        response = client.get('/big')
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.data, BODY)
+
+        response = client.get('/big', headers=[('If-None-Match', etag)])
+        self.assertEqual(response.status_code, 200)
+
+    def test_weak_etag(self):
+        compression = CompressionMiddleware()
+
+        class WeakHandler(RequestHandler):
+            middleware = [compression, ETagMiddleware()]
+
+            def get(self, **kwargs):
+                response = Response(BODY + self.request.args.get('name', ''))
+                response.set_etag('foo', weak=True)
+                return response
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=WeakHandler)])
+        client = app.get_test_client()
+        headers = [('Accept-Encoding', 'gzip')]
+
+        response = client.get('/', headers=headers)
+        self.assertEqual(response.headers['ETag'], 'w/"foo"')
+        self.assertEqual(gunzip(response.data), BODY)
+
+        response = client.get('/', headers=headers +
+            [('If-None-Match', 'W/"foo"')])
+        self.assertEqual(response.status_code, 304)
+
+        # Bodies with a weak etag are not cached: they may differ.
+        response = client.get('/?name=bob', headers=headers)
+        self.assertEqual(gunzip(response.data), BODY + 'bob')
+        self.assertEqual(len(compression.cache), 0)
+
+    def test_cache_size(self):
+        middleware = CompressionMiddleware(cache_size=1)
+        middleware.get_cached('a', 'gzip', BODY, zlib.MAX_WBITS)
+        middleware.get_cached('b', 'gzip', BODY, zlib.MAX_WBITS)
+        self.assertEqual(middleware.cache.keys(), [('b', 'gzip')])
+
+
+def get_cache_app(middleware, calls):
+    class CachedHandler(RequestHandler):
+        def get(self, **kwargs):
+            calls.append(self.request.url)
+            response = Response('Hello, %s!' % self.request.args.get('name'))
+            response.cache_control.max_age = 60
+            response.headers['Vary'] = 'Accept-Language'
+            return response
+
+    class PrivateHandler(RequestHandler):
+        def get(self, **kwargs):
+            calls.append(self.request.url)
+            response = Response('Hello!')
+            response.cache_control.max_age = 60
+            response.cache_control.private = True
+            return response
+
+    class CookieHandler(RequestHandler):
+        def get(self, **kwargs):
+            calls.append(self.request.url)
+            response = Response('Hello!')
+            response.cache_control.max_age = 60
+            response.set_cookie('foo', 'bar')
+            return response
+
+    class NoCacheHandler(RequestHandler):
+        def get(self, **kwargs):
+            calls.append(self.request.url)
+            return Response('Hello!')
+
+    for cls in (CachedHandler, PrivateHandler, CookieHandler, NoCacheHandler):
+        cls.middleware = middleware
+
+    return Tipfy(rules=[
+        Rule('/', name='home', handler=CachedHandler),
+        Rule('/private', name='private', handler=PrivateHandler),
+        Rule('/cookie', name='cookie', handler=CookieHandler),
+        Rule('/no-cache', name='no-cache', handler=NoCacheHandler),
+    ])
+
+
+class TestResponseCacheMiddleware(BaseTestCase):
+    def test_hit(self):
+        calls = []
+        middleware = ResponseCacheMiddleware()
+        app = get_cache_app([middleware], calls)
+        client = app.get_test_client()
+
+        response = client.get('/?name=foo')
+        self.assertEqual(response.data, 'Hello, foo!')
+        self.assertEqual(response.headers.get('Age'), None)
+
+        response = client.get('/?name=foo')
+        self.assertEqual(response.data, 'Hello, foo!')
+        self.assertEqual(response.headers['Age'], '0')
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=60')
+        self.assertEqual(len(calls), 1)
+
+        # Another query is another entry.
+        response = client.get('/?name=bar')
+        self.assertEqual(response.data, 'Hello, bar!')
+        self.assertEqual(len(calls), 2)
+
+        self.assertEqual(middleware.get_stats(), {
+            'hits': 1, 'misses': 2, 'ratio': 1 / 3.0})
+
+    def test_non_ascii_query_string(self):
+        calls = []
+        app = get_cache_app([ResponseCacheMiddleware()], calls)
+        client = app.get_test_client()
+
+        for i in range(2):
+            response = client.get('/', query_string='name=\xc3\xa9')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, 'Hello, \xc3\xa9!')
+
+        self.assertEqual(len(calls), 1)
+
+    def test_vary(self):
+        calls = []
+        app = get_cache_app([ResponseCacheMiddleware()], calls)
+        client = app.get_test_client()
+
+        client.get('/', headers=[('Accept-Language', 'en')])
+        client.get('/', headers=[('Accept-Language', 'en')])
+        self.assertEqual(len(calls), 1)
+        client.get('/', headers=[('Accept-Language', 'pt-BR')])
+        self.assertEqual(len(calls), 2)
+        client.get('/', headers=[('Accept-Language', 'pt-BR')])
+        self.assertEqual(len(calls), 2)
+
+    def test_not_cached(self):
+        calls = []
+        middleware = ResponseCacheMiddleware()
+        app = get_cache_app([middleware], calls)
+        client = app.get_test_client()
+
+        for path in ('/private', '/cookie', '/no-cache'):
+            client.get(path)
+            client.get(path)
+
+        self.assertEqual(len(calls), 6)
+        self.assertEqual(middleware.hits, 0)
+
+        # Requests with credentials bypass the cache.
+        client.get('/', headers=[('Authorization', 'Basic Zm9vOmJhcg==')])
+        client.get('/', headers=[('Authorization', 'Basic Zm9vOmJhcg==')])
+        self.assertEqual(len(calls), 8)
+
+    def test_with_etag(self):
+        calls = []
+        middleware = [ResponseCacheMiddleware(), ETagMiddleware()]
+        app = get_cache_app(middleware, calls)
+        client = app.get_test_client()
+
+        etag = client.get('/').headers['ETag']
+        response = client.get('/', headers=[('If-None-Match', etag)])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(calls), 1)
+
+    def test_get_timeout(self):
+        middleware = ResponseCacheMiddleware()
+
+        response = Response('foo')
+        self.assertEqual(middleware.get_timeout(response), None)
+
+        response.cache_control.max_age = 60
+        response.cache_control.s_maxage = 30
+        self.assertEqual(middleware.get_timeout(response), 30)
+
+        response = Response('foo')
+        response.date = datetime.datetime(2010, 1, 1, 12, 0, 0)
+        response.expires = datetime.datetime(2010, 1, 1, 12, 10, 0)
+        self.assertEqual(middleware.get_timeout(response), 600)
+
+        response = Response('foo', status=500)
+        response.cache_control.max_age = 60
+        self.assertEqual(middleware.get_timeout(response), None)
+
+
+def get_shedding_app(middleware):
+    class MyHandler(RequestHandler):
+        def get(self, **kwargs):
+            return Response('Hello, World!')
+
+    class BrokenHandler(RequestHandler):
+        def get(self, **kwargs):
+            raise ValueError('Boo!')
+
+    class Handle500(RequestHandler):
+        def handle_exception(self, exception=None):
+            return Response('Error', status=500)
+
+    MyHandler.middleware = BrokenHandler.middleware = middleware
+    app = Tipfy(rules=[
+        Rule('/', name='home', handler=MyHandler),
+        Rule('/reports', name='reports', handler=MyHandler),
+        Rule('/tasks', name='tasks', handler=MyHandler),
+        Rule('/_ah/warmup', name='warmup', handler=MyHandler),
+        Rule('/broken', name='broken', handler=BrokenHandler),
+    ])
+    app.error_handlers[500] = Handle500
+    return app
+
+
+class TestLoadSheddingMiddleware(BaseTestCase):
+    def test_concurrency_limit(self):
+        middleware = LoadSheddingMiddleware(max_in_flight=2, retry_after=5)
+        client = get_shedding_app([middleware]).get_test_client()
+
+        response = client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(middleware.in_flight, 0)
+
+        # Simulate two requests being processed.
+        middleware.acquire(1.0)
+        middleware.acquire(1.0)
+        response = client.get('/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+
+        middleware.release(0)
+        response = client.get('/')
+        self.assertEqual(response.status_code, 200)
+
+        stats = middleware.get_stats()
+        self.assertEqual(stats['in_flight'], 1)
+        self.assertEqual(stats['peak_in_flight'], 2)
+        self.assertEqual(stats['accepted'], 4)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['rejected_reasons'], {'concurrency': 1,
+            'queue_delay': 0})
+        self.assertEqual(stats['rejected_rules'], {'home': 1})
+
+    def test_priorities(self):
+        middleware = LoadSheddingMiddleware(max_in_flight=2,
+            priorities={'reports': 0.5, 'tasks': None})
+        client = get_shedding_app([middleware]).get_test_client()
+
+        middleware.acquire(1.0)
+        self.assertEqual(client.get('/reports').status_code, 503)
+        self.assertEqual(client.get('/').status_code, 200)
+
+        middleware.acquire(1.0)
+        self.assertEqual(client.get('/').status_code, 503)
+        # Never rejected.
+        self.assertEqual(client.get('/tasks').status_code, 200)
+        self.assertEqual(client.get('/_ah/warmup').status_code, 200)
+        self.assertEqual(middleware.in_flight, 2)
+
+    def test_queue_delay(self):
+        middleware = LoadSheddingMiddleware(max_queue_delay=1)
+        client = get_shedding_app([middleware]).get_test_client()
+
+        now = time.time()
+        for value, status in [
+            ('t=%f' % (now - 5), 503),
+            ('t=%d' % ((now - 5) * 1000), 503),
+            ('t=%d' % ((now - 5) * 1000000), 503),
+            ('%f' % now, 200),
+            ('foo', 200),
+        ]:
+            response = client.get('/', headers=[('X-Request-Start', value)])
+            self.assertEqual(response.status_code, status, value)
+
+        self.assertEqual(middleware.get_stats()['rejected_reasons'], {
+            'concurrency': 0, 'queue_delay': 3})
+
+    def test_queue_delay_in_process(self):
+        middleware = LoadSheddingMiddleware(max_queue_delay=1)
+        client = get_shedding_app([middleware]).get_test_client()
+
+        # Without the header, the delay is measured from the time the
+        # request was received.
+        response = client.get('/', environ_base={
+            REQUEST_START_KEY: time.time() - 5})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(client.get('/').status_code, 200)
+
+    def test_exception_releases_slot(self):
+        middleware = LoadSheddingMiddleware(max_in_flight=1)
+        client = get_shedding_app([middleware]).get_test_client()
+
+        response = client.get('/broken')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(middleware.in_flight, 0)
+        self.assertEqual(client.get('/').status_code, 200)
+
+    def test_other_middleware_releases_slot(self):
+        class BrokenBefore(object):
+            def before_dispatch(self, handler):
+                raise ValueError('Boo!')
+
+        class BrokenAfter(object):
+            def after_dispatch(self, handler, response):
+                raise ValueError('Boo!')
+
+        class HandleException(object):
+            def handle_exception(self, handler, exception):
+                return Response('Handled', status=500)
+
+        middleware = LoadSheddingMiddleware(max_in_flight=1)
+        for other, path in [
+            ([middleware, BrokenBefore()], '/'),
+            ([middleware, BrokenAfter()], '/'),
+            ([HandleException(), middleware], '/broken'),
+        ]:
+            client = get_shedding_app(other).get_test_client()
+            self.assertEqual(client.get(path).status_code, 500)
+            self.assertEqual(middleware.in_flight, 0)
+
+    def test_wait_for_slot(self):
+        middleware = LoadSheddingMiddleware(max_in_flight=1, max_wait=5)
+        middleware.acquire(1.0)
+        thread = threading.Timer(0.05, middleware.release, args=(0,))
+        thread.start()
+        try:
+            self.assertEqual(middleware.acquire(1.0), True)
+        finally:
+            thread.join()
+
+        middleware.max_wait = 0.01
+        self.assertEqual(middleware.acquire(1.0), False)
+
+    def test_wait_with_priorities(self):
+        middleware = LoadSheddingMiddleware(max_in_flight=2, max_wait=1)
+        middleware.acquire(1.0)
+        middleware.acquire(1.0)
+
+        # A low priority request waits first; the freed slot only fits the
+        # high priority one, which must be woken too.
+        low = []
+        thread = threading.Thread(target=lambda: low.append(
+            middleware.acquire(0.5)))
+        thread.start()
+        time.sleep(0.05)
+        timer = threading.Timer(0.05, middleware.release, args=(0,))
+        timer.start()
+        try:
+            start = time.time()
+            self.assertEqual(middleware.acquire(1.0), True)
+            self.assertTrue(time.time() - start < 0.5)
+        finally:
+            timer.join()
+            thread.join()
+
+        self.assertEqual(low, [False])
+
+    def test_adaptive_limit(self):
+        middleware = LoadSheddingMiddleware(max_in_flight=10,
+            target_latency=0.5, min_in_flight=2)
+        for i in range(50):
+            middleware.acquire(1.0)
+            middleware.release(1.0)
+
+        self.assertEqual(middleware.limit, 2)
+
+        for i in range(200):
+            middleware.acquire(1.0)
+            middleware.release(0.1)
+
+        self.assertEqual(middleware.limit, 10)
@@ -3,7 +3,8 @@ from __future__ import with_statement
 from . import BaseTestCase
 
 from tipfy import Tipfy, RequestHandler, Response
-from tipfy.routing import HandlerPrefix, NamePrefix, Router, Rule
+from tipfy.routing import (HandlerPrefix, NamePrefix, Router, Rule,
+    Submount, TenantRouter)
 
 
 class TestRouter(BaseTestCase):
@@ -21,6 +22,446 @@ class TestRouter(BaseTestCase):
         ])
         self.assertEqual(len(list(router.map.iter_rules())), 3)
 
+    def test_negative_cache(self):
+        class HomeHandler(RequestHandler):
+            def get(self, **kwargs):
+                return 'home'
+
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler=HomeHandler, methods=['GET']),
+        ], config={'tipfy': {'negative_cache_size': 1000}})
+        router = app.router
+        client = app.get_test_client()
+
+        for i in range(3):
+            self.assertEqual(client.get('/missing').status_code, 404)
+            response = client.post('/')
+            self.assertEqual(response.status_code, 405)
+            self.assertEqual('GET' in response.headers['Allow'], True)
+
+        self.assertEqual(len(router.negative_cache), 2)
+        self.assertEqual(client.get('/').data, 'home')
+
+        # Adding rules invalidates the cache.
+        router.add(Rule('/missing', name='missing', handler=HomeHandler))
+        self.assertEqual(client.get('/missing').data, 'home')
+        self.assertEqual(len(router.negative_cache), 0)
+
+        # Also when added directly to the map.
+        self.assertEqual(client.get('/other').status_code, 404)
+        router.map.add(Rule('/other', name='other', handler=HomeHandler))
+        self.assertEqual(client.get('/other').data, 'home')
+
+    def test_negative_cache_stale_miss(self):
+        from werkzeug.exceptions import NotFound
+
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+        ], config={'tipfy': {'negative_cache_size': 1000}})
+        router = app.router
+        client = app.get_test_client()
+        self.assertEqual(client.get('/').status_code, 200)
+
+        # A miss stored after the map was updated, by a request matched
+        # against the old rules, is not used.
+        router.cache_miss(('', '/', 'GET'), router.map.generation - 1,
+            NotFound, ())
+        self.assertEqual(client.get('/').status_code, 200)
+
+    def test_negative_cache_disabled(self):
+        app = Tipfy()
+        self.assertEqual(app.router.negative_cache_size, 0)
+        client = app.get_test_client()
+        self.assertEqual(client.get('/').status_code, 404)
+        self.assertEqual(app.router.negative_cache, {})
+
+    def test_negative_cache_size(self):
+        app = Tipfy(config={'tipfy': {'negative_cache_size': 2}})
+        client = app.get_test_client()
+        for i in range(5):
+            self.assertEqual(client.get('/%d' % i).status_code, 404)
+
+        self.assertEqual(len(app.router.negative_cache), 2)
+
+        app = Tipfy(config={'tipfy': {'negative_cache_size': 0}})
+        client = app.get_test_client()
+        self.assertEqual(client.get('/').status_code, 404)
+        self.assertEqual(app.router.negative_cache, {})
+
+    def test_adapter_cache(self):
+        from tipfy import Request
+        from tipfy.routing import Subdomain
+
+        def get_app(size):
+            return Tipfy(rules=[
+                Rule('/', name='home', handler='HomeHandler'),
+                Rule('/items/<int:id>', name='item', handler='HomeHandler'),
+                Subdomain('<area>', [
+                    Rule('/', name='area', handler='HomeHandler'),
+                ]),
+            ], config={'tipfy': {
+                'server_name':        'example.com',
+                'adapter_cache_size': size,
+            }})
+
+        cached = get_app(2)
+        uncached = get_app(0)
+        requests = [
+            ('/items/1', {'base_url': 'http://example.com/'}),
+            ('/items/2', {'base_url': 'http://example.com/'}),
+            ('/', {'base_url': 'https://foo.example.com/'}),
+            ('/items/3', {'base_url': 'http://example.com/app/'}),
+            ('/items/4', {'base_url': 'http://example.com:8080/'}),
+            ('/', {'base_url': 'http://bar.example.com/', 'method': 'POST'}),
+        ]
+        for i in range(2):
+            for path, kwargs in requests:
+                adapters = []
+                for app in (cached, uncached):
+                    request = Request.from_values(path, **kwargs)
+                    match = app.router.match(request)
+                    adapter = request.url_adapter
+                    adapters.append((match, adapter.server_name,
+                        adapter.script_name, adapter.subdomain,
+                        adapter.url_scheme, adapter.path_info,
+                        adapter.default_method, [app.router.build(request,
+                        name, dict(values)) for name, values in (
+                        ('item', {'id': 5}),
+                        ('item', {'id': 5, '_full': True}),
+                        ('item', {'id': 5, '_scheme': 'https'}),
+                        ('item', {'id': 5, '_netloc': 'other.com'}),
+                        ('area', {'area': 'baz', 'q': 'x'}),
+                        )]))
+
+                self.assertEqual(adapters[0], adapters[1])
+
+        self.assertEqual(len(cached.router.adapter_cache), 2)
+        self.assertEqual(uncached.router.adapter_cache, {})
+
+    def test_rule_index(self):
+        from werkzeug.exceptions import HTTPException
+        from werkzeug.routing import Map as WerkzeugMap, RequestRedirect
+        from tipfy.routing import Map, Subdomain
+
+        def get_rules():
+            return [
+                Rule('/', name='home'),
+                Rule('/about', name='about', methods=['GET']),
+                Rule('/about', name='about-post', methods=['POST']),
+                Rule('/docs/', name='docs'),
+                Rule('/loose', name='loose', strict_slashes=False),
+                Rule('/hidden', name='hidden', build_only=True),
+                Rule('/old', name='old', redirect_to='about'),
+                Rule('/pages/', name='pages', defaults={'page': 1}),
+                Rule('/pages/<int:page>', name='pages'),
+                Rule('/<slug>', name='slug'),
+                Rule('/files/<path:path>', name='files'),
+                Submount('/api', [
+                    Rule('/', name='api'),
+                    Rule('/items', name='api-items'),
+                    Rule('/items/<int:id>', name='api-item'),
+                    Rule('/items/<int:id>/edit', name='api-edit',
+                        methods=['POST']),
+                    Rule('/v<int:version>/status', name='api-status'),
+                ]),
+                Subdomain('admin', [
+                    Rule('/', name='admin'),
+                    Rule('/users/<int:id>', name='admin-user'),
+                ]),
+                Subdomain('<tenant>', [
+                    Rule('/dashboard', name='dashboard'),
+                ]),
+            ]
+
+        paths = ['/', '', '/about', '/about/', '/docs', '/docs/', '/loose',
+            '/loose/', '/hidden', '/old', '/pages', '/pages/', '/pages/2',
+            '/pages/x', '/foo', '/foo/', '/files/a/b.txt', '/files/',
+            '/api', '/api/', '/api/items', '/api/items/', '/api/items/3',
+            '/api/items/3/edit', '/api/items/x', '/api/v2/status',
+            '/api/vx/status', '/dashboard', '/users/1', '/missing/path',
+            '/about\n']
+        maps = [Map(get_rules(), default_subdomain='www'),
+            WerkzeugMap(get_rules(), default_subdomain='www')]
+
+        def match(map, subdomain, path, method):
+            adapter = map.bind('example.com', '/', subdomain=subdomain)
+            try:
+                rule, args = adapter.match(path, method, return_rule=True)
+                return rule.endpoint, args
+            except RequestRedirect, e:
+                return 'redirect', e.new_url
+            except HTTPException, e:
+                return e.code, sorted(getattr(e, 'valid_methods', None) or [])
+
+        for subdomain in ('www', 'admin', 'acme'):
+            for path in paths:
+                for method in ('GET', 'POST'):
+                    self.assertEqual(match(maps[0], subdomain, path, method),
+                        match(maps[1], subdomain, path, method))
+
+        # Only the selected rules are tested.
+        index = maps[0]._index
+        self.assertEqual(sorted(rule.endpoint for position, rule in
+            index.get_rules(u'www|/api/items/3')), ['api-edit', 'api-item',
+            'api-status', 'dashboard', 'slug'])
+        self.assertEqual(len(index.get_rules(u'www|/about')), 4)
+
+    def test_build(self):
+        from werkzeug import MultiDict
+        from werkzeug.routing import BuildError, Map as WerkzeugMap
+        from tipfy.routing import Map, Subdomain
+
+        def get_rules():
+            return [
+                Rule('/', name='home'),
+                Rule('/about', name='about', methods=['GET']),
+                Rule('/about-post', name='about', methods=['POST']),
+                Rule('/pages/', name='pages', defaults={'page': 1}),
+                Rule('/pages/<int:page>', name='pages'),
+                Rule('/a.b/<x>', name='dots'),
+                Rule('/100%/<int:id>', name='percent'),
+                Rule('/files/<path:path>', name='files'),
+                Submount('/api', [
+                    Rule('/items/<int:id>/<any(a, b):kind>', name='kind'),
+                ]),
+                Subdomain('<tenant>', [
+                    Rule('/dashboard', name='dashboard'),
+                ]),
+            ]
+
+        calls = [
+            ('home', {}),
+            ('home', {'q': u'\xe7', 'z': [1, 2], 'a': None}),
+            ('home', MultiDict([('q', 'a'), ('q', 'b')])),
+            ('about', {}),
+            ('pages', {}),
+            ('pages', {'page': 1}),
+            ('pages', {'page': 2, 'sort': 'date'}),
+            ('pages', {'page': 'x'}),
+            ('dots', {'x': 'y'}),
+            ('percent', {'id': 5}),
+            ('files', {'path': 'a/b c.txt'}),
+            ('files', {'path': 'a:b'}),
+            ('kind', {'id': 1, 'kind': 'a'}),
+            ('kind', {'id': 1, 'kind': 'c'}),
+            ('dashboard', {'tenant': 'acme'}),
+            ('missing', {}),
+        ]
+        maps = [Map(get_rules(), default_subdomain='www'),
+            WerkzeugMap(get_rules(), default_subdomain='www')]
+
+        def build(map, script_name, default_method, name, values, method,
+            full):
+            adapter = map.bind('example.com', script_name,
+                default_method=default_method)
+            try:
+                return adapter.build(name, values, method=method,
+                    force_external=full)
+            except BuildError:
+                return 'error'
+            except ValueError:
+                # Raised by the int converter for both maps.
+                return 'invalid'
+
+        for script_name in ('/', '/app/'):
+            for default_method in ('GET', 'POST'):
+                for name, values in calls:
+                    for method in (None, 'GET', 'POST'):
+                        for full in (False, True):
+                            args = (script_name, default_method, name,
+                                values, method, full)
+                            self.assertEqual(build(maps[0], *args),
+                                build(maps[1], *args))
+
+    def test_url_for_many(self):
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+            Rule('/items/<int:page>', name='items',
+                handler='resources.handlers.HomeHandler'),
+        ])
+        with app.get_test_handler('/') as handler:
+            values = [{'page': 1}, {'page': 2, 'sort': 'name'}]
+            self.assertEqual(handler.url_for_many('items', values,
+                sort='date', _anchor='top'), ['/items/1?sort=date#top',
+                '/items/2?sort=name#top'])
+            self.assertEqual(handler.url_for_many('items', values,
+                _netloc='other.com'), ['http://other.com/items/1',
+                'http://other.com/items/2?sort=name'])
+            self.assertEqual(handler.url_for_many('items', []), [])
+            self.assertEqual(handler.url_for('items', page=3, _full=True),
+                'http://localhost/items/3')
+
+    def test_rule_index_after_add(self):
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+        ])
+        client = app.get_test_client()
+        self.assertEqual(client.get('/').status_code, 200)
+        self.assertEqual(client.get('/other').status_code, 404)
+
+        app.router.add(Rule('/other', name='other',
+            handler='resources.handlers.HomeHandler'))
+        self.assertEqual(client.get('/other').status_code, 200)
+
+
+class ArgsHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response(','.join('%s=%s' % item for item in
+            sorted(kwargs.items())))
+
+
+class UrlHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response('%s %s' % (self.url_for('page', _full=True),
+            self.url_for('about')))
+
+
+def get_tenant_rules(tenant=None, plan=None):
+    return [
+        Rule('/', name='home', handler=ArgsHandler),
+        Rule('/%s' % plan, name='plan', handler=ArgsHandler),
+    ]
+
+
+def get_url(client, url):
+    base_url, path = url.rsplit('/', 1)
+    return client.get('/' + path, base_url=base_url + '/')
+
+
+class TenantApp(Tipfy):
+    router_class = TenantRouter
+
+
+class TestTenantRouter(BaseTestCase):
+    def test_match(self):
+        app = TenantApp(rules=[
+            Rule('/', name='home', handler=ArgsHandler, defaults={'g': 1}),
+            Rule('/about', name='about', handler=ArgsHandler),
+        ])
+        app.router.add_tenant('<tenant>.example.com', get_tenant_rules,
+            plan='free')
+        app.router.add_tenant('WWW.Customer.com', [
+            Rule('/', name='home', handler=ArgsHandler),
+        ], tenant='customer')
+        client = app.get_test_client()
+
+        def get(url):
+            response = get_url(client, url)
+            return response.status_code, response.data
+
+        self.assertEqual(get('http://localhost/'), (200, 'g=1'))
+        self.assertEqual(get('http://acme.example.com/'),
+            (200, 'plan=free,tenant=acme'))
+        self.assertEqual(get('http://foo.example.com:8080/free'),
+            (200, 'plan=free,tenant=foo'))
+        self.assertEqual(get('http://www.customer.com/'),
+            (200, 'tenant=customer'))
+        # Global rules are matched when tenant rules don't match.
+        self.assertEqual(get('http://acme.example.com/about'), (200, ''))
+        self.assertEqual(get('http://www.customer.com/free')[0], 404)
+        self.assertEqual(get('http://a.b.example.com/free')[0], 404)
+
+        self.assertEqual(len(app.router.tenant_maps), 3)
+        self.assertEqual(len(list(app.router.map.iter_rules())), 2)
+
+    def test_add(self):
+        app = TenantApp(rules=[
+            Rule('/', name='home', handler=ArgsHandler),
+        ])
+        app.router.add_tenant('*.example.com', [
+            Rule('/', name='home', handler=ArgsHandler, defaults={'t': 1}),
+        ])
+        client = app.get_test_client()
+        self.assertEqual(get_url(client, 'http://a.example.com/').data, 't=1')
+        response = get_url(client, 'http://a.example.com/new')
+        self.assertEqual(response.status_code, 404)
+        tenant_map = app.router.get_tenant_map(app.request_class.from_values(
+            base_url='http://a.example.com/'))[0]
+
+        # Rules are added to cached maps without rebuilding them.
+        app.router.add(Rule('/new', name='new', handler=ArgsHandler),
+            host='<tenant>.example.com')
+        app.router.add([Rule('/only-b', name='only-b', handler=ArgsHandler)],
+            host='b.example.com')
+        response = get_url(client, 'http://a.example.com/new')
+        self.assertEqual(response.status_code, 200)
+        response = get_url(client, 'http://b.example.com/new')
+        self.assertEqual(response.status_code, 200)
+        response = get_url(client, 'http://b.example.com/only-b')
+        self.assertEqual(response.status_code, 200)
+        response = get_url(client, 'http://a.example.com/only-b')
+        self.assertEqual(response.status_code, 404)
+        response = get_url(client, 'http://localhost/new')
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(app.router.get_tenant_map(app.request_class
+            .from_values(base_url='http://a.example.com/'))[0] is tenant_map)
+
+    def test_add_unknown_host(self):
+        app = TenantApp()
+        app.router.add_tenant('*.example.com', get_tenant_rules)
+        app.router.add_tenant('www.customer.com', get_tenant_rules)
+        rule = Rule('/new', name='new', handler=ArgsHandler)
+        app.router.add(rule, host='www.customer.com')
+        app.router.add(rule, host='a.example.com')
+        self.assertRaises(ValueError, app.router.add, rule,
+            host='www.other.com')
+        self.assertRaises(ValueError, app.router.add, rule,
+            host='<tenant>.other.com')
+        self.assertEqual(sorted(app.router.tenant_rules.keys()),
+            ['a.example.com', 'www.customer.com'])
+
+    def test_method_not_allowed(self):
+        app = TenantApp(rules=[
+            Rule('/form', name='form', handler=ArgsHandler, methods=['GET']),
+            Rule('/about', name='about', handler=ArgsHandler,
+                methods=['PUT']),
+        ])
+        app.router.add_tenant('*.example.com', [
+            Rule('/form', name='form', handler=ArgsHandler,
+                methods=['POST']),
+            Rule('/tenant', name='tenant', handler=ArgsHandler,
+                methods=['POST']),
+            Rule('/about', name='about', handler=ArgsHandler,
+                methods=['POST']),
+        ])
+        client = app.get_test_client()
+
+        # Global rules are matched when the tenant rules don't allow the
+        # method.
+        response = get_url(client, 'http://a.example.com/form')
+        self.assertEqual(response.status_code, 200)
+        response = get_url(client, 'http://a.example.com/tenant')
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual('POST' in response.headers['Allow'], True)
+        response = get_url(client, 'http://a.example.com/about')
+        self.assertEqual(response.status_code, 405)
+        allowed = response.headers['Allow']
+        self.assertEqual('POST' in allowed and 'PUT' in allowed, True)
+
+    def test_cache_size(self):
+        app = TenantApp(config={'tipfy': {'tenant_cache_size': 2}})
+        app.router.add_tenant('<tenant>.example.com', get_tenant_rules)
+        client = app.get_test_client()
+        for name in ('a', 'b', 'c', 'a'):
+            response = get_url(client, 'http://%s.example.com/' % name)
+            self.assertEqual(response.data, 'tenant=%s' % name)
+
+        self.assertEqual(len(app.router.tenant_maps), 2)
+
+    def test_build(self):
+        app = TenantApp(rules=[
+            Rule('/about', name='about', handler=UrlHandler),
+        ])
+        app.router.add_tenant('<tenant>.example.com', [
+            Rule('/', name='home', handler=UrlHandler),
+            Rule('/page', name='page', handler=ArgsHandler),
+        ])
+        client = app.get_test_client()
+        self.assertEqual(get_url(client, 'http://acme.example.com/').data,
+            'http://acme.example.com/page /about')
+        self.assertEqual(get_url(client, 'http://acme.example.com/about').data,
+            'http://acme.example.com/page /about')
+
 
 class TestRouting(BaseTestCase):
     #==========================================================================
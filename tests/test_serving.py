@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.serving
+"""
+import httplib
+import threading
+import time
+
+from . import BaseTestCase
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.serving import ThreadPoolServer, run_server
+
+
+class HelloHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response('Hello, World!')
+
+    def post(self, **kwargs):
+        return Response(self.request.form.get('name', ''))
+
+    head = get
+
+
+class StreamHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response(iter(['foo', 'bar', 'baz']))
+
+
+class RedirectHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response(iter(['Moved']), status=302,
+            headers=[('Location', '/')])
+
+
+class EnvironHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response(type(self.request.environ['REMOTE_PORT']).__name__)
+
+
+class SlowHandler(RequestHandler):
+    def get(self, **kwargs):
+        time.sleep(0.3)
+        return Response('slow')
+
+
+def get_app():
+    return Tipfy(rules=[
+        Rule('/', name='home', handler=HelloHandler),
+        Rule('/stream', name='stream', handler=StreamHandler),
+        Rule('/slow', name='slow', handler=SlowHandler),
+        Rule('/redirect', name='redirect', handler=RedirectHandler),
+        Rule('/environ', name='environ', handler=EnvironHandler),
+    ])
+
+
+class TestThreadPoolServer(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop(timeout=1)
+            self.server.server_close()
+
+        BaseTestCase.tearDown(self)
+
+    def start_server(self, **kwargs):
+        kwargs.setdefault('keep_alive_timeout', 2)
+        self.server = ThreadPoolServer(get_app(), port=0, **kwargs)
+        thread = threading.Thread(target=self.server.serve_forever,
+            kwargs={'poll_interval': 0.05})
+        thread.setDaemon(True)
+        thread.start()
+        return self.server.server_address[1]
+
+    def test_keep_alive(self):
+        port = self.start_server(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+
+        for i in range(3):
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read(), 'Hello, World!')
+            self.assertEqual(response.getheader('Connection'), None)
+
+        conn.close()
+
+    def test_request_body(self):
+        port = self.start_server(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+
+        conn.request('POST', '/', 'name=tipfy',
+            {'Content-Type': 'application/x-www-form-urlencoded'})
+        response = conn.getresponse()
+        self.assertEqual(response.read(), 'tipfy')
+
+        # Same connection is still usable.
+        conn.request('GET', '/')
+        self.assertEqual(conn.getresponse().read(), 'Hello, World!')
+        conn.close()
+
+    def test_chunked_request_body(self):
+        port = self.start_server(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+
+        conn.putrequest('POST', '/')
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        conn.send('4\r\nname\r\n0\r\n\r\n')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 411)
+        self.assertEqual(response.getheader('Connection'), 'close')
+        conn.close()
+
+    def test_environ(self):
+        port = self.start_server(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+
+        conn.request('GET', '/environ')
+        self.assertEqual(conn.getresponse().read(), 'str')
+        conn.close()
+
+    def test_chunked_response(self):
+        port = self.start_server(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+
+        conn.request('GET', '/stream')
+        response = conn.getresponse()
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(response.read(), 'foobarbaz')
+
+        conn.request('GET', '/')
+        self.assertEqual(conn.getresponse().read(), 'Hello, World!')
+        conn.close()
+
+    def test_redirect_without_length(self):
+        port = self.start_server(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+
+        conn.request('GET', '/redirect')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 302)
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(response.read(), 'Moved')
+
+        conn.request('GET', '/')
+        self.assertEqual(conn.getresponse().read(), 'Hello, World!')
+        conn.close()
+
+    def test_max_keep_alive(self):
+        port = self.start_server(workers=3, max_keep_alive=1)
+        conn1 = httplib.HTTPConnection('127.0.0.1', port)
+        conn2 = httplib.HTTPConnection('127.0.0.1', port)
+
+        conn1.request('GET', '/')
+        response = conn1.getresponse()
+        self.assertEqual(response.getheader('Connection'), None)
+        response.read()
+
+        # The only keep-alive slot is taken by the first connection.
+        conn2.request('GET', '/')
+        response = conn2.getresponse()
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertEqual(response.read(), 'Hello, World!')
+
+        conn1.close()
+        conn2.close()
+
+    def test_head(self):
+        port = self.start_server(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+
+        conn.request('HEAD', '/')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Length'), '13')
+        self.assertEqual(response.read(), '')
+        conn.close()
+
+    def test_404(self):
+        port = self.start_server(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+
+        conn.request('GET', '/nowhere')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 404)
+        response.read()
+        conn.close()
+
+    def test_queue_full(self):
+        port = self.start_server(workers=1, queue_size=1)
+
+        # Occupy the only worker and the only queue slot.
+        conns = []
+        for i in range(2):
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/slow')
+            conns.append(conn)
+            time.sleep(0.05)
+
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.getheader('Retry-After'), '1')
+
+        for conn in conns:
+            self.assertEqual(conn.getresponse().read(), 'slow')
+            conn.close()
+
+    def test_stop_finishes_requests(self):
+        port = self.start_server(workers=2)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/slow')
+        time.sleep(0.05)
+
+        self.server.stop(timeout=2)
+        response = conn.getresponse()
+        self.assertEqual(response.read(), 'slow')
+        self.assertEqual(response.getheader('Connection'), 'close')
+        conn.close()
+        self.server.server_close()
+        self.server = None
+
+
+class TestRunServer(BaseTestCase):
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, run_server, get_app(), mode='foo',
+            port=0)
+
+    def test_warmup_called_first(self):
+        calls = []
+
+        def warmup(app):
+            calls.append(app)
+            raise KeyboardInterrupt()
+
+        app = get_app()
+        self.assertRaises(KeyboardInterrupt, run_server, app, port=0,
+            warmup=warmup)
+        self.assertEqual(calls, [app])
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.sse
+"""
+import threading
+
+from . import BaseTestCase
+
+from tipfy import RequestHandler, Rule, Tipfy
+from tipfy.sse import Event, Hub
+
+
+class StreamHandler(RequestHandler):
+    def get(self, **kwargs):
+        hub = Hub.factory(self.app, 'sse', heartbeat=0.01)
+        return hub.stream(self, 'news', max_duration=0.05)
+
+
+def get_app():
+    return Tipfy(rules=[
+        Rule('/events', name='events', handler=StreamHandler),
+    ])
+
+
+class TestEvent(BaseTestCase):
+    def test_encode(self):
+        event = Event(u'foo\nbar', event='update', id=3)
+        self.assertEqual(event.encode(),
+            'id: 3\nevent: update\ndata: foo\ndata: bar\n\n')
+
+    def test_encode_json(self):
+        self.assertEqual(Event({'a': 1}).encode(), 'data: {"a": 1}\n\n')
+
+    def test_encode_empty(self):
+        self.assertEqual(Event(u'').encode(), 'data: \n\n')
+
+
+class TestHub(BaseTestCase):
+    def test_publish_subscribe(self):
+        hub = Hub()
+        sub = hub.subscribe('news')
+        other = hub.subscribe('sports')
+        event = hub.publish('news', 'hello')
+
+        self.assertEqual(event.id, 1)
+        self.assertEqual(sub.get(0), [event])
+        self.assertEqual(other.get(0), [])
+
+    def test_replay(self):
+        hub = Hub(replay_size=2)
+        hub.publish('news', 'one')
+        hub.publish('news', 'two')
+        hub.publish('news', 'three')
+
+        sub = hub.subscribe('news', last_event_id=1)
+        self.assertEqual([e.data for e in sub.get(0)], ['two', 'three'])
+
+        sub = hub.subscribe('news', last_event_id=3)
+        self.assertEqual(sub.get(0), [])
+
+    def test_slow_subscriber_is_dropped(self):
+        hub = Hub(queue_size=2)
+        slow = hub.subscribe('news')
+        fast = hub.subscribe('news')
+        for i in range(3):
+            hub.publish('news', str(i))
+            fast.get(0)
+
+        self.assertEqual(slow.dropped, True)
+        self.assertEqual(slow.closed, True)
+        self.assertEqual(fast.closed, False)
+        stats = hub.get_stats()
+        self.assertEqual(stats['subscribers'], 1)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['published'], 3)
+
+    def test_get_wakes_up_on_publish(self):
+        hub = Hub()
+        sub = hub.subscribe('news')
+        timer = threading.Timer(0.01, hub.publish, ('news', 'hello'))
+        timer.start()
+        events = sub.get(5)
+        timer.join()
+        self.assertEqual([e.data for e in events], ['hello'])
+
+    def test_iter_events(self):
+        hub = Hub(heartbeat=0.01, retry=1000)
+        sub = hub.subscribe('news')
+        stream = hub.iter_events(sub)
+        self.assertEqual(stream.next(), 'retry: 1000\n\n')
+        self.assertEqual(stream.next(), ': heartbeat\n\n')
+
+        hub.publish('news', 'a')
+        hub.publish('news', 'b')
+        self.assertEqual(stream.next(), 'id: 1\ndata: a\n\nid: 2\ndata: b\n\n')
+
+        hub.close()
+        self.assertRaises(StopIteration, stream.next)
+        self.assertEqual(hub.get_stats()['subscribers'], 0)
+
+    def test_closing_stream_unsubscribes(self):
+        hub = Hub()
+        stream = hub.iter_events(hub.subscribe('news'))
+        stream.next()
+        self.assertEqual(hub.get_stats()['subscribers'], 1)
+        stream.close()
+        self.assertEqual(hub.get_stats()['subscribers'], 0)
+
+    def test_factory(self):
+        app = get_app()
+        hub = Hub.factory(app, 'sse')
+        self.assertEqual(Hub.factory(app, 'sse') is hub, True)
+
+
+class TestStream(BaseTestCase):
+    def test_stream(self):
+        app = get_app()
+        hub = Hub.factory(app, 'sse', heartbeat=0.01)
+        hub.publish('news', 'one')
+        hub.publish('news', 'two')
+
+        client = app.get_test_client()
+        response = client.get('/events', headers={'Last-Event-ID': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(response.data.startswith(':\n\nid: 2\ndata: two\n\n'),
+            True)
+        self.assertEqual(hub.get_stats()['subscribers'], 0)
+
+    def test_head(self):
+        app = get_app()
+        client = app.get_test_client()
+        response = client.head('/events')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, '')
+        self.assertEqual(Hub.factory(app, 'sse').get_stats()['subscribers'], 0)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for rule statistics and tipfy.stats
+"""
+from . import BaseTestCase
+
+from tipfy import Rule, Tipfy
+from tipfy.routing import Submount
+from tipfy.utils import json_decode
+
+
+def get_app(**config):
+    config.setdefault('rule_stats', True)
+    return Tipfy(rules=[
+        Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+        Rule('/<slug>', name='slug',
+            handler='resources.handlers.HomeHandler'),
+        Rule('/about', name='about',
+            handler='resources.handlers.HomeHandler'),
+        Submount('/a', [
+            Rule('/<int:id>', name='a',
+                handler='resources.handlers.HomeHandler'),
+        ]),
+        Submount('/b', [
+            Rule('/<int:id>', name='b',
+                handler='resources.handlers.HomeHandler'),
+        ]),
+        Rule('/_stats', name='stats',
+            handler='tipfy.stats.RuleStatsHandler'),
+    ], config={'tipfy': config})
+
+
+class TestRuleStats(BaseTestCase):
+    def test_disabled(self):
+        app = get_app(rule_stats=False)
+        client = app.get_test_client()
+        client.get('/')
+        self.assertEqual(app.router.rule_stats, None)
+        self.assertEqual(app.router.get_rule_stats(), [])
+
+    def test_stats(self):
+        app = get_app()
+        client = app.get_test_client()
+        for i in range(3):
+            client.get('/b/%d' % i)
+
+        client.get('/')
+        client.get('/missing/path')
+
+        stats = app.router.get_rule_stats()
+        self.assertEqual([(s['name'], s['count']) for s in stats],
+            [('b', 3), ('home', 1)])
+        self.assertEqual(stats[0]['rule'], '/b/<int:id>')
+        self.assertEqual(stats[0]['mean'] > 0, True)
+        self.assertEqual(stats[0]['max'] >= stats[0]['mean'], True)
+
+        app.router.reset_rule_stats()
+        self.assertEqual(app.router.get_rule_stats(), [])
+
+    def test_reorder(self):
+        app = get_app()
+        router = app.router
+        client = app.get_test_client()
+        for i in range(5):
+            client.get('/b/%d' % i)
+            client.get('/about')
+
+        client.get('/a/1')
+        before = [rule.name for rule in router.map._rules]
+        self.assertEqual(before.index('a') < before.index('b'), True)
+
+        router.reorder_rules()
+        after = [rule.name for rule in router.map._rules]
+        self.assertEqual(after.index('b') < after.index('a'), True)
+        # '/about' can also be matched by '/<slug>': the order is kept.
+        self.assertEqual(after.index('about') < after.index('slug'), True)
+        self.assertEqual(client.get('/about').data, 'Hello, World!')
+        positions = dict((s['name'], s['position']) for s in
+            router.get_rule_stats())
+        self.assertEqual(positions['b'], after.index('b'))
+
+        # The order is kept when rules are added.
+        router.add(Rule('/c', name='c',
+            handler='resources.handlers.HomeHandler'))
+        self.assertEqual(client.get('/c').status_code, 200)
+        after = [rule.name for rule in router.map._rules]
+        self.assertEqual(after.index('b') < after.index('a'), True)
+
+    def test_reorder_interval(self):
+        app = get_app(rule_stats=False, rule_reorder_interval=60)
+        router = app.router
+        client = app.get_test_client()
+        for i in range(3):
+            client.get('/b/%d' % i)
+
+        self.assertEqual(router.map.hits, None)
+        router.next_reorder = 0
+        client.get('/b/1')
+        self.assertEqual(router.map.hits is not None, True)
+        names = [rule.name for rule in router.map._rules]
+        self.assertEqual(names.index('b') < names.index('a'), True)
+        self.assertEqual(router.next_reorder > 0, True)
+
+    def test_handler(self):
+        app = get_app()
+        client = app.get_test_client()
+        client.get('/b/1')
+
+        response = client.get('/_stats')
+        data = json_decode(response.data)
+        self.assertEqual(data['enabled'], True)
+        self.assertEqual(sorted(r['name'] for r in data['rules']),
+            ['b', 'stats'])
+
+        response = client.post('/_stats', data={'action': 'reset'})
+        data = json_decode(response.data)
+        self.assertEqual(data['rules'], [])
+
+        response = client.post('/_stats', data={'action': 'reorder'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.post('/_stats').status_code, 400)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.tracing
+"""
+from . import BaseTestCase
+
+from tipfy import RequestHandler, Rule, Tipfy
+from tipfy.tracing import RequestTrace, TraceAggregator
+
+
+class MyMiddleware(object):
+    def before_dispatch(self, handler):
+        pass
+
+    def after_dispatch(self, handler, response):
+        return response
+
+
+class HomeHandler(RequestHandler):
+    middleware = [MyMiddleware()]
+
+    def get(self, **kwargs):
+        return 'Hello, World!'
+
+
+def get_app(tracing=True):
+    return Tipfy(rules=[
+        Rule('/', name='home', handler=HomeHandler),
+        Rule('/lazy', name='lazy', handler='resources.handlers.HomeHandler'),
+    ], config={
+        'tipfy': {
+            'enable_tracing': tracing,
+        },
+    })
+
+
+def get_phases(response):
+    header = response.headers.get('Server-Timing')
+    return [metric.split(';')[0] for metric in header.split(', ')]
+
+
+class TestTracing(BaseTestCase):
+    def test_disabled(self):
+        app = get_app(tracing=False)
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'Hello, World!')
+        self.assertEqual(response.headers.get('Server-Timing'), None)
+        self.assertEqual(app.trace_aggregator.samples, {})
+
+    def test_server_timing(self):
+        app = get_app()
+        client = app.get_test_client()
+        response = client.get('/')
+        self.assertEqual(response.data, 'Hello, World!')
+        self.assertEqual(get_phases(response), [
+            'request',
+            'match',
+            'dispatch_spec',
+            'before_dispatch.MyMiddleware',
+            'handler',
+            'make_response',
+            'after_dispatch.MyMiddleware',
+            'total',
+        ])
+
+    def test_server_timing_lazy_handler(self):
+        app = get_app()
+        client = app.get_test_client()
+        response = client.get('/lazy')
+        self.assertEqual(response.data, 'Hello, World!')
+        self.assertEqual(get_phases(response), [
+            'request',
+            'match',
+            'dispatch_spec',
+            'handler',
+            'make_response',
+            'total',
+        ])
+
+    def test_not_found(self):
+        app = get_app()
+        client = app.get_test_client()
+        response = client.get('/nowhere')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(get_phases(response), ['request', 'total'])
+        self.assertEqual(len(app.trace_aggregator.samples[None]['total']), 1)
+
+    def test_aggregator(self):
+        app = get_app()
+        client = app.get_test_client()
+        for i in range(10):
+            client.get('/')
+
+        stats = app.trace_aggregator.get_stats()
+        self.assertEqual(stats['home']['total']['count'], 10)
+        self.assertEqual(stats['home']['handler']['count'], 10)
+        self.assertEqual(stats['home']['total'][50] <=
+            stats['home']['total'][99], True)
+
+    def test_clock_set_back(self):
+        trace = RequestTrace()
+        # A start time in the future, as if the clock was set back.
+        trace.start += 60
+        trace.add('match', trace.start)
+        trace.finish()
+        self.assertEqual(trace.phases, [('match', 0.0)])
+        self.assertEqual(trace.get_server_timing(),
+            'match;dur=0.000, total;dur=0.000')
+
+
+class TestTraceAggregator(BaseTestCase):
+    def get_trace(self, total):
+        trace = RequestTrace()
+        trace.total = total
+        return trace
+
+    def test_percentiles(self):
+        aggregator = TraceAggregator()
+        for i in range(1, 101):
+            aggregator.add('home', self.get_trace(i / 1000.0))
+
+        res = aggregator.get_percentiles('home')
+        self.assertAlmostEqual(res[50], 50.0)
+        self.assertAlmostEqual(res[90], 90.0)
+        self.assertAlmostEqual(res[99], 99.0)
+
+    def test_rolling_window(self):
+        aggregator = TraceAggregator(size=10)
+        for i in range(100):
+            aggregator.add('home', self.get_trace(i / 1000.0))
+
+        self.assertEqual(len(aggregator.samples['home']['total']), 10)
+        self.assertAlmostEqual(aggregator.get_percentiles('home',
+            percentiles=[1])[1], 90.0)
+
+    def test_no_samples(self):
+        aggregator = TraceAggregator()
+        self.assertEqual(aggregator.get_percentiles('home'), None)
+
+        aggregator.add('home', self.get_trace(0.1))
+        aggregator.clear()
+        self.assertEqual(aggregator.get_percentiles('home'), None)
@@ -36,17 +36,101 @@ __version_info__ = tuple(int(n) for n in __version__.split('.'))
 #: enable_debugger
 #:     True to enable the interactive debugger when in debug mode, False
 #:     otherwise. Default is True.
+#:
+#: enable_tracing
+#:     True to record per-phase timings for each request, sent in a
+#:     ``Server-Timing`` response header and collected in
+#:     :attr:`tipfy.Tipfy.trace_aggregator`. Default is False.
+#:
+#: tracing_samples
+#:     Number of timing samples kept per rule and phase to calculate
+#:     percentiles when tracing is enabled. Default is 1000.
+#:
+#: max_content_length
+#:     Maximum size in bytes of a request body. Bigger requests are rejected
+#:     with `413 Request Entity Too Large` before the body is read. Default
+#:     is None (no limit).
+#:
+#: max_form_memory_size
+#:     Maximum size in bytes of form data kept in memory, not counting file
+#:     uploads. Bigger forms are rejected with
+#:     `413 Request Entity Too Large`. Default is None (no limit).
+#:
+#: upload_memory_threshold
+#:     Maximum size in bytes of a file upload kept in memory. Bigger uploads
+#:     are written to a temporary file. Default is 512000.
+#:
+#: upload_dir
+#:     Directory for temporary upload files. Default is None (the system
+#:     default temporary directory).
+#:
+#: negative_cache_size
+#:     Maximum number of paths that failed to match (`404 Not Found` or
+#:     `405 Method Not Allowed`) remembered by the router, so that repeated
+#:     misses don't scan the URL map again. Default is 0 (disabled).
+#:
+#: adapter_cache_size
+#:     Maximum number of bound URL adapter states (server name, script name,
+#:     subdomain and scheme) remembered by the router, so that requests to a
+#:     known host don't parse it again. Set to 0 to disable. Default is 100.
+#:
+#: rule_stats
+#:     True to record match counts and latency per rule. See
+#:     :meth:`tipfy.routing.Router.get_rule_stats`. Default is False.
+#:
+#: rule_reorder_interval
+#:     If set, match statistics are recorded and every this number of
+#:     seconds the URL map is reordered so that the most matched rules are
+#:     tested first. Rules that can match the same paths keep their order.
+#:     Default is None (disabled).
+#:
+#: tenant_cache_size
+#:     Maximum number of tenant URL maps kept by
+#:     :class:`tipfy.routing.TenantRouter`. Maps of the least recently
+#:     requested hosts are discarded and built again when needed.
+#:     Default is 1000.
+#:
+#: length_cache_size
+#:     Maximum number of body lengths of ``GET`` responses remembered per URL
+#:     and validator, used to set ``Content-Length`` in ``HEAD`` responses
+#:     with a deferred body. See :attr:`tipfy.RequestHandler.validator`.
+#:     Set to 0 to disable. Default is 1000.
+#:
+#: request_deadline
+#:     Seconds available to each request. If set, requests get a
+#:     :class:`tipfy.deadline.Deadline` that helpers consult to cap timeouts
+#:     and retries. It can be overridden per rule with the `deadline` option
+#:     of :class:`tipfy.Rule`. Default is None (no deadline).
+#:
+#: warmup_locales
+#:     Locale codes for which translations are loaded by
+#:     :meth:`tipfy.Tipfy.warmup`. Default is an empty list.
 default_config = {
-    'auth_store_class':    'tipfy.appengine.auth.AuthStore',
-    'i18n_store_class':    'tipfy.i18n.I18nStore',
-    'session_store_class': 'tipfy.sessions.SessionStore',
-    'server_name':         None,
-    'default_subdomain':   '',
-    'enable_debugger':     True,
+    'auth_store_class':        'tipfy.appengine.auth.AuthStore',
+    'i18n_store_class':        'tipfy.i18n.I18nStore',
+    'session_store_class':     'tipfy.sessions.SessionStore',
+    'server_name':             None,
+    'default_subdomain':       '',
+    'enable_debugger':         True,
+    'enable_tracing':          False,
+    'tracing_samples':         1000,
+    'max_content_length':      None,
+    'max_form_memory_size':    None,
+    'upload_memory_threshold': 1024 * 500,
+    'upload_dir':              None,
+    'negative_cache_size':     0,
+    'adapter_cache_size':      100,
+    'rule_stats':              False,
+    'rule_reorder_interval':   None,
+    'tenant_cache_size':       1000,
+    'length_cache_size':       1000,
+    'request_deadline':        None,
+    'warmup_locales':          [],
 }
 
 from .app import (HTTPException, Request, RequestHandler, Response, Tipfy,
-    abort, current_app, current_handler, APPENGINE, APPLICATION_ID,
-    CURRENT_VERSION_ID, DEV_APPSERVER)
+    abort, current_app, current_handler, get_current_app, get_current_handler,
+    APPENGINE, APPLICATION_ID, CURRENT_VERSION_ID, DEV_APPSERVER,
+    REQUEST_START_KEY)
 from .config import DEFAULT_VALUE, REQUIRED_VALUE
 from .routing import HandlerPrefix, NamePrefix, Rule, Subdomain, Submount
@@ -10,18 +10,30 @@
 """
 import logging
 import os
+import sys
+import tempfile
+import time
 import urlparse
+from functools import partial
 from wsgiref.handlers import CGIHandler
 
 # Werkzeug Swiss knife.
 # Need to import werkzeug first otherwise py_zipimport fails.
 import werkzeug
-from werkzeug import (Local, Request as BaseRequest, Response as BaseResponse,
+from werkzeug import (Request as BaseRequest, Response as BaseResponse,
     cached_property, import_string, redirect as base_redirect)
 from werkzeug.exceptions import HTTPException, InternalServerError, abort
 
-#: Context-local.
-local = Local()
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from .context import ContextLocal
+
+#: Context-local. Values are set per thread, or per greenlet if greenlets are
+#: available. See :mod:`tipfy.context`.
+local = ContextLocal()
 #: A proxy to the active handler for a request. This is intended to be used by
 #: functions called out of a handler context. Usage is generally discouraged:
 #: it is preferable to pass the handler as argument when possible and only use
@@ -35,15 +47,46 @@ current_handler = local('current_handler')
 #: Same as current_handler, only for the active WSGI app.
 current_app = local('current_app')
 
+
+def get_current_handler():
+    """Returns the active handler for the current request. This is a faster
+    alternative to the :data:`current_handler` proxy for functions that are
+    called very often.
+
+    :returns:
+        A :class:`RequestHandler` instance.
+    """
+    try:
+        return local.current_handler
+    except AttributeError:
+        raise RuntimeError('No handler is active in this context.')
+
+
+def get_current_app():
+    """Returns the active WSGI app. This is a faster alternative to the
+    :data:`current_app` proxy.
+
+    :returns:
+        A :class:`Tipfy` instance.
+    """
+    try:
+        return local.current_app
+    except AttributeError:
+        raise RuntimeError('No app is active in this context.')
+
+
 from . import default_config
 from .config import Config, REQUIRED_VALUE
+from .deadline import Deadline
 from .routing import Router, Rule
+from .tracing import RequestTrace, TraceAggregator, timer
 from .utils import json_decode
 
 __all__ = [
     'HTTPException', 'Request', 'RequestHandler', 'Response', 'Tipfy',
-    'current_handler', 'APPENGINE', 'APPLICATION_ID', 'CURRENT_VERSION_ID',
-    'DEV_APPSERVER',
+    'current_handler', 'get_current_app', 'get_current_handler', 'APPENGINE',
+    'APPLICATION_ID', 'CURRENT_VERSION_ID', 'DEV_APPSERVER',
+    'REQUEST_START_KEY',
 ]
 
 # App Engine flags.
@@ -58,6 +101,10 @@ DEV_APPSERVER = SERVER_SOFTWARE.startswith('Development')
 APPENGINE = (APPLICATION_ID is not None and (DEV_APPSERVER or
     SERVER_SOFTWARE.startswith('Google App Engine')))
 
+#: WSGI environment key for the time, from ``time.time()``, when a request
+#: was received. :meth:`Tipfy.wsgi_app` sets it if the server didn't.
+REQUEST_START_KEY = 'tipfy.request_start'
+
 
 class RequestHandler(object):
     """Base class to handle requests. This is the central piece for an
@@ -82,6 +129,31 @@ class RequestHandler(object):
     #:     Called if an exception occurs while executing the requested method.
     #:     These are executed in reverse order.
     middleware = None
+    #: When this handler is set in :attr:`Tipfy.error_handlers`, True means
+    #: that its error response doesn't depend on the request or exception.
+    #: The first response for a status code is then reused for later errors,
+    #: without instantiating the handler. Responses that set cookies or are
+    #: streamed are never reused.
+    cache_error_response = False
+    #: A cheap validator for conditional GET requests: a method
+    #: ``validator(**kwargs)`` that receives the rule arguments and returns a
+    #: tuple ``(etag, last_modified)``, e.g., a content version and an
+    #: entity's update time. Either value can be None. It is called before
+    #: the handler method for ``GET`` and ``HEAD`` requests; if the request
+    #: ``If-None-Match`` or ``If-Modified-Since`` headers match, a
+    #: ``304 Not Modified`` response is returned without calling the handler
+    #: method. Otherwise the values are set as the response ``ETag`` (weak)
+    #: and ``Last-Modified`` headers. A `validator` option set in the
+    #: :class:`tipfy.Rule` takes precedence.
+    #:
+    #: The body length of ``GET`` responses is also remembered per URL and
+    #: validator, to set ``Content-Length`` in ``HEAD`` responses with a
+    #: deferred body: see :meth:`make_deferred_response`.
+    validator = None
+    #: Output buffered by :meth:`write`.
+    _output = None
+    #: Functions registered by :meth:`add_cleanup`.
+    _cleanups = None
 
     def __init__(self, app, request):
         """Initializes the handler.
@@ -110,6 +182,10 @@ class RequestHandler(object):
             A :attr:`response_class` instance.
         """
         method = getattr(self, _method, None)
+        if method is None and _method == 'head':
+            # HEAD is the same as GET, without a body.
+            method = getattr(self, 'get', None)
+
         if method is None:
             # 405 Method Not Allowed.
             # The response MUST include an Allow header containing a
@@ -117,40 +193,110 @@ class RequestHandler(object):
             # http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.6
             self.abort(405, valid_methods=self.get_valid_methods())
 
-        if not self.middleware:
-            # No middleware are set: just execute the method.
-            return self.make_response(method(*args, **kwargs))
+        if self.request.method in _CONDITIONAL_METHODS and \
+            _method != 'handle_exception':
+            validator = self.get_validator()
+            if validator is not None:
+                method = self._make_conditional(method, validator)
 
-        # Execute before_dispatch middleware.
-        for obj in self.middleware:
-            func = getattr(obj, 'before_dispatch', None)
-            if func:
+        pipeline = self.get_pipeline()
+        if pipeline.middleware is not self.middleware:
+            # Middleware were set for this instance only: don't cache them.
+            pipeline = HandlerPipeline(self.middleware)
+
+        if self.request.trace is not None:
+            pipeline = pipeline.traced
+            method = self.request.trace.wrap('handler', method)
+
+        try:
+            if not pipeline.has_hooks:
+                # No middleware hooks are set: just execute the method.
+                return self.make_response(method(*args, **kwargs))
+
+            # Execute before_dispatch middleware.
+            for func in pipeline.before_dispatch:
                 response = func(self)
                 if response is not None:
                     break
-        else:
-            try:
-                response = self.make_response(method(*args, **kwargs))
-            except Exception, e:
-                # Execute handle_exception middleware.
-                for obj in reversed(self.middleware):
-                    func = getattr(obj, 'handle_exception', None)
-                    if func:
+            else:
+                try:
+                    response = self.make_response(method(*args, **kwargs))
+                except Exception, e:
+                    # Execute handle_exception middleware.
+                    for func in pipeline.handle_exception:
                         response = func(self, e)
                         if response is not None:
                             break
-                else:
-                    # If a middleware didn't return a response, reraise.
-                    raise
+                    else:
+                        # If a middleware didn't return a response, reraise.
+                        raise
 
-        # Execute after_dispatch middleware.
-        for obj in reversed(self.middleware):
-            func = getattr(obj, 'after_dispatch', None)
-            if func:
+            # Execute after_dispatch middleware.
+            for func in pipeline.after_dispatch:
                 response = func(self, response)
 
-        # Done!
-        return response
+            # Done!
+            return response
+        finally:
+            if self._cleanups is not None:
+                self._run_cleanups()
+
+    def add_cleanup(self, func, *args):
+        """Registers a function to be called when the handler method and
+        the middleware hooks are done, even if one of them raised an
+        exception or returned a response early. Middleware use it to free
+        resources taken in ``before_dispatch``, as their ``after_dispatch``
+        and ``handle_exception`` hooks are not always called.
+
+        :param func:
+            A callable.
+        :param args:
+            Positional arguments passed to `func`.
+        """
+        if self._cleanups is None:
+            self._cleanups = []
+
+        self._cleanups.append((func, args))
+
+    def _run_cleanups(self):
+        """Calls the functions registered by :meth:`add_cleanup`, logging
+        their exceptions so that they don't replace the response or the
+        original exception.
+        """
+        cleanups, self._cleanups = self._cleanups, None
+        for func, args in cleanups:
+            try:
+                func(*args)
+            except Exception, e:
+                logging.exception(e)
+
+    @classmethod
+    def get_pipeline(cls):
+        """Returns the compiled :class:`HandlerPipeline` for this handler
+        class. It is built on first use and cached in the class; it is rebuilt
+        automatically if :attr:`middleware` is replaced by another list.
+
+        :returns:
+            A :class:`HandlerPipeline` instance.
+        """
+        pipeline = cls.__dict__.get('_pipeline')
+        if pipeline is None or pipeline.middleware is not cls.middleware:
+            pipeline = cls._pipeline = HandlerPipeline(cls.middleware)
+
+        return pipeline
+
+    @classmethod
+    def reset_pipeline(cls):
+        """Discards the compiled :class:`HandlerPipeline` for this handler
+        class and its subclasses. Call this after changing the
+        :attr:`middleware` list in place or the hooks of a middleware
+        instance at runtime.
+        """
+        if '_pipeline' in cls.__dict__:
+            del cls._pipeline
+
+        for subclass in cls.__subclasses__():
+            subclass.reset_pipeline()
 
     @cached_property
     def auth(self):
@@ -160,6 +306,11 @@ class RequestHandler(object):
         :returns:
             An auth store instance.
         """
+        parent = self.request.parent
+        if parent is not None:
+            # A sub-request shares the auth state of its batch request.
+            return parent.auth
+
         return self.app.auth_store_class(self)
 
     @cached_property
@@ -188,6 +339,11 @@ class RequestHandler(object):
         :returns:
             A session store instance.
         """
+        parent = self.request.parent
+        if parent is not None:
+            # A sub-request shares the sessions of its batch request.
+            return parent.session_store
+
         return self.app.session_store_class(self)
 
     def abort(self, code, *args, **kwargs):
@@ -218,8 +374,114 @@ class RequestHandler(object):
         :returns:
             A list of methods supported by this handler.
         """
-        return [method for method in self.app.allowed_methods if
-            getattr(self, method.lower().replace('-', '_'), None)]
+        allowed_methods = self.app.allowed_methods
+        pipeline = self.get_pipeline()
+        methods = pipeline.valid_methods.get(allowed_methods)
+        if methods is None:
+            methods = pipeline.valid_methods[allowed_methods] = [method for
+                method in allowed_methods if
+                getattr(self, method.lower().replace('-', '_'), None) or
+                (method == 'HEAD' and getattr(self, 'get', None))]
+
+        return list(methods)
+
+    def get_validator(self):
+        """Returns the validator for conditional requests: the `validator`
+        option of the matched :class:`tipfy.Rule`, called with this handler
+        as first argument, or :attr:`validator`.
+
+        :returns:
+            A callable that receives the rule arguments and returns a tuple
+            ``(etag, last_modified)``, or None.
+        """
+        rule = self.request.rule
+        validator = getattr(rule, 'validator', None)
+        if validator is None:
+            return self.validator
+
+        if isinstance(validator, basestring):
+            validator = rule.validator = import_string(validator)
+
+        return partial(validator, self)
+
+    def _make_conditional(self, method, validator):
+        """Wraps a handler method to return ``304 Not Modified`` when the
+        validator matches the request conditional headers, and to set
+        validator headers in the response otherwise.
+        """
+        def conditional(*args, **kwargs):
+            etag, last_modified = validator(*args, **kwargs) or (None, None)
+            if etag is None and last_modified is None:
+                return method(*args, **kwargs)
+
+            if last_modified is not None:
+                if last_modified.tzinfo is not None:
+                    # Request dates are parsed as naive UTC datetimes.
+                    last_modified = (last_modified -
+                        last_modified.utcoffset()).replace(tzinfo=None)
+
+                # HTTP dates don't have fractions of seconds.
+                last_modified = last_modified.replace(microsecond=0)
+
+            request = self.request
+            if 'HTTP_IF_NONE_MATCH' in request.environ:
+                not_modified = etag is not None and \
+                    request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = since is not None and \
+                    last_modified is not None and last_modified <= since
+
+            if not_modified:
+                response = self.app.response_class(status=304)
+            else:
+                response = self.make_response(method(*args, **kwargs))
+                if response.status_code == 200:
+                    self._cache_length(response, (etag, last_modified))
+
+            if etag is not None:
+                response.set_etag(etag, weak=True)
+
+            if last_modified is not None:
+                response.last_modified = last_modified
+
+            return response
+
+        return conditional
+
+    def _cache_length(self, response, validator):
+        """Remembers the body length of a ``GET`` response for the current
+        URL and validator, or sets it as ``Content-Length`` in a ``HEAD``
+        response with a deferred body.
+        """
+        lengths = self.app.lengths
+        key = (self.request.url, validator)
+        if self.request.method == 'HEAD':
+            if response.is_streamed and \
+                'Content-Length' not in response.headers:
+                length = lengths.get(key)
+                if length is not None:
+                    response.headers['Content-Length'] = str(length)
+
+            return
+
+        size = self.app.config['tipfy']['length_cache_size']
+        if not size or not response.is_sequence:
+            return
+
+        try:
+            length = sum(len(str(chunk)) for chunk in response.response)
+        except UnicodeError:
+            return
+
+        while len(lengths) >= size and key not in lengths:
+            try:
+                lengths.popitem()
+            except KeyError:
+                # Emptied by another thread.
+                break
+
+        lengths[key] = length
 
     def handle_exception(self, exception=None):
         """Handles an exception. The default behavior is to reraise the
@@ -234,9 +496,177 @@ class RequestHandler(object):
         """Converts the returned value from a :class:`RequestHandler` to a
         response object that is an instance of :attr:`Tipfy.response_class`.
 
+        If the handler method didn't return a value but wrote output using
+        :meth:`write`, the written output is used as response body. If it
+        returned an iterator or generator, the body is streamed.
+
         .. seealso:: :meth:`Tipfy.make_response`.
         """
-        return self.app.make_response(self.request, *rv)
+        if self._output is not None and rv in ((), (None,)):
+            rv = (self.flush(),)
+        elif len(rv) == 1 and _is_iterator(rv[0]):
+            rv = (self._prime(rv[0]),)
+
+        trace = self.request.trace
+        if trace is None:
+            return self.app.make_response(self.request, *rv)
+
+        start = timer()
+        try:
+            return self.app.make_response(self.request, *rv)
+        finally:
+            trace.add('make_response', start)
+
+    def make_deferred_response(self, _render, *args, **kwargs):
+        """Returns a response with a body generated by
+        ``_render(*args, **kwargs)``, e.g., a template render function::
+
+            class MyHandler(RequestHandler):
+                def get(self, **kwargs):
+                    template = loader.load('page.html')
+                    return self.make_deferred_response(template.generate,
+                        title='Hello')
+
+        For ``HEAD`` requests the body is deferred: it is only generated if
+        something reads it, so the template is normally not rendered. Status
+        and headers are still set by the handler and middleware. If a
+        :attr:`validator` is used, ``Content-Length`` is set from a previous
+        ``GET`` response with the same validator.
+
+        :param _render:
+            A function that returns the response body.
+        :param args:
+            Positional arguments passed to `_render`.
+        :param kwargs:
+            Keyword arguments passed to `_render`.
+        :returns:
+            A :attr:`Tipfy.response_class` instance.
+        """
+        if self.request.method == 'HEAD':
+            body = DeferredBody(_render, *args, **kwargs)
+        else:
+            body = _render(*args, **kwargs)
+
+        return self.app.response_class(body)
+
+    def write(self, data):
+        """Buffers output to be sent in the response body. If the handler
+        method doesn't return a value, the written output is used as body::
+
+            class MyHandler(RequestHandler):
+                def get(self, **kwargs):
+                    self.write('Hello, ')
+                    self.write('World!')
+
+        To send output incrementally, make the method a generator. The
+        response is streamed: each yielded value is sent as a chunk, preceded
+        by any pending written output, and yielding ``None`` sends the output
+        written so far::
+
+            class MyHandler(RequestHandler):
+                def get(self, **kwargs):
+                    self.write('<ul>')
+                    for item in get_items():
+                        self.write('<li>%s</li>' % item)
+                        yield
+
+                    self.write('</ul>')
+
+        Code before the first ``yield`` runs before middleware
+        ``after_dispatch`` hooks, so headers, cookies and sessions can be set
+        there, and exceptions raised there are handled as usual. The rest of
+        the method runs after all middleware, while the body is sent.
+
+        :param data:
+            A string to be written.
+        """
+        if self._output is None:
+            self._output = []
+
+        self._output.append(data)
+
+    def flush(self):
+        """Returns the output buffered by :meth:`write` and clears the
+        buffer. In generator methods, ``yield self.flush()`` is the same as
+        a bare ``yield``.
+
+        :returns:
+            The buffered output.
+        """
+        output, self._output = self._output, None
+        if not output:
+            return ''
+
+        return ''.join(output)
+
+    def _prime(self, iterator):
+        """Generates the first chunk from an iterator returned by a handler
+        method, so that code before the first ``yield`` runs inside the
+        middleware and exception handling chain.
+
+        :param iterator:
+            The iterator returned by the handler method.
+        :returns:
+            The response body: the buffered output if the iterator is
+            exhausted, or a stream of chunks otherwise.
+        """
+        try:
+            chunk = iterator.next()
+        except StopIteration:
+            return self.flush()
+        except:
+            exc_info = sys.exc_info()
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        output = self.flush()
+        if chunk:
+            output += chunk
+
+        return self._stream(iterator, output)
+
+    def _stream(self, iterator, first=''):
+        """Yields chunks from an iterator returned by a handler method, with
+        output from :meth:`write` prepended. :data:`current_app` and
+        :data:`current_handler` are set while each chunk is generated.
+
+        :param iterator:
+            The iterator returned by the handler method.
+        :param first:
+            Output already generated by :meth:`_prime`, sent first.
+        """
+        try:
+            if first:
+                yield first
+
+            while True:
+                context = _get_context()
+                local.current_app = self.app
+                local.current_handler = self
+                try:
+                    chunk = iterator.next()
+                except StopIteration:
+                    break
+                finally:
+                    _set_context(context)
+
+                output = self.flush()
+                if chunk:
+                    output += chunk
+
+                if output:
+                    yield output
+
+            output = self.flush()
+            if output:
+                yield output
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
 
     def redirect(self, location, code=302, empty=False):
         """Returns a response object with headers set for redirection to the
@@ -294,6 +724,152 @@ class RequestHandler(object):
         """
         return self.app.router.build(self.request, _name, kwargs)
 
+    def url_for_many(self, _name, _values, **kwargs):
+        """Returns URLs for a named :class:`Rule`, one for each dictionary
+        in `_values`. Keyword arguments are shared by all URLs::
+
+            urls = self.url_for_many('list', [{'page': i} for i in
+                range(1, 11)], sort='date')
+
+        .. seealso:: :meth:`Router.build_many`.
+        """
+        return self.app.router.build_many(self.request, _name, _values,
+            kwargs)
+
+
+class HandlerPipeline(object):
+    """Middleware hooks and valid methods resolved once for a
+    :class:`RequestHandler` class, so that dispatching a request doesn't need
+    to look them up in every middleware object.
+
+    The pipeline is cached in the handler class by
+    :meth:`RequestHandler.get_pipeline`. If middleware are changed in place at
+    runtime, call :meth:`RequestHandler.reset_pipeline` to rebuild it.
+    """
+    def __init__(self, middleware=None):
+        """Initializes the pipeline.
+
+        :param middleware:
+            A list of middleware instances, as defined in
+            :attr:`RequestHandler.middleware`.
+        """
+        #: The middleware list this pipeline was built from.
+        self.middleware = middleware
+        #: ``before_dispatch`` hooks, in execution order.
+        self.before_dispatch = self._get_hooks('before_dispatch')
+        #: ``handle_exception`` hooks, in execution order (reversed).
+        self.handle_exception = self._get_hooks('handle_exception', True)
+        #: ``after_dispatch`` hooks, in execution order (reversed).
+        self.after_dispatch = self._get_hooks('after_dispatch', True)
+        #: True if any middleware hook is set.
+        self.has_hooks = bool(self.before_dispatch or self.handle_exception or
+            self.after_dispatch)
+        #: Valid methods, keyed by the app's allowed methods.
+        self.valid_methods = {}
+
+    @cached_property
+    def traced(self):
+        """A copy of this pipeline with hooks that record their timings in
+        the request trace. Used when tracing is enabled.
+        """
+        pipeline = HandlerPipeline.__new__(HandlerPipeline)
+        pipeline.__dict__.update(self.__dict__)
+        for name in ('before_dispatch', 'handle_exception', 'after_dispatch'):
+            setattr(pipeline, name, [_trace_hook(name, func) for func in
+                getattr(self, name)])
+
+        return pipeline
+
+    def _get_hooks(self, name, reverse=False):
+        middleware = self.middleware or []
+        if reverse:
+            middleware = reversed(middleware)
+
+        hooks = []
+        for obj in middleware:
+            func = getattr(obj, name, None)
+            if func:
+                hooks.append(func)
+
+        return hooks
+
+
+def _is_iterator(value):
+    """Returns True if a value is an iterator, e.g., a generator."""
+    return hasattr(value, 'next') and hasattr(value, '__iter__')
+
+
+def _get_context():
+    """Returns the context-local app and handler."""
+    return (getattr(local, 'current_app', None),
+        getattr(local, 'current_handler', None))
+
+
+def _set_context(context):
+    """Restores the context-local app and handler."""
+    if context == (None, None):
+        # Release the storage too: greenlet storage would keep the greenlet
+        # alive after the response is sent.
+        local.__release_local__()
+        return
+
+    for name, value in zip(('current_app', 'current_handler'), context):
+        if value is not None:
+            setattr(local, name, value)
+        else:
+            try:
+                delattr(local, name)
+            except AttributeError:
+                pass
+
+
+def _trace_hook(name, func):
+    """Wraps a middleware hook to record its timing in the request trace."""
+    obj = getattr(func, 'im_self', None)
+    if obj is None:
+        label = getattr(func, '__name__', 'hook')
+    else:
+        label = obj.__class__.__name__
+
+    phase = '%s.%s' % (name, label)
+
+    def traced(handler, *args):
+        start = timer()
+        try:
+            return func(handler, *args)
+        finally:
+            handler.request.trace.add(phase, start)
+
+    return traced
+
+
+class DeferredBody(object):
+    """A response body that is only generated when it is iterated. It has
+    no length, so Werkzeug treats it as a streamed body and doesn't generate
+    it to calculate ``Content-Length``.
+    """
+    def __init__(self, func, *args, **kwargs):
+        """Initializes the body.
+
+        :param func:
+            A function that returns the body, as a string or an iterable of
+            strings.
+        :param args:
+            Positional arguments passed to `func`.
+        :param kwargs:
+            Keyword arguments passed to `func`.
+        """
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __iter__(self):
+        body = self.func(*self.args, **self.kwargs)
+        if isinstance(body, basestring):
+            return iter([body])
+
+        return iter(body)
+
 
 class Request(BaseRequest):
     """Provides all environment variables for the current request: GET, POST,
@@ -305,6 +881,47 @@ class Request(BaseRequest):
     rule = None
     #: Keyword arguments from the matched rule.
     rule_args = None
+    #: A :class:`tipfy.tracing.RequestTrace` if tracing is enabled.
+    trace = None
+    #: A :class:`tipfy.deadline.Deadline` if the request has a time budget.
+    deadline = None
+    #: For sub-requests executed by :class:`tipfy.batch.BatchHandler`, the
+    #: batch handler. Its auth and session stores are shared.
+    parent = None
+    #: Maximum size in bytes of a file upload kept in memory. Bigger uploads
+    #: are spooled to a temporary file.
+    upload_memory_threshold = 1024 * 500
+    #: Directory for temporary upload files. If None, the system default is
+    #: used.
+    upload_dir = None
+
+    def _get_file_stream(self, total_content_length, content_type,
+        filename=None, content_length=None):
+        """Returns a stream to store a file upload. Uploads are kept in memory
+        until they reach :attr:`upload_memory_threshold`, then are written to
+        a temporary file in :attr:`upload_dir`.
+
+        :param total_content_length:
+            The length of the whole request body.
+        :param content_type:
+            The mimetype of the uploaded file.
+        :param filename:
+            The filename of the uploaded file.
+        :param content_length:
+            The length of the uploaded file, if known.
+        :returns:
+            A readable and writable file-like object.
+        """
+        threshold = self.upload_memory_threshold
+        if _SpooledTemporaryFile is not None:
+            return _SpooledTemporaryFile(max_size=threshold, mode='wb+',
+                dir=self.upload_dir)
+
+        # Python 2.5: the upload size is not known in advance.
+        if (content_length or total_content_length) > threshold:
+            return tempfile.TemporaryFile('wb+', dir=self.upload_dir)
+
+        return StringIO()
 
     @cached_property
     def json(self):
@@ -325,6 +942,11 @@ class Response(BaseResponse):
     default_mimetype = 'text/html'
 
 
+_SpooledTemporaryFile = getattr(tempfile, 'SpooledTemporaryFile', None)
+# Request methods for which validators are evaluated.
+_CONDITIONAL_METHODS = frozenset(['GET', 'HEAD'])
+
+
 class Tipfy(object):
     """The WSGI application."""
     # Allowed request methods.
@@ -338,6 +960,14 @@ class Tipfy(object):
     config_class = Config
     #: Default class for the configuration object.
     router_class = Router
+    #: Template engines created by :meth:`warmup`: tuples
+    #: ``(handler_attribute, registry_name)``. If a handler has the attribute,
+    #: its value is a template engine class with a ``factory()`` class
+    #: method, as in :class:`tipfyext.jinja2.Jinja2Mixin`.
+    warmup_template_engines = (
+        ('jinja2_class', 'jinja2'),
+        ('mako_class',   'mako'),
+    )
 
     def __init__(self, rules=None, config=None, debug=False):
         """Initializes the application.
@@ -353,8 +983,15 @@ class Tipfy(object):
         self.debug = debug
         self.registry = {}
         self.error_handlers = {}
+        # Error dispatch entries per status code: see handle_exception().
+        self.error_entries = {}
+        # GET body lengths per URL and validator: see RequestHandler.validator.
+        self.lengths = {}
         self.config = self.config_class(config, {'tipfy': default_config})
         self.router = self.router_class(self, rules)
+        self.tracing = self.config['tipfy']['enable_tracing']
+        self.request_deadline = self.config['tipfy']['request_deadline']
+        self.request_options = self.get_request_options()
 
         if debug:
             logging.getLogger().setLevel(logging.DEBUG)
@@ -389,13 +1026,44 @@ class Tipfy(object):
             A callable accepting a status code, a list of headers and an
             optional exception context to start the response.
         """
+        # The time the request entered the app, unless the server set it.
+        environ.setdefault(REQUEST_START_KEY, time.time())
         cleanup = True
+        trace = None
+        if self.tracing:
+            trace = RequestTrace()
+
         try:
             request = self.request_class(environ)
+            request.__dict__.update(self.request_options)
+            if self.request_deadline is not None:
+                request.deadline = Deadline(self.request_deadline)
+            if trace is not None:
+                request.trace = trace
+                trace.add('request', trace.start)
+
             if request.method not in self.allowed_methods:
                 abort(501)
 
-            match = self.router.match(request)
+            max_length = request.max_content_length
+            if max_length is not None and \
+                (request.content_length or 0) > max_length:
+                # Reject big bodies before anything is read.
+                abort(413)
+
+            if trace is None:
+                match = self.router.match(request)
+            else:
+                start = timer()
+                match = self.router.match(request)
+                trace.add('match', start)
+
+            deadline = getattr(match[0], 'deadline', None)
+            if deadline is not None:
+                # The rule overrides the default budget.
+                start = request.deadline and request.deadline.start
+                request.deadline = Deadline(deadline, start)
+
             response = self.router.dispatch(request, match)
         except Exception, e:
             try:
@@ -415,8 +1083,42 @@ class Tipfy(object):
             if cleanup:
                 local.__release_local__()
 
+        if trace is not None:
+            self.finish_trace(request, response, trace)
+
         return response(environ, start_response)
 
+    def finish_trace(self, request, response, trace):
+        """Sets the ``Server-Timing`` header for a traced request and adds its
+        timings to :attr:`trace_aggregator`.
+
+        :param request:
+            A :attr:`request_class` instance.
+        :param response:
+            A :attr:`response_class` instance.
+        :param trace:
+            A :class:`tipfy.tracing.RequestTrace` instance.
+        """
+        trace.finish()
+        response.headers['Server-Timing'] = trace.get_server_timing()
+        rule = request.rule
+        self.trace_aggregator.add(rule and rule.name, trace)
+
+    def get_request_options(self):
+        """Returns the request body limits configured for the app, to be set
+        in every :attr:`request_class` instance.
+
+        :returns:
+            A dictionary of request attributes.
+        """
+        config = self.config['tipfy']
+        return {
+            'max_content_length':      config['max_content_length'],
+            'max_form_memory_size':    config['max_form_memory_size'],
+            'upload_memory_threshold': config['upload_memory_threshold'],
+            'upload_dir':              config['upload_dir'],
+        }
+
     def handle_exception(self, request, exception):
         """Handles an exception. To set app-wide error handlers, define them
         using the corresponent HTTP status code in the ``error_handlers``
@@ -448,6 +1150,10 @@ class Tipfy(object):
            status code and logging the exception, as shown in the example
            above.
 
+        If the error handler sets :attr:`RequestHandler.cache_error_response`,
+        its first response is reused for later errors with the same status
+        code, without instantiating the handler.
+
         :param request:
             A :attr:`request_class` instance.
         :param exception:
@@ -459,14 +1165,129 @@ class Tipfy(object):
             code = 500
 
         handler = self.error_handlers.get(code)
-        if handler:
-            rule = Rule('/', handler=handler, name='__exception__')
-            kwargs = dict(exception=exception)
-            return self.router.dispatch(request, (rule, kwargs),
-                method='handle_exception')
-        else:
+        if not handler:
             raise
 
+        entry = self._get_error_entry(code, handler)
+        cached = entry[2]
+        if cached is not None:
+            return self.response_class(cached[2], status=cached[0],
+                headers=cached[1])
+
+        rule = entry[1]
+        response = self.router.dispatch(request, (rule,
+            {'exception': exception}), method='handle_exception')
+
+        if getattr(rule.handler, 'cache_error_response', False) and \
+            isinstance(response, self.response_class) and \
+            not response.is_streamed and 'Set-Cookie' not in response.headers:
+            entry[2] = (response.status, response.headers.to_list(),
+                response.data)
+
+        return response
+
+    def _get_error_entry(self, code, handler):
+        """Returns a list ``[handler, rule, cached_response]`` to dispatch
+        errors with the given status code. The dispatch rule is built once
+        per status code and handler.
+        """
+        entry = self.error_entries.get(code)
+        if entry is None or entry[0] is not handler:
+            entry = [handler, Rule('/', handler=handler, name='__exception__'),
+                None]
+            self.error_entries[code] = entry
+
+        return entry
+
+    def warmup(self, locales=None):
+        """Does up front the work that is otherwise done lazily by the first
+        requests, so that they are not slower than the others. This is
+        intended to be called when a new instance starts, e.g., by a
+        :class:`tipfy.appengine.warmup.WarmupHandler` mapped to
+        ``/_ah/warmup`` or by :func:`tipfy.serving.run_server`::
+
+            app.run(mode='threaded', warmup=Tipfy.warmup)
+
+        These steps are performed:
+
+        handlers
+            Imports all rule and error handlers defined as strings, including
+            ``Handler:method`` definitions.
+        url_map
+            Compiles and sorts the URL map.
+        config
+            Loads the default configuration of all configured modules and of
+            all imported ``tipfy`` and ``tipfyext`` modules.
+        templates
+            Creates the template environments used by the handlers: see
+            :attr:`warmup_template_engines`.
+        translations
+            Loads translations for the given locales.
+
+        :param locales:
+            A list of locale codes to load translations for. If not set, uses
+            the ``warmup_locales`` config key for ``tipfy``.
+        :returns:
+            A list of tuples ``(step, seconds)``.
+        """
+        local.current_app = self
+        if locales is None:
+            locales = self.config['tipfy']['warmup_locales']
+
+        steps = [
+            ('handlers',     self._warmup_handlers),
+            ('url_map',      self.router.update),
+            ('config',       self._warmup_config),
+            ('templates',    self._warmup_templates),
+            ('translations', lambda: self._warmup_translations(locales)),
+        ]
+
+        timings = []
+        for name, func in steps:
+            start = timer()
+            func()
+            timings.append((name, timer() - start))
+            logging.debug('Warm-up step %s took %.3f ms.', name,
+                timings[-1][1] * 1000)
+
+        return timings
+
+    def _warmup_handlers(self):
+        # Redirect and build only rules are never dispatched.
+        rules = [rule for rule in self.router.map.iter_rules() if
+            rule.redirect_to is None and not rule.build_only]
+        for code, handler in self.error_handlers.items():
+            rules.append(self._get_error_entry(code, handler)[1])
+
+        for rule in rules:
+            self.router.resolve_handler(rule)
+
+    def _warmup_config(self):
+        modules = set(self.config.keys())
+        for name, module in sys.modules.items():
+            if name.startswith(('tipfy.', 'tipfyext.')) and \
+                getattr(module, 'default_config', None) is not None:
+                modules.add(name)
+
+        for module in modules:
+            self.config[module]
+
+    def _warmup_templates(self):
+        classes = set(getattr(rule, 'handler', None) for rule in
+            self.router.map.iter_rules())
+        classes.update(entry[1].handler for entry in
+            self.error_entries.values())
+
+        for cls in classes:
+            for attr, name in self.warmup_template_engines:
+                engine_class = getattr(cls, attr, None)
+                if engine_class is not None and name not in self.registry:
+                    engine_class.factory(self, name)
+
+    def _warmup_translations(self, locales):
+        if locales:
+            self.i18n_store_class.load_locales(self, locales)
+
     def make_response(self, request, *rv):
         """Converts the returned value from a :class:`RequestHandler` to a
         response object that is an instance of :attr:`response_class`.
@@ -482,6 +1303,10 @@ class Tipfy(object):
               - :class:`str`: a response is created with the string as body.
               - :class:`unicode`: a response is created with the string
                 encoded to utf-8 as body.
+              - an iterator, e.g., a generator: a response is created with
+                the iterator as body. It is not buffered: chunks are sent as
+                they are generated. Other iterables, like lists or dicts,
+                are not accepted.
               - a WSGI function: the function is called as WSGI application
                 and buffered as response object.
               - None: a ValueError exception is raised.
@@ -507,6 +1332,10 @@ class Tipfy(object):
             if rv is None:
                 raise ValueError('RequestHandler did not return a response.')
 
+            if _is_iterator(rv):
+                # Stream iterators instead of buffering them.
+                return self.response_class(rv)
+
             return self.response_class.force_type(rv, request.environ)
 
         return self.response_class(*rv)
@@ -538,7 +1367,7 @@ class Tipfy(object):
         from .testing import CurrentHandlerContext
         return CurrentHandlerContext(self, *args, **kwargs)
 
-    def run(self):
+    def run(self, mode='cgi', **kwargs):
         """Runs the app using ``CGIHandler``. This must be called inside a
         ``main()`` function in the file defined in *app.yaml* to run the
         application::
@@ -555,8 +1384,24 @@ class Tipfy(object):
             if __name__ == '__main__':
                 main()
 
+        Outside of App Engine, the app can be served by a long-lived
+        multi-threaded server instead, keeping the app and its caches loaded
+        between requests. The server requires Python 2.6 or later::
+
+            app.run(mode='threaded', host='0.0.0.0', port=8080, workers=20)
+
+        :param mode:
+            `cgi` (the default) to run a single request using ``CGIHandler``,
+            or `threaded` or `prefork` to start a server.
+        :param kwargs:
+            Keyword arguments for the server.
+            See :func:`tipfy.serving.run_server`.
         """
-        CGIHandler().run(self)
+        if mode == 'cgi':
+            CGIHandler().run(self)
+        else:
+            from .serving import run_server
+            run_server(self, mode=mode, **kwargs)
 
     @cached_property
     def _debugged_wsgi_app(self):
@@ -564,6 +1409,15 @@ class Tipfy(object):
         from .debugger import DebuggedApplication
         return DebuggedApplication(self.wsgi_app, evalex=True)
 
+    @cached_property
+    def trace_aggregator(self):
+        """Rolling timings of traced requests, per rule name.
+
+        :returns:
+            A :class:`tipfy.tracing.TraceAggregator` instance.
+        """
+        return TraceAggregator(self.config['tipfy']['tracing_samples'])
+
     @cached_property
     def auth_store_class(self):
         """Returns the configured auth store class.
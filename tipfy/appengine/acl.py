@@ -67,7 +67,8 @@ from werkzeug import cached_property
 from tipfy import current_handler, CURRENT_VERSION_ID
 from tipfy.appengine.db import PickleProperty
 
-#: Cache for loaded rules.
+#: Cache for loaded rules. It is shared by concurrent requests, so it is only
+#: accessed using single dictionary operations.
 _rules_map = {}
 
 
@@ -188,9 +189,8 @@ class AclRules(db.Model):
         """
         res = None
         cache_key = cls.get_key_name(area, user)
-        if cache_key in _rules_map:
-            res = _rules_map[cache_key]
-        else:
+        res = _rules_map.get(cache_key)
+        if res is None:
             res = memcache.get(cache_key, namespace=cls.__name__)
 
         if res is not None:
@@ -238,9 +238,7 @@ class AclRules(db.Model):
         :param cache_key:
             The Cache key.
         """
-        if cache_key in _rules_map:
-            del _rules_map[cache_key]
-
+        _rules_map.pop(cache_key, None)
         memcache.delete(cache_key, namespace=cls.__name__)
 
     def put(self):
@@ -9,6 +9,7 @@
     :license: BSD, see LICENSE.txt for more details.
 """
 import logging
+import random
 import time
 
 from google.appengine.api import datastore_errors
@@ -17,6 +18,8 @@ from google.appengine.ext import db
 
 from werkzeug import abort
 
+from tipfy.deadline import get_deadline, get_timeout
+
 
 def get_protobuf_from_entity(entities):
     """Converts one or more ``db.Model`` instances to encoded Protocol Buffers.
@@ -380,6 +383,12 @@ def retry_on_timeout(retries=3, interval=1.0, exponent=2.0):
                 # Save the entity. This will be retried in case of timeouts.
                 entity.put()
 
+    Each wait is jittered, between half and the whole interval, so that
+    requests that failed together don't retry at the same time. If the
+    request has a deadline (see :mod:`tipfy.deadline`), retrying stops and
+    the exception is reraised when the wait would take the rest of the time
+    left.
+
     This function derives from `Kay <http://code.google.com/p/kay-framework/>`_.
 
     :param retries:
@@ -404,18 +413,47 @@ def retry_on_timeout(retries=3, interval=1.0, exponent=2.0):
                     logging.debug(e)
                     if count >= retries:
                         raise e
-                    else:
-                        sleep_time = (exponent ** count) * interval
-                        logging.warning("Retrying function %r in %d secs" %
-                            (func, sleep_time))
-                        time.sleep(sleep_time)
-                        count += 1
+
+                    sleep_time = (exponent ** count) * interval
+                    sleep_time -= random.uniform(0, sleep_time / 2)
+                    deadline = get_deadline()
+                    if deadline is not None and \
+                        deadline.remaining() <= sleep_time:
+                        logging.warning("Not retrying function %r: the "
+                            "request deadline is too close" % func)
+                        raise e
+
+                    logging.warning("Retrying function %r in %.2f secs" %
+                        (func, sleep_time))
+                    time.sleep(sleep_time)
+                    count += 1
 
         return decorated
 
     return decorator
 
 
+def create_rpc(deadline=5, **kwargs):
+    """Creates a datastore RPC object with a deadline capped by the time
+    left in the current request. Example::
+
+        from tipfy.appengine.db import create_rpc
+
+        entities = db.get(keys, rpc=create_rpc())
+
+    :param deadline:
+        Deadline in seconds to use if the request has enough time left.
+    :param kwargs:
+        Other keyword arguments for ``db.create_rpc()``.
+    :returns:
+        A datastore RPC object.
+    :raises:
+        :class:`tipfy.deadline.DeadlineExceeded` if the request has no time
+        left.
+    """
+    return db.create_rpc(deadline=get_timeout(deadline), **kwargs)
+
+
 def load_entity(model, kwarg_old, kwarg_new=None, fetch_mode=None):
     """A decorator that takes an entity key, key name or id from the request
     handler keyword arguments, load an entity and add it to the arguments.
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.appengine.warmup
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Handler for App Engine warm-up requests. To use it, enable the warmup
+    inbound service in *app.yaml*::
+
+        inbound_services:
+        - warmup
+
+    And map the handler to ``/_ah/warmup``::
+
+        Rule('/_ah/warmup', name='warmup',
+            handler='tipfy.appengine.warmup.WarmupHandler')
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import logging
+
+from tipfy import RequestHandler, Response
+
+
+class WarmupHandler(RequestHandler):
+    """Calls :meth:`tipfy.Tipfy.warmup` and responds with the time taken by
+    each warm-up step, in milliseconds.
+    """
+    def get(self, **kwargs):
+        timings = self.app.warmup()
+        total = sum(seconds for step, seconds in timings)
+        lines = ['%s: %.3f ms' % (step, seconds * 1000) for step, seconds in
+            timings]
+        lines.append('total: %.3f ms' % (total * 1000))
+
+        logging.info('Warm-up finished in %.3f ms.', total * 1000)
+        return Response('\n'.join(lines), mimetype='text/plain')
@@ -60,10 +60,12 @@ class BaseAuthStore(object):
         """
         registry = self.app.registry
         key = 'auth.user_model'
-        if key not in registry:
-            registry[key] = import_string(self.config['user_model'])
+        model = registry.get(key)
+        if model is None:
+            model = registry.setdefault(key,
+                import_string(self.config['user_model']))
 
-        return registry[key]
+        return model
 
     @cached_property
     def _session_base(self):
@@ -22,6 +22,7 @@ import urllib
 from google.appengine.api import urlfetch
 
 from tipfy import REQUIRED_VALUE
+from tipfy.deadline import get_timeout
 from tipfy.utils import json_decode, json_encode
 
 #: Default configuration values for this module. Keys are:
@@ -190,7 +191,7 @@ class FacebookMixin(object):
             urllib.urlencode(kwargs)
 
         try:
-            response = urlfetch.fetch(url, deadline=10)
+            response = urlfetch.fetch(url, deadline=get_timeout(10))
         except urlfetch.DownloadError, e:
             logging.exception(e)
             response = None
@@ -18,6 +18,7 @@ import urllib
 from google.appengine.api import urlfetch
 
 from tipfy import REQUIRED_VALUE
+from tipfy.deadline import get_timeout
 from .oauth import OAuthMixin
 from .openid import OpenIdMixin
 
@@ -112,7 +113,7 @@ class GoogleMixin(OpenIdMixin, OAuthMixin):
             try:
                 token = dict(key=token, secret='')
                 url = self._oauth_access_token_url(token)
-                response = urlfetch.fetch(url, deadline=10)
+                response = urlfetch.fetch(url, deadline=get_timeout(10))
             except urlfetch.DownloadError, e:
                 logging.exception(e)
                 response = None
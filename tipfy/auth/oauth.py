@@ -25,6 +25,8 @@ import uuid
 
 from google.appengine.api import urlfetch
 
+from tipfy.deadline import get_timeout
+
 
 class OAuthMixin(object):
     """A :class:`tipfy.RequestHandler` mixin that implements OAuth
@@ -60,7 +62,7 @@ class OAuthMixin(object):
 
         url = self._oauth_request_token_url()
         try:
-            response = urlfetch.fetch(url, deadline=10)
+            response = urlfetch.fetch(url, deadline=get_timeout(10))
         except urlfetch.DownloadError, e:
             logging.exception(e)
             response = None
@@ -96,7 +98,7 @@ class OAuthMixin(object):
         url = self._oauth_access_token_url(token)
 
         try:
-            response = urlfetch.fetch(url, deadline=10)
+            response = urlfetch.fetch(url, deadline=get_timeout(10))
             if response.status_code < 200 or response.status_code >= 300:
                 logging.warning('Invalid OAuth response: %s',
                     response.content)
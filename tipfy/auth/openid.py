@@ -19,6 +19,8 @@ import urlparse
 
 from google.appengine.api import urlfetch
 
+from tipfy.deadline import get_timeout
+
 
 class OpenIdMixin(object):
     """A :class:`tipfy.RequestHandler` mixin that implements OpenID
@@ -80,7 +82,7 @@ class OpenIdMixin(object):
         url = make_full_url(openid_endpoint, args)
 
         try:
-            response = urlfetch.fetch(url, deadline=10)
+            response = urlfetch.fetch(url, deadline=get_timeout(10))
             if response.status_code < 200 or response.status_code >= 300:
                 logging.warning('Invalid OpenID response: %s',
                     response.content)
@@ -19,6 +19,7 @@ import urllib
 from google.appengine.api import urlfetch
 
 from tipfy import REQUIRED_VALUE
+from tipfy.deadline import get_timeout
 from tipfy.utils import json_decode, json_encode
 from .oauth import OAuthMixin
 
@@ -106,7 +107,7 @@ class TwitterMixin(OAuthMixin):
         """
         url = self._oauth_request_token_url()
         try:
-            response = urlfetch.fetch(url, deadline=10)
+            response = urlfetch.fetch(url, deadline=get_timeout(10))
         except urlfetch.DownloadError, e:
             logging.exception(e)
             response = None
@@ -175,9 +176,10 @@ class TwitterMixin(OAuthMixin):
         try:
             if post_args is not None:
                 response = urlfetch.fetch(url, method='POST',
-                    payload=urllib.urlencode(post_args), deadline=10)
+                    payload=urllib.urlencode(post_args),
+                    deadline=get_timeout(10))
             else:
-                response = urlfetch.fetch(url, deadline=10)
+                response = urlfetch.fetch(url, deadline=get_timeout(10))
         except urlfetch.DownloadError, e:
             logging.exception(e)
             response = None
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.batch
+    ~~~~~~~~~~~
+
+    A handler that executes several sub-requests in a single HTTP request, so
+    that a client building a page from many API calls pays for one round
+    trip. Map it to a URL::
+
+        Rule('/batch', name='batch', handler='tipfy.batch.BatchHandler')
+
+    And post a JSON array of sub-requests, each one with a `path` and
+    optional `method`, `headers` and `body`::
+
+        [
+            {"path": "/api/user"},
+            {"path": "/api/messages?unread=1", "parallel": true},
+            {"path": "/api/friends", "parallel": true},
+            {"method": "POST", "path": "/api/seen", "body": {"id": 42}}
+        ]
+
+    A `body` that is not a string is sent encoded as JSON. The response is a
+    JSON array with the result of each sub-request, in the same order::
+
+        [{"status": 200, "headers": [["Content-Type", "text/html"]],
+          "body": "..."}, ...]
+
+    Bodies that are not valid text are encoded in base64, and the result has
+    ``"encoding": "base64"``.
+
+    Sub-requests are executed in order. Consecutive sub-requests marked as
+    ``"parallel": true`` don't depend on each other: they are executed at the
+    same time by a pool of threads, and the next sub-request starts when all
+    of them are done.
+
+    Sub-requests are matched and dispatched in-process by the app router,
+    with the headers listed in the `forward_headers` config key copied from
+    the batch request. They share the auth and session stores of the batch
+    handler, so the batch handler middleware, e.g.,
+    :class:`tipfy.sessions.SessionMiddleware`, saves sessions once for the
+    whole batch. The stores are created once even if parallel sub-requests
+    use them at the same time, but they are not thread-safe: parallel
+    sub-requests can read sessions, and must not write sessions or cookies.
+    Write them in sequential sub-requests.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import base64
+import logging
+import Queue
+import threading
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from werkzeug import Headers, cached_property
+from werkzeug.exceptions import HTTPException, InternalServerError
+from werkzeug.test import EnvironBuilder
+
+from .app import RequestHandler, abort, local
+from .utils import json_decode, json_encode
+
+__all__ = [
+    'BatchHandler', 'ThreadPool',
+]
+
+#: Default configuration values for this module. Keys are:
+#:
+#: max_requests
+#:     Maximum number of sub-requests in a batch. Bigger batches are rejected
+#:     with `413 Request Entity Too Large`. Default is 20.
+#:
+#: max_workers
+#:     Number of threads that execute parallel sub-requests. The threads are
+#:     shared by all batches of the app. Set to 0 to execute parallel
+#:     sub-requests sequentially. Default is 4.
+#:
+#: forward_headers
+#:     Names of the batch request headers copied to every sub-request.
+#:     Headers set in a sub-request take precedence.
+default_config = {
+    'max_requests':    20,
+    'max_workers':     4,
+    'forward_headers': ['Accept', 'Accept-Language', 'Authorization',
+                        'Cookie', 'User-Agent'],
+}
+
+# WSGI environment keys that are not copied to sub-requests.
+_PER_REQUEST_PREFIXES = ('HTTP_', 'CONTENT_', 'wsgi.', 'werkzeug.',
+    'tipfy.')
+
+
+class BatchHandler(RequestHandler):
+    """Executes a batch of sub-requests posted as a JSON array."""
+    def __init__(self, app, request):
+        RequestHandler.__init__(self, app, request)
+        # Guards the creation of stores shared with parallel sub-requests.
+        self._stores_lock = threading.Lock()
+
+    @cached_property
+    def auth(self):
+        """The auth store, shared with the sub-requests. See
+        :attr:`tipfy.RequestHandler.auth`.
+        """
+        return self._get_store('auth', self.app.auth_store_class)
+
+    @cached_property
+    def session_store(self):
+        """The session store, shared with the sub-requests. See
+        :attr:`tipfy.RequestHandler.session_store`.
+        """
+        return self._get_store('session_store',
+            self.app.session_store_class)
+
+    def _get_store(self, name, store_class):
+        """Creates a store once, even if parallel sub-requests ask for it
+        at the same time.
+        """
+        self._stores_lock.acquire()
+        try:
+            store = self.__dict__.get(name)
+            if store is None:
+                store = self.__dict__[name] = store_class(self)
+
+            return store
+        finally:
+            self._stores_lock.release()
+
+    def post(self, **kwargs):
+        if self.request.parent is not None:
+            # Batches can't be nested.
+            abort(400)
+
+        items = self.get_sub_requests()
+        results = [None] * len(items)
+        parallel = []
+        for index, item in enumerate(items):
+            if item.get('parallel'):
+                parallel.append(index)
+                continue
+
+            self.execute_parallel(items, parallel, results)
+            parallel = []
+            results[index] = self.execute(item)
+
+        self.execute_parallel(items, parallel, results)
+        return self.app.response_class(json_encode(results),
+            mimetype='application/json')
+
+    def get_sub_requests(self):
+        """Returns the sub-requests posted in the request body, aborting with
+        `400 Bad Request` if they are not valid.
+
+        :returns:
+            A list of dictionaries.
+        """
+        try:
+            items = json_decode(self.request.data)
+        except ValueError:
+            abort(400)
+
+        if not isinstance(items, list):
+            abort(400)
+
+        for item in items:
+            if not isinstance(item, dict) or \
+                not isinstance(item.get('path'), basestring) or \
+                not item['path'].startswith('/'):
+                abort(400)
+
+        if len(items) > self.get_config(__name__, 'max_requests'):
+            abort(413)
+
+        return items
+
+    def execute(self, item):
+        """Executes a sub-request.
+
+        :param item:
+            A dictionary describing the sub-request.
+        :returns:
+            A dictionary with the sub-request result.
+        """
+        request = self.make_request(item)
+        try:
+            response = self.dispatch(request)
+        finally:
+            local.current_handler = self
+
+        return self.make_result(request, response)
+
+    def execute_parallel(self, items, indexes, results):
+        """Executes sub-requests at the same time using the thread pool.
+
+        :param items:
+            The list of sub-requests.
+        :param indexes:
+            Indexes of the sub-requests to be executed.
+        :param results:
+            The list of results, filled in place.
+        """
+        if not indexes:
+            return
+
+        pool = self.get_pool()
+        if pool is None or len(indexes) == 1:
+            for index in indexes:
+                results[index] = self.execute(items[index])
+
+            return
+
+        app = self.app
+
+        def execute(item):
+            local.current_app = app
+            local.current_handler = self
+            try:
+                return self.execute(item)
+            finally:
+                local.__release_local__()
+
+        values = pool.map(execute, [items[index] for index in indexes])
+        for index, value in zip(indexes, values):
+            results[index] = value
+
+    def get_pool(self):
+        """Returns the thread pool shared by the batches of the app.
+
+        :returns:
+            A :class:`ThreadPool`, or None if `max_workers` is 0.
+        """
+        size = self.get_config(__name__, 'max_workers')
+        if not size:
+            return None
+
+        registry = self.app.registry
+        pool = registry.get('batch.pool')
+        if pool is None:
+            pool = registry.setdefault('batch.pool', ThreadPool(size))
+
+        return pool
+
+    def make_request(self, item):
+        """Builds a sub-request.
+
+        :param item:
+            A dictionary describing the sub-request.
+        :returns:
+            A :attr:`tipfy.Tipfy.request_class` instance.
+        """
+        parent = self.request
+        headers = Headers()
+        for name in self.get_config(__name__, 'forward_headers'):
+            value = parent.headers.get(name)
+            if value is not None:
+                headers[name] = value
+
+        for name, value in (item.get('headers') or {}).iteritems():
+            headers[name] = value
+
+        body = item.get('body')
+        if body is None:
+            body = ''
+        elif not isinstance(body, basestring):
+            body = json_encode(body)
+            headers.setdefault('Content-Type', 'application/json')
+
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        environ_base = dict((key, value) for key, value in
+            parent.environ.iteritems() if
+            not key.startswith(_PER_REQUEST_PREFIXES))
+        content_type = headers.get('Content-Type')
+        headers.pop('Content-Type', None)
+
+        environ = EnvironBuilder(path=item['path'],
+            base_url=parent.url_root, method=item.get('method', 'GET').upper(),
+            headers=headers, input_stream=StringIO(body),
+            content_type=content_type, environ_base=environ_base).get_environ()
+
+        request = self.app.request_class(environ)
+        request.__dict__.update(self.app.request_options)
+        request.parent = self
+        request.deadline = parent.deadline
+        return request
+
+    def dispatch(self, request):
+        """Matches and dispatches a sub-request, handling exceptions like
+        :meth:`tipfy.Tipfy.wsgi_app` does.
+
+        :param request:
+            The sub-request.
+        :returns:
+            A :attr:`tipfy.Tipfy.response_class` instance.
+        """
+        app = self.app
+        try:
+            match = app.router.match(request)
+            return app.router.dispatch(request, match)
+        except Exception, e:
+            try:
+                return app.handle_exception(request, e)
+            except HTTPException, e:
+                return app.make_response(request, e)
+            except Exception, e:
+                logging.exception(e)
+                return app.make_response(request, InternalServerError())
+
+    def make_result(self, request, response):
+        """Converts a sub-request response to a value for the batch response.
+
+        :param request:
+            The sub-request.
+        :param response:
+            The sub-request response.
+        :returns:
+            A dictionary with the keys `status`, `headers` and `body`, and
+            `encoding` if the body is encoded in base64.
+        """
+        result = {
+            'status':  response.status_code,
+            'headers': response.headers.to_list(),
+        }
+        if request.method == 'HEAD' or response.status_code in (204, 304):
+            result['body'] = u''
+            return result
+
+        data = response.data
+        try:
+            result['body'] = data.decode(response.charset)
+        except UnicodeDecodeError:
+            result['body'] = base64.b64encode(data)
+            result['encoding'] = 'base64'
+
+        return result
+
+
+class ThreadPool(object):
+    """A fixed number of daemon threads that execute functions from a queue.
+    Threads are started on first use.
+    """
+    def __init__(self, size):
+        """Initializes the pool.
+
+        :param size:
+            Number of threads.
+        """
+        self.size = size
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def map(self, func, values):
+        """Calls a function for each value using the pool threads, and waits
+        until all calls are done.
+
+        :param func:
+            A function that receives a value.
+        :param values:
+            A list of values.
+        :returns:
+            A list with the results of each call, in order. If a call raised
+            an exception, the first one is reraised.
+        """
+        self.start()
+        results = [None] * len(values)
+        errors = []
+        pending = [len(values)]
+        done = threading.Event()
+        lock = threading.Lock()
+
+        def call(index, value):
+            try:
+                results[index] = func(value)
+            except Exception, e:
+                errors.append(e)
+
+            lock.acquire()
+            try:
+                pending[0] -= 1
+                if not pending[0]:
+                    done.set()
+            finally:
+                lock.release()
+
+        for index, value in enumerate(values):
+            self.queue.put((call, (index, value)))
+
+        done.wait()
+        if errors:
+            raise errors[0]
+
+        return results
+
+    def start(self):
+        """Starts the pool threads, if they were not started yet."""
+        if self.threads:
+            return
+
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work,
+                    name='tipfy.batch.ThreadPool-%d' % len(self.threads))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def work(self):
+        """Executes queued functions. This is the target of pool threads."""
+        while True:
+            func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception, e:
+                logging.exception(e)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.cache
+    ~~~~~~~~~~~
+
+    In-process cache backends, implementing the ``werkzeug.contrib.cache``
+    API.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import threading
+import time
+
+from werkzeug.contrib.cache import BaseCache
+
+__all__ = [
+    'LRUCache',
+]
+
+# Indexes of the fields in a linked list entry.
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES = range(5)
+
+
+class LRUCache(BaseCache):
+    """A thread-safe in-process cache that keeps up to `max_entries` values,
+    discarding the least recently used one when it is full.
+    """
+    def __init__(self, max_entries=500, default_timeout=300):
+        """Initializes the cache.
+
+        :param max_entries:
+            Maximum number of values in the cache.
+        :param default_timeout:
+            Default timeout in seconds used if none is set in :meth:`set`.
+        """
+        BaseCache.__init__(self, default_timeout)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns a value from the cache, or None if it is not set or
+        expired.
+
+        :param key:
+            The cache key.
+        :returns:
+            The cached value.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            self._unlink(entry)
+            if entry[_EXPIRES] <= time.time():
+                del self._entries[key]
+                return None
+
+            # Move it to the most recently used end.
+            self._append(entry)
+            return entry[_VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout=None):
+        """Sets a value in the cache.
+
+        :param key:
+            The cache key.
+        :param value:
+            The value to be cached.
+        :param timeout:
+            Timeout in seconds. If not set, uses the default timeout.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+
+            while len(self._entries) >= self.max_entries:
+                oldest = self._root[_NEXT]
+                self._unlink(oldest)
+                del self._entries[oldest[_KEY]]
+
+            entry = [None, None, key, value, time.time() + timeout]
+            self._entries[key] = entry
+            self._append(entry)
+        finally:
+            self._lock.release()
+
+    def add(self, key, value, timeout=None):
+        """Sets a value in the cache if it is not set yet.
+
+        :param key:
+            The cache key.
+        :param value:
+            The value to be cached.
+        :param timeout:
+            Timeout in seconds. If not set, uses the default timeout.
+        """
+        if self.get(key) is None:
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        """Removes a value from the cache.
+
+        :param key:
+            The cache key.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Removes all values from the cache."""
+        self._lock.acquire()
+        try:
+            self._entries = {}
+            # Circular doubly linked list, from least to most recently used.
+            root = self._root = [None, None, None, None, None]
+            root[_PREV] = root[_NEXT] = root
+        finally:
+            self._lock.release()
+
+    def _append(self, entry):
+        last = self._root[_PREV]
+        entry[_PREV], entry[_NEXT] = last, self._root
+        last[_NEXT] = self._root[_PREV] = entry
+
+    def _unlink(self, entry):
+        entry[_PREV][_NEXT] = entry[_NEXT]
+        entry[_NEXT][_PREV] = entry[_PREV]
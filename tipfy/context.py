@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.context
+    ~~~~~~~~~~~~~
+
+    Context-local storage for the active app and handler.
+
+    :class:`ContextLocal` has the same interface as ``werkzeug.Local`` --
+    attribute access, ``__release_local__()`` and ``__call__(name)`` to create
+    a proxy -- but doesn't acquire a lock on every access:
+
+    - If greenlets are available, values are stored per greenlet. Every
+      thread has its own main greenlet, so this is also correct for threads.
+    - Otherwise it is a ``threading.local``, implemented in C.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import threading
+
+from werkzeug import LocalProxy
+
+try:
+    from greenlet import getcurrent as get_current_greenlet
+except ImportError:
+    get_current_greenlet = None
+
+__all__ = [
+    'ContextLocal',
+]
+
+
+class GreenletLocal(object):
+    """Context-local storage keyed by the current greenlet."""
+    __slots__ = ('__storage__',)
+
+    def __init__(self):
+        object.__setattr__(self, '__storage__', {})
+
+    def __getattr__(self, name):
+        try:
+            return self.__storage__[get_current_greenlet()][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        key = get_current_greenlet()
+        storage = self.__storage__.get(key)
+        if storage is None:
+            storage = self.__storage__[key] = {}
+
+        storage[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self.__storage__[get_current_greenlet()][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __release_local__(self):
+        """Removes all values for the current context."""
+        self.__storage__.pop(get_current_greenlet(), None)
+
+    def __call__(self, name):
+        """Returns a proxy to a value in this local."""
+        return LocalProxy(self, name)
+
+
+class ThreadLocal(threading.local):
+    """Context-local storage keyed by the current thread."""
+    def __release_local__(self):
+        """Removes all values for the current context."""
+        self.__dict__.clear()
+
+    def __call__(self, name):
+        """Returns a proxy to a value in this local."""
+        return LocalProxy(self, name)
+
+
+if get_current_greenlet is not None:
+    ContextLocal = GreenletLocal
+else:
+    ContextLocal = ThreadLocal
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.deadline
+    ~~~~~~~~~~~~~~
+
+    Per-request time budget. When the ``request_deadline`` config key for
+    ``tipfy`` or the `deadline` option of a :class:`tipfy.Rule` is set, each
+    request gets a :class:`Deadline`, available as ``request.deadline``.
+    Helpers that call slow services consult it to cap their own timeouts and
+    to stop work that can't finish in time::
+
+        from google.appengine.api import urlfetch
+        from tipfy.deadline import get_timeout
+
+        response = urlfetch.fetch(url, deadline=get_timeout(10))
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+from werkzeug.exceptions import ServiceUnavailable
+
+from .tracing import timer
+
+__all__ = [
+    'Deadline', 'DeadlineExceeded', 'get_deadline', 'get_timeout',
+]
+
+
+class DeadlineExceeded(ServiceUnavailable):
+    """Raised when a request has no time left to perform an operation. It is
+    an HTTP exception, so if it is not handled the response is
+    ``503 Service Unavailable``.
+    """
+    description = (
+        '<p>The server could not complete your request in time. Please try '
+        'again later.</p>'
+    )
+
+
+class Deadline(object):
+    """The time budget of a request."""
+    def __init__(self, timeout, start=None):
+        """Initializes the deadline.
+
+        :param timeout:
+            Seconds available to the request.
+        :param start:
+            Start time of the request, as returned by
+            :func:`tipfy.tracing.timer`. Default is now.
+        """
+        if start is None:
+            start = timer()
+
+        self.timeout = timeout
+        self.start = start
+        self.expires = start + timeout
+
+    def remaining(self):
+        """Returns the time left.
+
+        :returns:
+            Seconds left, or 0 if the deadline has passed.
+        """
+        return max(self.expires - timer(), 0.0)
+
+    @property
+    def expired(self):
+        """True if the deadline has passed."""
+        return timer() >= self.expires
+
+    def check(self):
+        """Raises :class:`DeadlineExceeded` if the deadline has passed."""
+        if self.expired:
+            raise DeadlineExceeded()
+
+    def get_timeout(self, default):
+        """Returns a timeout for an operation: the default timeout capped by
+        the time left.
+
+        :param default:
+            The timeout in seconds to use if there's enough time left.
+        :returns:
+            ``min(remaining, default)``, in seconds.
+        """
+        remaining = self.expires - timer()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+
+        return min(remaining, default)
+
+    def __repr__(self):
+        return '<Deadline %.3fs remaining of %ss>' % (self.remaining(),
+            self.timeout)
+
+
+def get_deadline():
+    """Returns the deadline of the current request.
+
+    :returns:
+        A :class:`Deadline` instance, or None if there is no active request
+        or it has no deadline.
+    """
+    from .app import local
+    handler = getattr(local, 'current_handler', None)
+    return getattr(getattr(handler, 'request', None), 'deadline', None)
+
+
+def get_timeout(default):
+    """Returns a timeout for an operation performed by the current request:
+    the default timeout capped by the time the request has left. Out of a
+    request, or if it has no deadline, it is the default timeout.
+
+    :param default:
+        The timeout in seconds to use if there's enough time left.
+    :returns:
+        A timeout in seconds.
+    :raises:
+        :class:`DeadlineExceeded` if the request has no time left.
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return default
+
+    return deadline.get_timeout(default)
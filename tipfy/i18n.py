@@ -23,17 +23,28 @@
 from datetime import datetime
 import os
 
-from babel import Locale, dates, numbers, support
+from .app import get_current_handler
+from .lazy import LazyModule
 
-try:
-    from pytz.gae import pytz
-except ImportError:
+
+def _import_pytz():
     try:
-        import pytz
+        from pytz.gae import pytz
     except ImportError:
-        raise RuntimeError('gaepytz or pytz are required.')
+        try:
+            import pytz
+        except ImportError:
+            raise RuntimeError('gaepytz or pytz are required.')
+
+    return pytz
 
-from .app import current_handler
+
+# Babel and pytz are only imported when they are first used.
+babel = LazyModule('babel.core')
+dates = LazyModule('babel.dates')
+numbers = LazyModule('babel.numbers')
+support = LazyModule('babel.support')
+pytz = LazyModule(_import_pytz)
 
 #: Default configuration values for this module. Keys are:
 #:
@@ -149,6 +160,25 @@ class I18nStore(object):
         self.set_locale_for_request(handler)
         self.set_timezone_for_request(handler)
 
+    @classmethod
+    def load_locales(cls, app, locales):
+        """Loads translations for a list of locales in advance, so that
+        requests using them don't need to load them. This is used by
+        :meth:`tipfy.Tipfy.warmup`.
+
+        :param app:
+            A :class:`tipfy.Tipfy` instance.
+        :param locales:
+            A list of locale codes, e.g., ``['en_US', 'pt_BR']``.
+        """
+        # The store is not bound to a request: only translations are set.
+        store = cls.__new__(cls)
+        store.config = app.config[__name__]
+        store.loaded_translations = app.registry.setdefault(
+            'i18n.translations', {})
+        for locale in locales:
+            store.set_locale(locale)
+
     def set_locale_for_request(self, handler):
         locale = _get_request_value(handler,
             self.config['locale_request_lookup'], self.config['locale'])
@@ -166,14 +196,18 @@ class I18nStore(object):
             A locale code, e.g., ``pt_BR``.
         """
         self.locale = locale
-        if locale not in self.loaded_translations:
+        translations = self.loaded_translations.get(locale)
+        if translations is None:
             locales = [locale]
             if locale != self.config['locale']:
                 locales.append(self.config['locale'])
 
-            self.loaded_translations[locale] = self.load_translations(locales)
+            # If concurrent requests load the same locale, all use the first
+            # translations stored.
+            translations = self.loaded_translations.setdefault(locale,
+                self.load_translations(locales))
 
-        self.translations = self.loaded_translations[locale]
+        self.translations = translations
 
     def set_timezone(self, timezone):
         """Sets the current timezone and tzinfo.
@@ -635,109 +669,110 @@ class I18nStore(object):
 
 def set_locale(locale):
     """See :meth:`I18nStore.set_locale`."""
-    return current_handler.i18n.set_locale(locale)
+    return get_current_handler().i18n.set_locale(locale)
 
 
 def set_timezone(timezone):
     """See :meth:`I18nStore.set_timezone`."""
-    return current_handler.i18n.set_timezone(timezone)
+    return get_current_handler().i18n.set_timezone(timezone)
 
 
 def gettext(string, **variables):
     """See :meth:`I18nStore.gettext`."""
-    return current_handler.i18n.gettext(string, **variables)
+    return get_current_handler().i18n.gettext(string, **variables)
 
 
 def ngettext(singular, plural, n, **variables):
     """See :meth:`I18nStore.ngettext`."""
-    return current_handler.i18n.ngettext(singular, plural, n, **variables)
+    return get_current_handler().i18n.ngettext(singular, plural, n,
+        **variables)
 
 
 def to_local_timezone(datetime):
     """See :meth:`I18nStore.to_local_timezone`."""
-    return current_handler.i18n.to_local_timezone(datetime)
+    return get_current_handler().i18n.to_local_timezone(datetime)
 
 
 def to_utc(datetime):
     """See :meth:`I18nStore.to_utc`."""
-    return current_handler.i18n.to_utc(datetime)
+    return get_current_handler().i18n.to_utc(datetime)
 
 
 def format_date(date=None, format=None, rebase=True):
     """See :meth:`I18nStore.format_date`."""
-    return current_handler.i18n.format_date(date, format, rebase)
+    return get_current_handler().i18n.format_date(date, format, rebase)
 
 
 def format_datetime(datetime=None, format=None, rebase=True):
     """See :meth:`I18nStore.format_datetime`."""
-    return current_handler.i18n.format_datetime(datetime, format, rebase)
+    return get_current_handler().i18n.format_datetime(datetime, format, rebase)
 
 
 def format_time(time=None, format=None, rebase=True):
     """See :meth:`I18nStore.format_time`."""
-    return current_handler.i18n.format_time(time, format, rebase)
+    return get_current_handler().i18n.format_time(time, format, rebase)
 
 
 def format_timedelta(datetime_or_timedelta, granularity='second',
     threshold=.85):
     """See :meth:`I18nStore.format_timedelta`."""
-    return current_handler.i18n.format_timedelta(datetime_or_timedelta,
+    return get_current_handler().i18n.format_timedelta(datetime_or_timedelta,
         granularity, threshold)
 
 
 def format_number(number):
     """See :meth:`I18nStore.format_number`."""
-    return current_handler.i18n.format_number(number)
+    return get_current_handler().i18n.format_number(number)
 
 
 def format_decimal(number, format=None):
     """See :meth:`I18nStore.format_decimal`."""
-    return current_handler.i18n.format_decimal(number, format)
+    return get_current_handler().i18n.format_decimal(number, format)
 
 
 def format_currency(number, currency, format=None):
     """See :meth:`I18nStore.format_currency`."""
-    return current_handler.i18n.format_currency(number, currency, format)
+    return get_current_handler().i18n.format_currency(number, currency, format)
 
 
 def format_percent(number, format=None):
     """See :meth:`I18nStore.format_percent`."""
-    return current_handler.i18n.format_percent(number, format)
+    return get_current_handler().i18n.format_percent(number, format)
 
 
 def format_scientific(number, format=None):
     """See :meth:`I18nStore.format_scientific`."""
-    return current_handler.i18n.format_scientific(number, format)
+    return get_current_handler().i18n.format_scientific(number, format)
 
 
 def parse_date(string):
     """See :meth:`I18nStore.parse_date`"""
-    return current_handler.i18n.parse_date(string)
+    return get_current_handler().i18n.parse_date(string)
 
 
 def parse_datetime(string):
     """See :meth:`I18nStore.parse_datetime`."""
-    return current_handler.i18n.parse_datetime(string)
+    return get_current_handler().i18n.parse_datetime(string)
 
 
 def parse_time(string):
     """See :meth:`I18nStore.parse_time`."""
-    return current_handler.i18n.parse_time(string)
+    return get_current_handler().i18n.parse_time(string)
 
 
 def parse_number(string):
     """See :meth:`I18nStore.parse_number`."""
-    return current_handler.i18n.parse_number(string)
+    return get_current_handler().i18n.parse_number(string)
 
 
 def parse_decimal(string):
     """See :meth:`I18nStore.parse_decimal`."""
-    return current_handler.i18n.parse_decimal(string)
+    return get_current_handler().i18n.parse_decimal(string)
 
 
 def get_timezone_location(dt_or_tzinfo):
     """See :meth:`I18nStore.get_timezone_location`."""
-    return current_handler.i18n.get_timezone_location(dt_or_tzinfo)
+    return get_current_handler().i18n.get_timezone_location(dt_or_tzinfo)
 
 
 def list_translations(dirname='locale'):
@@ -755,7 +790,7 @@ def list_translations(dirname='locale'):
     result = []
     for folder in sorted(os.listdir(dirname)):
         if os.path.isdir(os.path.join(dirname, folder, 'LC_MESSAGES')):
-            result.append(Locale.parse(folder))
+            result.append(babel.Locale.parse(folder))
 
     return result
 
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.lazy
+    ~~~~~~~~~~
+
+    Lazy imports for heavy dependencies, so that they are only loaded when
+    a request actually uses them::
+
+        dates = LazyModule('babel.dates')
+
+        def format_date(date):
+            # babel.dates is imported here, on first access.
+            return dates.format_date(date)
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import sys
+
+__all__ = [
+    'LazyModule',
+]
+
+
+class LazyModule(object):
+    """A proxy to a module that is imported on first attribute access.
+    Accessed attributes are then copied to the proxy, so that later lookups
+    are as fast as normal module attribute lookups.
+    """
+    def __init__(self, loader):
+        """Initializes the proxy.
+
+        :param loader:
+            The module name, or a function without arguments that imports
+            and returns the module.
+        """
+        self.__dict__['_loader'] = loader
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, name):
+        value = getattr(self._load(), name)
+        self.__dict__[name] = value
+        return value
+
+    def __setattr__(self, name, value):
+        # Allow patching the module through the proxy, e.g., in tests.
+        setattr(self._load(), name, value)
+        self.__dict__[name] = value
+
+    def _load(self):
+        """Imports the module if it was not imported yet.
+
+        :returns:
+            The module.
+        """
+        module = self._module
+        if module is None:
+            loader = self._loader
+            if isinstance(loader, basestring):
+                __import__(loader)
+                module = sys.modules[loader]
+            else:
+                module = loader()
+
+            self.__dict__['_module'] = module
+
+        return module
+
+    def __repr__(self):
+        if self._module is None:
+            return '<LazyModule %r (not loaded)>' % (self._loader,)
+
+        return '<LazyModule %r>' % self._module
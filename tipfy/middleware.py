@@ -8,13 +8,57 @@
     :copyright: 2010 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
+import threading
+import time
+import zlib
+from calendar import timegm
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
 from werkzeug import ETagResponseMixin
+from werkzeug.exceptions import ServiceUnavailable
+
+from .app import APPENGINE, REQUEST_START_KEY
+from .cache import LRUCache
+
+__all__ = [
+    'CompressionMiddleware', 'ETagMiddleware', 'LoadSheddingMiddleware',
+    'ResponseCacheMiddleware',
+]
+
+#: Headers of a response copied to its ``304 Not Modified`` replacement.
+_NOT_MODIFIED_HEADERS = ('Cache-Control', 'Content-Location', 'ETag',
+    'Expires', 'Last-Modified', 'Vary')
+
+#: WSGI environment key for the response cache key of a request.
+_RESPONSE_CACHE_KEY = 'tipfy.response_cache_key'
 
 
 class ETagMiddleware(object):
     """Adds an etag to all responses if they haven't already set one, and
     returns '304 Not Modified' if the request contains a matching etag.
+
+    Calculating an etag requires the whole body, so by default streamed
+    responses are left untouched.
+
+    To use it with :class:`CompressionMiddleware`, list the compression
+    middleware first, so that etags are calculated for the uncompressed body
+    and compressed bodies can be cached by etag::
+
+        middleware = [CompressionMiddleware(), ETagMiddleware()]
     """
+    def __init__(self, buffer_streamed=False):
+        """Initializes the middleware.
+
+        :param buffer_streamed:
+            If True, streamed responses are buffered to calculate their
+            etag. Default is False.
+        """
+        self.buffer_streamed = buffer_streamed
+
     def after_dispatch(self, handler, response):
         """Called after the class:`tipfy.RequestHandler` method was executed.
 
@@ -28,9 +72,724 @@ class ETagMiddleware(object):
         if not isinstance(response, ETagResponseMixin):
             return response
 
+        if response.is_streamed and 'etag' not in response.headers:
+            if not self.buffer_streamed:
+                return response
+
+            response.make_sequence()
+
         response.add_etag()
 
-        if handler.request.if_none_match.contains_raw(response.get_etag()[0]):
-            return handler.app.response_class(status=304)
+        if _is_not_modified(handler.request, response):
+            not_modified = handler.app.response_class(status=304)
+            for key in _NOT_MODIFIED_HEADERS:
+                if key in response.headers:
+                    not_modified.headers[key] = response.headers[key]
+
+            return not_modified
+
+        return response
+
+
+class CompressionMiddleware(object):
+    """Compresses response bodies using gzip or deflate, according to the
+    ``Accept-Encoding`` request header.
+
+    Only responses with a mimetype in :attr:`mimetypes` are compressed.
+    Buffered responses smaller than `min_size` are left untouched; streamed
+    responses are compressed chunk by chunk, each chunk being flushed so that
+    it reaches the client without waiting for the next one.
+
+    Compressed bodies of responses with a strong etag are kept in a bounded
+    cache keyed by etag and encoding, so identical responses are compressed
+    only once. Weak etags are not used as cache keys, because responses with
+    different bodies can share them. A strong etag is changed to a distinct
+    strong etag for the compressed body (``"<etag>-gzip"``), and a request
+    with that etag in ``If-None-Match`` gets a ``304 Not Modified``. Weak
+    etags are kept.
+    """
+    #: Mimetypes that are compressed.
+    mimetypes = frozenset([
+        'application/atom+xml', 'application/javascript', 'application/json',
+        'application/rss+xml', 'application/xhtml+xml', 'application/xml',
+        'image/svg+xml', 'text/css', 'text/csv', 'text/html',
+        'text/javascript', 'text/plain', 'text/xml',
+    ])
+    #: Supported encodings, in order of preference, mapped to the ``wbits``
+    #: argument for ``zlib.compressobj()``.
+    encodings = (
+        ('gzip', 16 + zlib.MAX_WBITS),
+        ('deflate', zlib.MAX_WBITS),
+    )
+
+    def __init__(self, min_size=500, level=6, cache_size=100):
+        """Initializes the middleware.
+
+        :param min_size:
+            Minimum body size in bytes to compress a buffered response.
+        :param level:
+            Compression level, from 1 (fastest) to 9 (smallest).
+        :param cache_size:
+            Maximum number of compressed bodies kept in cache. Set to 0 to
+            disable the cache.
+        """
+        self.min_size = min_size
+        self.level = level
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def after_dispatch(self, handler, response):
+        """Called after the class:`tipfy.RequestHandler` method was executed.
+
+        :param handler:
+            A class:`tipfy.RequestHandler` instance.
+        :param response:
+            A class:`tipfy.Response` instance.
+        :returns:
+            A class:`tipfy.Response` instance.
+        """
+        if response.status_code != 200 or \
+            response.mimetype not in self.mimetypes or \
+            'content-encoding' in response.headers or \
+            'no-transform' in response.headers.get('Cache-Control', ''):
+            return response
+
+        # The body varies according to Accept-Encoding, even if the
+        # current client doesn't accept compression.
+        vary = response.headers.get('Vary')
+        if not vary:
+            response.headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            response.headers['Vary'] = vary + ', Accept-Encoding'
+
+        request = handler.request
+        encoding, wbits = self.get_encoding(request)
+        if encoding is None:
+            return response
+
+        etag, weak = response.get_etag()
+        if response.is_streamed:
+            length = response.headers.get('Content-Length')
+            if length is not None and int(length) < self.min_size:
+                return response
+
+            response.response = self.compress_iter(response.response, wbits,
+                response.charset)
+            del response.headers['Content-Length']
+        else:
+            data = response.data
+            if len(data) < self.min_size:
+                return response
+
+            if etag is None or weak or not self.cache_size:
+                response.data = self.compress(data, wbits)
+            else:
+                response.data = self.get_cached(etag, encoding, data, wbits)
+
+            # The data setter doesn't update a preset length.
+            response.headers['Content-Length'] = str(len(response.data))
+
+        response.headers['Content-Encoding'] = encoding
+
+        if etag is None:
+            return response
+
+        if not weak:
+            # The compressed body is a different representation.
+            response.set_etag('%s-%s' % (etag, encoding))
+
+        if _is_not_modified(request, response):
+            not_modified = handler.app.response_class(status=304)
+            for key in ('ETag', 'Vary', 'Content-Encoding'):
+                not_modified.headers[key] = response.headers[key]
+
+            return not_modified
+
+        return response
+
+    def get_encoding(self, request):
+        """Returns the preferred encoding accepted by the client.
+
+        :param request:
+            A class:`tipfy.Request` instance.
+        :returns:
+            A tuple ``(encoding, wbits)``, or ``(None, None)`` if the client
+            doesn't accept any of the supported encodings.
+        """
+        accept = request.accept_encodings
+        res, best = (None, None), 0
+        for encoding, wbits in self.encodings:
+            quality = None
+            for value, q in accept:
+                if value == encoding:
+                    quality = q
+                    break
+                elif value == '*' and quality is None:
+                    quality = q
+
+            if quality > best:
+                res, best = (encoding, wbits), quality
+
+        return res
+
+    def get_cached(self, etag, encoding, data, wbits):
+        """Returns a compressed body from cache, compressing and caching it
+        if needed. If the cache is full, an arbitrary entry is discarded.
+
+        :param etag:
+            The uncompressed body etag. It must be a strong etag, which
+            identifies the body.
+        :param encoding:
+            The content encoding.
+        :param data:
+            The uncompressed body.
+        :param wbits:
+            The ``wbits`` argument for ``zlib.compressobj()``.
+        :returns:
+            The compressed body.
+        """
+        key = (etag, encoding)
+        value = self.cache.get(key)
+        if value is None:
+            value = self.compress(data, wbits)
+            while len(self.cache) >= self.cache_size:
+                try:
+                    self.cache.popitem()
+                except KeyError:
+                    break
+
+            self.cache[key] = value
+
+        return value
+
+    def compress(self, data, wbits):
+        """Compresses a string.
+
+        :param data:
+            The string to be compressed.
+        :param wbits:
+            The ``wbits`` argument for ``zlib.compressobj()``.
+        :returns:
+            The compressed string.
+        """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, wbits)
+        return compressor.compress(data) + compressor.flush()
+
+    def compress_iter(self, iterable, wbits, charset='utf-8'):
+        """Compresses an iterable chunk by chunk.
+
+        :param iterable:
+            An iterable of strings.
+        :param wbits:
+            The ``wbits`` argument for ``zlib.compressobj()``.
+        :param charset:
+            Charset used to encode unicode chunks.
+        :returns:
+            A generator of compressed chunks.
+        """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, wbits)
+        try:
+            for chunk in iterable:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode(charset)
+
+                if chunk:
+                    yield compressor.compress(chunk) + \
+                        compressor.flush(zlib.Z_SYNC_FLUSH)
+
+            yield compressor.flush()
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+
+class ResponseCacheMiddleware(object):
+    """A shared cache for whole responses. Responses are stored with their
+    status, headers and body, keyed by request method and URL plus the
+    values of the request headers named in the response ``Vary`` header. On
+    a hit, the cached response is returned before the handler method is
+    called, with an ``Age`` header.
+
+    A response is only stored if:
+
+    - the request method is ``GET`` or ``HEAD`` and it has no
+      ``Authorization`` header;
+    - the status is in :attr:`cacheable_status` and the body is not streamed;
+    - it has a freshness lifetime set by ``Cache-Control`` (``s-maxage`` or
+      ``max-age``) or ``Expires``, and ``Cache-Control`` doesn't contain
+      ``no-store``, ``no-cache`` or ``private``;
+    - it doesn't set cookies and its ``Vary`` header is not ``*``.
+
+    The middleware must be listed before middleware that set cookies, like
+    :class:`tipfy.sessions.SessionMiddleware`, so that their cookies are seen
+    when a response is stored. It should be listed after
+    :class:`CompressionMiddleware` and before :class:`ETagMiddleware`, so that
+    uncompressed bodies are stored with their etag and hits are not hashed
+    again::
+
+        middleware = [CompressionMiddleware(), ResponseCacheMiddleware(),
+            ETagMiddleware(), SessionMiddleware()]
+    """
+    #: Status codes of responses that can be cached.
+    cacheable_status = frozenset([200, 203, 300, 301, 404, 410])
+
+    def __init__(self, cache=None, key_prefix='tipfy.response_cache:'):
+        """Initializes the middleware.
+
+        :param cache:
+            A cache implementing the ``werkzeug.contrib.cache`` API. Default
+            is memcache on App Engine and a :class:`tipfy.cache.LRUCache`
+            otherwise.
+        :param key_prefix:
+            A prefix for cache keys.
+        """
+        if cache is None:
+            if APPENGINE:
+                from werkzeug.contrib.cache import GAEMemcachedCache
+                cache = GAEMemcachedCache()
+            else:
+                cache = LRUCache()
+
+        self.cache = cache
+        self.key_prefix = key_prefix
+        #: Number of requests served from cache.
+        self.hits = 0
+        #: Number of cacheable requests not found in cache.
+        self.misses = 0
+
+    def before_dispatch(self, handler):
+        """Called before the class:`tipfy.RequestHandler` method is executed.
+
+        :param handler:
+            A class:`tipfy.RequestHandler` instance.
+        :returns:
+            A cached class:`tipfy.Response` instance, or None.
+        """
+        request = handler.request
+        if request.method not in ('GET', 'HEAD') or \
+            'Authorization' in request.headers:
+            return None
+
+        base_key = self.get_base_key(request)
+        vary = self.cache.get(base_key)
+        if vary is not None:
+            entry = self.cache.get(self.get_key(base_key, vary, request))
+            now = time.time()
+            if entry is not None and entry[4] > now:
+                self.hits += 1
+                status, headers, data, stored = entry[:4]
+                response = handler.app.response_class(data, status=status,
+                    headers=headers)
+                response.headers['Age'] = str(int(now - stored))
+                return response
+
+        self.misses += 1
+        request.environ[_RESPONSE_CACHE_KEY] = base_key
+
+    def after_dispatch(self, handler, response):
+        """Called after the class:`tipfy.RequestHandler` method was executed.
+
+        :param handler:
+            A class:`tipfy.RequestHandler` instance.
+        :param response:
+            A class:`tipfy.Response` instance.
+        :returns:
+            A class:`tipfy.Response` instance.
+        """
+        request = handler.request
+        base_key = request.environ.pop(_RESPONSE_CACHE_KEY, None)
+        if base_key is None:
+            return response
+
+        timeout = self.get_timeout(response)
+        if not timeout:
+            return response
 
+        vary = response.headers.get('Vary', '')
+        vary = tuple(sorted(set(v.strip().lower() for v in vary.split(',')
+            if v.strip())))
+        if '*' in vary:
+            return response
+
+        now = time.time()
+        entry = (response.status_code, response.headers.to_list(),
+            response.data, now, now + timeout)
+        self.cache.set(self.get_key(base_key, vary, request), entry, timeout)
+        self.cache.set(base_key, vary, timeout)
         return response
+
+    def get_timeout(self, response):
+        """Returns how long a response can be cached.
+
+        :param response:
+            A class:`tipfy.Response` instance.
+        :returns:
+            The freshness lifetime in seconds, or None if the response can't
+            be cached.
+        """
+        if response.status_code not in self.cacheable_status or \
+            response.is_streamed or 'set-cookie' in response.headers:
+            return None
+
+        cache_control = response.cache_control
+        if cache_control.no_store or cache_control.no_cache or \
+            cache_control.private:
+            return None
+
+        for value in (cache_control.s_maxage, cache_control.max_age):
+            if value is not None:
+                try:
+                    return max(int(value), 0)
+                except ValueError:
+                    return None
+
+        if response.expires is not None:
+            date = response.date
+            if date is None:
+                now = time.time()
+            else:
+                now = timegm(date.utctimetuple())
+
+            return max(int(timegm(response.expires.utctimetuple()) - now), 0)
+
+    def get_base_key(self, request):
+        """Returns the cache key for a request method and URL.
+
+        :param request:
+            A class:`tipfy.Request` instance.
+        :returns:
+            A cache key.
+        """
+        method, url = request.method, request.url
+        if isinstance(method, unicode):
+            method = method.encode('utf-8')
+
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+
+        return self.key_prefix + sha1('%s %s' % (method, url)).hexdigest()
+
+    def get_key(self, base_key, vary, request):
+        """Returns the cache key for a request, including the values of the
+        request headers that vary.
+
+        :param base_key:
+            The key returned by :meth:`get_base_key`.
+        :param vary:
+            A tuple of lower case header names.
+        :param request:
+            A class:`tipfy.Request` instance.
+        :returns:
+            A cache key.
+        """
+        if not vary:
+            return base_key + ':'
+
+        values = '\n'.join(request.headers.get(name, '') for name in vary)
+        if isinstance(values, unicode):
+            values = values.encode('utf-8')
+
+        return '%s:%s' % (base_key, sha1(values).hexdigest())
+
+    def get_stats(self):
+        """Returns the hit and miss counters.
+
+        :returns:
+            A dictionary with the keys `hits`, `misses` and `ratio` (the
+            fraction of cacheable requests served from cache).
+        """
+        hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'hits':   hits,
+            'misses': misses,
+            'ratio':  total and float(hits) / total or 0.0,
+        }
+
+
+class LoadSheddingMiddleware(object):
+    """Limits the number of requests processed at the same time and rejects
+    requests early with ``503 Service Unavailable`` and a ``Retry-After``
+    header when the app is overloaded. Without it, when a dependency slows
+    down, requests pile up in the process and all of them get slower.
+
+    A request is rejected if:
+
+    - its queueing delay is above `max_queue_delay`. The delay is measured
+      from the ``X-Request-Start`` header set by the front end, in the
+      format ``t=<timestamp>`` with seconds, milliseconds or microseconds.
+      Without the header, it is measured in-process from the time the
+      request was received (see :data:`tipfy.REQUEST_START_KEY`);
+    - `max_in_flight` requests are already being processed and no slot is
+      freed within `max_wait` seconds.
+
+    Requests are prioritized by rule name: `priorities` maps rule names to
+    the fraction of the limits available to them. For example, with
+    ``{'reports': 0.5}`` a ``reports`` request is rejected when half of the
+    slots are in use, leaving the other half for more important requests.
+    Rules with priority None, and paths starting with one of `exempt_paths`
+    (by default App Engine paths like ``/_ah/warmup``), are never rejected.
+    Task queue handlers can be exempted in the same way.
+
+    The slot taken by a request is freed when the handler is done, even if
+    another middleware raises or returns a response early (see
+    :meth:`tipfy.RequestHandler.add_cleanup`).
+
+    If `target_latency` is set, the concurrency limit adapts to the handler
+    latency: it is reduced by 10% after each request slower than the target,
+    down to `min_in_flight`, and grows back slowly up to `max_in_flight`.
+
+    It should be the first middleware listed, so that rejected requests do
+    as little work as possible::
+
+        middleware = [LoadSheddingMiddleware(max_in_flight=20,
+            max_queue_delay=2, priorities={'tasks/send-mail': None})]
+
+    The limits apply to all handlers that share the middleware instance.
+    Counters for monitoring are returned by :meth:`get_stats`.
+    """
+    def __init__(self, max_in_flight=50, max_queue_delay=None, max_wait=0,
+        retry_after=1, priorities=None, exempt_paths=('/_ah/',),
+        target_latency=None, min_in_flight=1):
+        """Initializes the middleware.
+
+        :param max_in_flight:
+            Maximum number of requests processed at the same time.
+        :param max_queue_delay:
+            Maximum queueing delay in seconds, measured from the
+            ``X-Request-Start`` request header or from the time the request
+            was received. Default is None (no limit).
+        :param max_wait:
+            Seconds a request waits for a free slot before it is rejected.
+            Default is 0 (don't wait).
+        :param retry_after:
+            Value in seconds for the ``Retry-After`` header of rejected
+            requests.
+        :param priorities:
+            A dictionary mapping rule names to the fraction of the limits
+            available to them, or to None to never reject them. Default
+            is 1.0.
+        :param exempt_paths:
+            A sequence of path prefixes that are never rejected.
+        :param target_latency:
+            Handler latency in seconds used to adapt the concurrency limit.
+            Default is None (the limit is always `max_in_flight`).
+        :param min_in_flight:
+            Minimum concurrency limit when it adapts to latency.
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue_delay = max_queue_delay
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.priorities = priorities or {}
+        self.exempt_paths = tuple(exempt_paths)
+        self.target_latency = target_latency
+        self.min_in_flight = min_in_flight
+        #: Current concurrency limit.
+        self.limit = float(max_in_flight)
+        #: Number of requests being processed.
+        self.in_flight = 0
+        #: Highest number of requests processed at the same time.
+        self.peak_in_flight = 0
+        #: Number of admitted requests.
+        self.accepted = 0
+        #: Number of rejected requests per reason: `queue_delay` or
+        #: `concurrency`.
+        self.rejected = {'queue_delay': 0, 'concurrency': 0}
+        #: Number of rejected requests per rule name.
+        self.rejected_rules = {}
+        self._condition = threading.Condition()
+
+    def before_dispatch(self, handler):
+        """Called before the class:`tipfy.RequestHandler` method is executed.
+
+        :param handler:
+            A class:`tipfy.RequestHandler` instance.
+        :returns:
+            A ``503 Service Unavailable`` response if the request is
+            rejected, or None.
+        """
+        request = handler.request
+        priority = self.get_priority(request)
+        if priority is None:
+            return None
+
+        if self.max_queue_delay is not None:
+            delay = self.get_queue_delay(request)
+            if delay is not None and delay > self.max_queue_delay * priority:
+                return self.reject(handler, 'queue_delay')
+
+        if not self.acquire(priority):
+            return self.reject(handler, 'concurrency')
+
+        # Free the slot when the handler is done, whatever happens.
+        handler.add_cleanup(self.release_since, time.time())
+
+    def release_since(self, start):
+        """Frees a slot taken at the given time. See :meth:`release`.
+
+        :param start:
+            Time the slot was taken, from ``time.time()``.
+        """
+        self.release(time.time() - start)
+
+    def get_priority(self, request):
+        """Returns the fraction of the limits available to a request.
+
+        :param request:
+            A class:`tipfy.Request` instance.
+        :returns:
+            A float, or None if the request must never be rejected.
+        """
+        if self.exempt_paths and request.path.startswith(self.exempt_paths):
+            return None
+
+        rule = request.rule
+        return self.priorities.get(rule and rule.name, 1.0)
+
+    def get_queue_delay(self, request):
+        """Returns how long a request waited before being dispatched,
+        according to the ``X-Request-Start`` header or, without it, to the
+        time the request was received.
+
+        :param request:
+            A class:`tipfy.Request` instance.
+        :returns:
+            The delay in seconds, or None if it is not known.
+        """
+        value = request.headers.get('X-Request-Start')
+        if not value:
+            start = request.environ.get(REQUEST_START_KEY)
+            if start is None:
+                return None
+
+            return max(time.time() - start, 0.0)
+
+        if value.startswith('t='):
+            value = value[2:]
+
+        try:
+            start = float(value)
+        except ValueError:
+            return None
+
+        # Convert microseconds or milliseconds to seconds.
+        if start > 1e14:
+            start /= 1e6
+        elif start > 1e11:
+            start /= 1e3
+
+        return max(time.time() - start, 0.0)
+
+    def acquire(self, priority):
+        """Takes a slot for a request, waiting up to :attr:`max_wait`
+        seconds for one to be freed.
+
+        :param priority:
+            Fraction of the concurrency limit available to the request.
+        :returns:
+            True if a slot was taken, False otherwise.
+        """
+        condition = self._condition
+        condition.acquire()
+        try:
+            deadline = None
+            while self.in_flight >= self.limit * priority:
+                if deadline is None:
+                    deadline = time.time() + self.max_wait
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+
+                condition.wait(remaining)
+
+            self.in_flight += 1
+            self.accepted += 1
+            if self.in_flight > self.peak_in_flight:
+                self.peak_in_flight = self.in_flight
+
+            return True
+        finally:
+            condition.release()
+
+    def release(self, latency):
+        """Frees a slot taken by :meth:`acquire` and adapts the concurrency
+        limit if :attr:`target_latency` is set.
+
+        :param latency:
+            Time in seconds the request took to be processed.
+        """
+        condition = self._condition
+        condition.acquire()
+        try:
+            self.in_flight -= 1
+            if self.target_latency is not None:
+                if latency > self.target_latency:
+                    self.limit = max(self.limit * 0.9, self.min_in_flight)
+                else:
+                    self.limit = min(self.limit + 1.0 / self.limit,
+                        self.max_in_flight)
+
+            # Wake all waiters: each one checks the limit for its own
+            # priority, and the first one woken may not fit in the slot.
+            condition.notifyAll()
+        finally:
+            condition.release()
+
+    def reject(self, handler, reason):
+        """Returns a ``503 Service Unavailable`` response for a rejected
+        request and updates the counters.
+
+        :param handler:
+            A class:`tipfy.RequestHandler` instance.
+        :param reason:
+            `queue_delay` or `concurrency`.
+        :returns:
+            A class:`tipfy.Response` instance.
+        """
+        request = handler.request
+        name = request.rule and request.rule.name
+        condition = self._condition
+        condition.acquire()
+        try:
+            self.rejected[reason] += 1
+            self.rejected_rules[name] = self.rejected_rules.get(name, 0) + 1
+        finally:
+            condition.release()
+
+        response = handler.app.response_class(
+            ServiceUnavailable().get_body(request.environ), status=503)
+        response.headers['Retry-After'] = str(self.retry_after)
+        return response
+
+    def get_stats(self):
+        """Returns the middleware counters.
+
+        :returns:
+            A dictionary with the keys `in_flight`, `peak_in_flight`,
+            `limit`, `accepted`, `rejected` (the total), `rejected_reasons`
+            and `rejected_rules` (dictionaries with counts per reason and
+            rule name).
+        """
+        condition = self._condition
+        condition.acquire()
+        try:
+            return {
+                'in_flight':        self.in_flight,
+                'peak_in_flight':   self.peak_in_flight,
+                'limit':            self.limit,
+                'accepted':         self.accepted,
+                'rejected':         sum(self.rejected.values()),
+                'rejected_reasons': dict(self.rejected),
+                'rejected_rules':   dict(self.rejected_rules),
+            }
+        finally:
+            condition.release()
+
+
+def _is_not_modified(request, response):
+    """Returns True if the response etag matches one in the request
+    ``If-None-Match`` header, using weak comparison.
+    """
+    return request.if_none_match.contains_weak(response.get_etag()[0])
@@ -8,16 +8,33 @@
     :copyright: 2010 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
-from werkzeug import import_string, url_quote
-from werkzeug.routing import (BaseConverter, EndpointPrefix, Map,
-    Rule as BaseRule, RuleFactory, Subdomain, Submount)
+import heapq
+import re
+import threading
+from urlparse import urljoin
+
+from werkzeug import MultiDict, import_string, url_encode, url_quote
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+from werkzeug.routing import (BaseConverter, BuildError, EndpointPrefix,
+    Map as BaseMap, MapAdapter as BaseMapAdapter, RequestRedirect,
+    RequestSlash, Rule as BaseRule, RuleFactory, Subdomain, Submount,
+    ValidationError, _simple_rule_re)
 
 from .app import local
+from .cache import LRUCache
+from .tracing import timer
 
 __all__ = [
-    'HandlerPrefix', 'NamePrefix', 'Rule', 'Subdomain', 'Submount',
+    'HandlerPrefix', 'Map', 'NamePrefix', 'Rule', 'RuleBuilder', 'RuleIndex',
+    'Subdomain', 'Submount', 'Tenant', 'TenantRouter',
 ]
 
+# Characters that make urlparse.urljoin() change a relative path.
+_URLJOIN_CHARS = frozenset('.:;#')
+
+# A host pattern: a variable or wildcard in the first label of a domain.
+_host_pattern_re = re.compile(r'^(?:<([a-zA-Z_][a-zA-Z0-9_]*)>|\*)\.(.+)$')
+
 
 class Router(object):
     def __init__(self, app, rules=None):
@@ -31,6 +48,30 @@ class Router(object):
         self.app = app
         self.handlers = {}
         self.map = self.create_map(rules)
+        #: Lock held while the URL map is sorted. See :meth:`update`.
+        self.lock = threading.Lock()
+        #: Paths that recently failed to match, mapped to the map
+        #: generation, exception class and arguments to raise again. See
+        #: :meth:`match`.
+        self.negative_cache = {}
+        self.negative_cache_size = app.config['tipfy'][
+            'negative_cache_size']
+        #: Bound URL adapter state by host, script name, scheme and server
+        #: name. See :meth:`bind`.
+        self.adapter_cache = {}
+        self.adapter_cache_size = app.config['tipfy']['adapter_cache_size']
+        #: Interval in seconds to reorder rules by hits. See
+        #: :meth:`reorder_rules`.
+        self.reorder_interval = app.config['tipfy']['rule_reorder_interval']
+        #: Match count and latency per rule, keyed by rule id, or None if
+        #: disabled. See :meth:`get_rule_stats`.
+        self.rule_stats = None
+        if app.config['tipfy']['rule_stats'] or self.reorder_interval:
+            self.rule_stats = {}
+
+        self.next_reorder = None
+        if self.reorder_interval:
+            self.next_reorder = timer() + self.reorder_interval
 
     def add(self, rule):
         """Adds a rule to the URL map.
@@ -45,6 +86,22 @@ class Router(object):
         else:
             self.map.add(rule)
 
+    def update(self):
+        """Sorts the URL map and rebuilds its index after rules were added.
+        This is called automatically by :meth:`match`. See :meth:`Map.update`.
+
+        Requests matched while the map is updated by another thread wait for
+        the update, because the map is only marked as updated once the new
+        index is in place. The negative cache is cleared, as new rules may
+        match paths that failed before.
+        """
+        self.lock.acquire()
+        try:
+            self.map.update()
+            self.negative_cache.clear()
+        finally:
+            self.lock.release()
+
     def match(self, request):
         """Matches registered :class:`Rule` definitions against the current
         request and returns the matched rule and rule arguments.
@@ -56,21 +113,199 @@ class Router(object):
         ``MethodNotAllowed`` or ``RequestRedirect``. The WSGI app will handle
         raised exceptions.
 
+        If the ``negative_cache_size`` config key is set, paths that raise
+        ``NotFound`` or ``MethodNotAllowed`` are kept in a bounded cache, so
+        that repeated misses don't scan the whole map again. Entries are
+        only used while the map is not updated, so rules added to the router
+        or directly to the map invalidate them.
+
+        If the ``rule_stats`` config key is set, the match count and latency
+        of the matched rule are recorded. See :meth:`get_rule_stats`.
+
         :param request:
             A :class:`tipfy.Request` instance.
         :returns:
             A tuple ``(rule, rule_args)`` with the matched rule and rule
             arguments.
         """
+        if self.map._remap:
+            self.update()
+
         # Bind the URL map to the current request
-        request.url_adapter = self.map.bind_to_environ(request.environ,
-            server_name=self.get_server_name(request))
+        adapter = request.url_adapter = self.bind(request)
+
+        if self.rule_stats is not None:
+            start = timer()
+
+        if not self.negative_cache_size:
+            match = request.rule, request.rule_args = adapter.match(
+                return_rule=True)
+        else:
+            # Read before matching: a miss stored by a request that was
+            # matched against an older map is never used.
+            generation = self.map.generation
+            key = (adapter.subdomain, adapter.path_info, request.method)
+            miss = self.negative_cache.get(key)
+            if miss is not None and miss[0] == generation:
+                raise miss[1](*miss[2])
+
+            try:
+                # Match the path against registered rules.
+                match = request.rule, request.rule_args = adapter.match(
+                    return_rule=True)
+            except NotFound:
+                self.cache_miss(key, generation, NotFound, ())
+                raise
+            except MethodNotAllowed, e:
+                self.cache_miss(key, generation, MethodNotAllowed,
+                    (e.valid_methods,))
+                raise
+
+        if self.rule_stats is not None:
+            self.record_match(match[0], timer() - start)
 
-        # Match the path against registered rules.
-        match = request.rule, request.rule_args = request.url_adapter.match(
-            return_rule=True)
         return match
 
+    def record_match(self, rule, duration):
+        """Adds a match to the rule statistics, and reorders the rules if
+        the ``rule_reorder_interval`` config key is set and the interval
+        has passed.
+
+        :param rule:
+            The matched :class:`Rule`.
+        :param duration:
+            Time spent matching, in seconds.
+        """
+        stats = self.rule_stats
+        entry = stats.get(id(rule))
+        if entry is None:
+            entry = stats.setdefault(id(rule), [rule, 0, 0.0, 0.0])
+
+        # Counters may miss a few concurrent updates; that is fine for
+        # statistics and avoids a lock.
+        entry[1] += 1
+        entry[2] += duration
+        if duration > entry[3]:
+            entry[3] = duration
+
+        if self.next_reorder is not None and timer() >= self.next_reorder:
+            self.next_reorder = timer() + self.reorder_interval
+            self.reorder_rules()
+
+    def get_rule_stats(self):
+        """Returns the match statistics of the rules matched since the
+        router was created or :meth:`reset_rule_stats` was called. They are
+        recorded when the ``rule_stats`` or ``rule_reorder_interval`` config
+        keys are set.
+
+        :returns:
+            A list of dictionaries with the keys `name`, `rule`, `subdomain`,
+            `methods`, `count`, `mean` and `max` (match latency in
+            milliseconds) and `position` (in match order), sorted by count.
+        """
+        positions = dict((id(rule), position) for position, rule in
+            enumerate(self.map._rules))
+        res = []
+        for rule_id, (rule, count, total, longest) in \
+            (self.rule_stats or {}).items():
+            res.append({
+                'name':      rule.name,
+                'rule':      rule.rule,
+                'subdomain': rule.subdomain,
+                'methods':   rule.methods and sorted(rule.methods),
+                'count':     count,
+                'mean':      count and total / count * 1000 or 0.0,
+                'max':       longest * 1000,
+                'position':  positions.get(rule_id),
+            })
+
+        res.sort(key=lambda item: (-item['count'], item['position']))
+        return res
+
+    def reset_rule_stats(self):
+        """Discards the rule match statistics."""
+        if self.rule_stats is not None:
+            self.rule_stats = {}
+
+    def reorder_rules(self):
+        """Reorders the URL map so that the most matched rules are tested
+        first. Only rules that can't match the same paths change places, so
+        the rule that matches a path is always the same. See
+        :meth:`Map.reorder`.
+        """
+        hits = dict((rule_id, entry[1]) for rule_id, entry in
+            (self.rule_stats or {}).items())
+        self.lock.acquire()
+        try:
+            self.map.reorder(hits)
+        finally:
+            self.lock.release()
+
+    def bind(self, request):
+        """Returns a URL adapter bound to the request, used to match and
+        build URLs.
+
+        Binding parses the host, script name and subdomain, which are the
+        same for most requests. The bound values are kept in a bounded cache
+        keyed by the environment values they derive from, so that a cached
+        request only needs a new adapter with its path and method. If the
+        cache is full, an arbitrary entry is discarded: the host is sent by
+        clients, so the number of keys is not limited.
+
+        :param request:
+            A :class:`tipfy.Request` instance.
+        :returns:
+            A ``werkzeug.routing.MapAdapter`` instance.
+        """
+        environ = request.environ
+        server_name = self.get_server_name(request)
+        if not self.adapter_cache_size:
+            return self.map.bind_to_environ(environ, server_name=server_name)
+
+        key = (environ.get('HTTP_HOST'), environ.get('SERVER_NAME'),
+            environ.get('SERVER_PORT'), environ.get('SCRIPT_NAME'),
+            environ['wsgi.url_scheme'], server_name)
+        state = self.adapter_cache.get(key)
+        if state is not None:
+            return MapAdapter(self.map, state[0], state[1], state[2],
+                state[3], environ.get('PATH_INFO'), environ['REQUEST_METHOD'])
+
+        adapter = self.map.bind_to_environ(environ, server_name=server_name)
+        cache = self.adapter_cache
+        while len(cache) >= self.adapter_cache_size:
+            try:
+                cache.popitem()
+            except KeyError:
+                # Emptied by another thread.
+                break
+
+        cache[key] = (adapter.server_name, adapter.script_name,
+            adapter.subdomain, adapter.url_scheme)
+        return adapter
+
+    def cache_miss(self, key, generation, exception, args):
+        """Stores a path that failed to match in the negative cache. If the
+        cache is full, an arbitrary entry is discarded.
+
+        :param key:
+            A tuple ``(subdomain, path_info, method)``.
+        :param generation:
+            The :attr:`Map.generation` the path was matched against.
+        :param exception:
+            The exception class raised for the path.
+        :param args:
+            Arguments to instantiate the exception.
+        """
+        cache = self.negative_cache
+        while len(cache) >= self.negative_cache_size:
+            try:
+                cache.popitem()
+            except KeyError:
+                # Emptied by another thread.
+                break
+
+        cache[key] = (generation, exception, args)
+
     def dispatch(self, request, match, method=None):
         """Dispatches a request. This instantiates and calls a
         :class:`tipfy.RequestHandler` based on the matched :class:`Rule`.
@@ -85,7 +320,14 @@ class Router(object):
         :returns:
             A :class:`tipfy.Response` instance.
         """
-        cls, method, kwargs = self.get_dispatch_spec(request, match, method)
+        if request.trace is None:
+            spec = self.get_dispatch_spec(request, match, method)
+        else:
+            start = timer()
+            spec = self.get_dispatch_spec(request, match, method)
+            request.trace.add('dispatch_spec', start)
+
+        cls, method, kwargs = spec
 
         # Instantiate the handler.
         local.current_handler = handler = cls(self.app, request)
@@ -125,15 +367,7 @@ class Router(object):
         rule, rule_args = match
 
         if isinstance(rule.handler, basestring):
-            parts = rule.handler.rsplit(':', 1)
-            handler = parts[0]
-            if len(parts) > 1:
-                rule.handler_method = parts[1]
-
-            if handler not in self.handlers:
-                self.handlers[handler] = import_string(handler)
-
-            rule.handler = self.handlers[handler]
+            self.resolve_handler(rule)
 
         if not method:
             request_method = request.method.lower().replace('-', '_')
@@ -150,6 +384,34 @@ class Router(object):
 
         return rule.handler, method, rule_args
 
+    def resolve_handler(self, rule):
+        """Imports the handler of a rule if it is defined as a string,
+        replacing ``rule.handler`` by the imported class. If the handler
+        string is defined using the ``Handler:method`` notation, the method
+        is stored in ``rule.handler_method``.
+
+        :param rule:
+            A :class:`Rule` instance.
+        :returns:
+            The handler class.
+        """
+        handler = rule.handler
+        if isinstance(handler, basestring):
+            # Rules are shared by concurrent requests: the class is set last,
+            # as other threads check it to know if the rule was resolved.
+            parts = handler.rsplit(':', 1)
+            handler = self.handlers.get(parts[0])
+            if handler is None:
+                handler = self.handlers.setdefault(parts[0],
+                    import_string(parts[0]))
+
+            if len(parts) > 1:
+                rule.handler_method = parts[1]
+
+            rule.handler = handler
+
+        return handler
+
     def build(self, request, name, kwargs):
         """Returns a URL for a named :class:`Rule`. This is the central place
         to build URLs for an app. It is used by :meth:`RequestHandler.url_for`,
@@ -177,6 +439,26 @@ class Router(object):
         :returns:
             An absolute or relative URL.
         """
+        return self.build_many(request, name, [None], kwargs)[0]
+
+    def build_many(self, request, name, values, kwargs):
+        """Returns URLs for a named :class:`Rule`, one for each set of
+        values. This is faster than calling :meth:`build` for each URL, e.g.,
+        to build pagination or list links.
+
+        :param request:
+            The current request object.
+        :param name:
+            The rule name.
+        :param values:
+            A list of dictionaries with the values for each URL, updating
+            the values in `kwargs`.
+        :param kwargs:
+            Values shared by all URLs, including the keywords with special
+            meaning described in :meth:`build`.
+        :returns:
+            A list of absolute or relative URLs.
+        """
         full = kwargs.pop('_full', False)
         method = kwargs.pop('_method', None)
         scheme = kwargs.pop('_scheme', None)
@@ -186,25 +468,54 @@ class Router(object):
         if scheme or netloc:
             full = False
 
-        url = request.url_adapter.build(name, values=kwargs, method=method,
-            force_external=full)
+        items = []
+        for value in values:
+            if value:
+                value = dict(kwargs, **value)
+            else:
+                value = kwargs
+
+            items.append(value)
+
+        adapter = self.get_build_adapter(request, name)
+        if isinstance(adapter, MapAdapter):
+            urls = adapter.build_many(name, items, method=method,
+                force_external=full)
+        else:
+            urls = [adapter.build(name, values=item, method=method,
+                force_external=full) for item in items]
 
         if scheme or netloc:
-            url = '%s://%s%s' % (scheme or 'http', netloc or request.host, url)
+            prefix = '%s://%s' % (scheme or 'http', netloc or request.host)
+            urls = [prefix + url for url in urls]
 
         if anchor:
-            url += '#%s' % url_quote(anchor)
+            anchor = '#%s' % url_quote(anchor)
+            urls = [url + anchor for url in urls]
 
-        return url
+        return urls
+
+    def get_build_adapter(self, request, name):
+        """Returns the URL adapter used to build URLs for a rule name. By
+        default it is the adapter bound to the request by :meth:`match`.
+
+        :param request:
+            The current request object.
+        :param name:
+            The rule name.
+        :returns:
+            A ``werkzeug.routing.MapAdapter`` instance.
+        """
+        return request.url_adapter
 
     def create_map(self, rules=None):
-        """Returns a ``werkzeug.routing.Map`` instance with the given
-        :class:`Rule` definitions.
+        """Returns a :class:`Map` instance with the given :class:`Rule`
+        definitions.
 
         :param rules:
             A list of :class:`Rule` definitions.
         :returns:
-            A ``werkzeug.routing.Map`` instance.
+            A :class:`Map` instance.
         """
         return Map(rules, default_subdomain=self.get_default_subdomain())
 
@@ -231,6 +542,900 @@ class Router(object):
         return self.app.config['tipfy']['server_name']
 
 
+class TenantRouter(Router):
+    """A router that keeps a separate URL map for each tenant host, for apps
+    that serve many customer domains or subdomains. Instead of adding
+    :class:`Subdomain` rules for every tenant to a single map, which are all
+    tested on each request, rules are registered for a host or host
+    pattern::
+
+        class MyApp(Tipfy):
+            router_class = TenantRouter
+
+        app = MyApp(rules=[
+            Rule('/about', name='about', handler='myapp.AboutHandler'),
+        ])
+        app.router.add_tenant('<tenant>.example.com', 'myapp.urls.get_rules')
+        app.router.add_tenant('www.customer.com', [
+            Rule('/', name='home', handler='myapp.HomeHandler'),
+        ], tenant='customer')
+
+    The tenant of a request is found by the request host using dictionary
+    lookups, so the cost doesn't depend on the number of tenants. The map of
+    a host is built on its first request and kept in a bounded cache (see
+    the ``tenant_cache_size`` config key): maps of hosts that are not
+    requested are discarded and built again when needed. Paths that don't
+    match a tenant rule are matched against the global rules.
+    """
+    #: Maximum time in seconds a tenant map is kept in the cache.
+    tenant_map_timeout = 86400
+
+    def __init__(self, app, rules=None):
+        """Initializes the router.
+
+        :param app:
+            A :class:`tipfy.Tipfy` instance.
+        :param rules:
+            A list of initial :class:`Rule` instances, matched for all hosts.
+        """
+        super(TenantRouter, self).__init__(app, rules)
+        #: Tenants registered for a host name.
+        self.hosts = {}
+        #: Tenants registered for a host pattern, keyed by domain.
+        self.patterns = {}
+        #: Rules added at runtime, keyed by host name or host pattern.
+        self.tenant_rules = {}
+        #: Tenant maps by host name. See :meth:`get_tenant_map`.
+        self.tenant_maps = LRUCache(app.config['tipfy']['tenant_cache_size'],
+            default_timeout=self.tenant_map_timeout)
+
+    def add_tenant(self, host, rules, **defaults):
+        """Registers the rules of a tenant, replacing the ones registered
+        for the same host before.
+
+        :param host:
+            A host name, e.g., ``www.customer.com``, or a host pattern with a
+            variable in place of the subdomain, e.g., ``<tenant>.example.com``.
+            The subdomain is passed to the handlers of the tenant rules in a
+            keyword argument with the variable name. Use ``*.example.com`` to
+            not pass it.
+        :param rules:
+            A list of :class:`Rule` definitions, or a callable or import
+            string of a callable that receives the tenant arguments as
+            keyword arguments and returns the rules. It is called when the
+            map of a host is built, so rules can be loaded per tenant.
+        :param defaults:
+            Keyword arguments passed to the handlers of the tenant rules.
+        """
+        key, variable, domain = _parse_host(host)
+        tenant = Tenant(key, rules, variable=variable, defaults=defaults)
+        if domain is None:
+            self.hosts[key] = tenant
+        else:
+            self.patterns[domain] = tenant
+
+    def add(self, rule, host=None):
+        """Adds a rule to the URL map. Rules added to a tenant are added to
+        its cached maps when they are used next, without rebuilding them or
+        the global map.
+
+        :param rule:
+            A :class:`Rule` or rule factory instance or a list of rules
+            to be added.
+        :param host:
+            If set, the rule is added to the tenant rules of this host name
+            or host pattern (see :meth:`add_tenant`) instead of the global
+            map. For a host name matched by a pattern, the rule is only
+            added for that host. A tenant must be registered for the host
+            first, or ``ValueError`` is raised.
+        """
+        if host is None:
+            return super(TenantRouter, self).add(rule)
+
+        if not isinstance(rule, list):
+            rule = [rule]
+
+        key, variable, domain = _parse_host(host)
+        if domain is None:
+            known = self.get_tenant(key)[0] is not None
+        else:
+            known = domain in self.patterns
+
+        if not known:
+            raise ValueError('No tenant is registered for host %r.' % host)
+
+        self.lock.acquire()
+        try:
+            self.tenant_rules.setdefault(key, []).extend(rule)
+        finally:
+            self.lock.release()
+
+    def get_tenant(self, name):
+        """Returns the tenant for a host name.
+
+        :param name:
+            A lowercase host name, without port.
+        :returns:
+            A tuple ``(tenant, args)`` with the :class:`Tenant` and the
+            arguments for its handlers, or ``(None, None)``.
+        """
+        tenant = self.hosts.get(name)
+        if tenant is not None:
+            return tenant, tenant.defaults
+
+        parts = name.split('.', 1)
+        if len(parts) == 2:
+            tenant = self.patterns.get(parts[1])
+            if tenant is not None:
+                if tenant.variable is None:
+                    return tenant, tenant.defaults
+
+                args = dict(tenant.defaults)
+                args[tenant.variable] = parts[0]
+                return tenant, args
+
+        return None, None
+
+    def get_tenant_map(self, request):
+        """Returns the tenant map for the request host, building it if it
+        is not cached and adding rules added since it was built.
+
+        :param request:
+            A :class:`tipfy.Request` instance.
+        :returns:
+            A tuple ``(map, args)`` with the :class:`Map` and the arguments
+            for the tenant handlers, or ``(None, None)`` if the host has no
+            tenant.
+        """
+        name = request.host.split(':', 1)[0].lower()
+        tenant, args = self.get_tenant(name)
+        if tenant is None:
+            return None, None
+
+        entry = self.tenant_maps.get(name)
+        if entry is None or entry[1] is not tenant:
+            # Built without locking; if two threads build the same map,
+            # one of them is discarded.
+            entry = [self.create_tenant_map(tenant, args), tenant, 0, 0]
+            self.tenant_maps.set(name, entry)
+
+        map = entry[0]
+        tenant_rules = self.tenant_rules.get(tenant.key, ())
+        host_rules = ()
+        if name != tenant.key:
+            host_rules = self.tenant_rules.get(name, ())
+
+        if entry[2] < len(tenant_rules) or entry[3] < len(host_rules) or \
+            map._remap:
+            self.lock.acquire()
+            try:
+                _add_copies(map, tenant_rules[entry[2]:])
+                _add_copies(map, host_rules[entry[3]:])
+                entry[2] = len(tenant_rules)
+                entry[3] = len(host_rules)
+                map.update()
+            finally:
+                self.lock.release()
+
+        return map, args
+
+    def create_tenant_map(self, tenant, args):
+        """Returns a new :class:`Map` with the rules of a tenant. Rules
+        added at runtime are added by :meth:`get_tenant_map`.
+
+        :param tenant:
+            A :class:`Tenant` instance.
+        :param args:
+            The arguments for the tenant handlers.
+        :returns:
+            A :class:`Map` instance.
+        """
+        map = Map(default_subdomain='')
+        # Rules can only be bound to one map, so each host gets copies.
+        _add_copies(map, tenant.get_rules(args))
+        map.update()
+        return map
+
+    def bind_tenant(self, request, map):
+        """Returns a URL adapter for a tenant map bound to the request.
+
+        :param request:
+            A :class:`tipfy.Request` instance.
+        :param map:
+            The tenant :class:`Map`.
+        :returns:
+            A :class:`MapAdapter` instance.
+        """
+        environ = request.environ
+        return map.bind(request.host.lower(), environ.get('SCRIPT_NAME'),
+            None, environ['wsgi.url_scheme'], environ['REQUEST_METHOD'],
+            environ.get('PATH_INFO'))
+
+    def match(self, request):
+        """Matches the tenant rules for the request host, if any, and then
+        the global rules. See :meth:`Router.match`.
+
+        The arguments of the tenant are added to the arguments of a matched
+        tenant rule. If the tenant rules raise ``NotFound`` or
+        ``MethodNotAllowed``, the global rules are matched. If they don't
+        match either, a ``MethodNotAllowed`` lists the methods allowed by
+        both.
+
+        :param request:
+            A :class:`tipfy.Request` instance.
+        :returns:
+            A tuple ``(rule, rule_args)`` with the matched rule and rule
+            arguments.
+        """
+        map, args = self.get_tenant_map(request)
+        if map is None:
+            return super(TenantRouter, self).match(request)
+
+        adapter = self.bind_tenant(request, map)
+        if self.rule_stats is not None:
+            start = timer()
+
+        try:
+            rule, rule_args = adapter.match(return_rule=True)
+        except NotFound:
+            return super(TenantRouter, self).match(request)
+        except MethodNotAllowed, e:
+            # A global rule may accept the method for the same path.
+            try:
+                return super(TenantRouter, self).match(request)
+            except NotFound:
+                pass
+            except MethodNotAllowed, other:
+                e.valid_methods = sorted(set(e.valid_methods) |
+                    set(other.valid_methods))
+
+            raise e
+
+        if args:
+            rule_args = dict(args, **rule_args)
+
+        request.url_adapter = adapter
+        match = request.rule, request.rule_args = rule, rule_args
+        if self.rule_stats is not None:
+            self.record_match(rule, timer() - start)
+
+        return match
+
+    def get_build_adapter(self, request, name):
+        """Returns the URL adapter used to build URLs for a rule name: the
+        tenant adapter if the rule is a tenant rule for the request host,
+        and the global adapter otherwise.
+
+        :param request:
+            The current request object.
+        :param name:
+            The rule name.
+        :returns:
+            A ``werkzeug.routing.MapAdapter`` instance.
+        """
+        adapter = request.url_adapter
+        if adapter is not None and name in adapter.map._rules_by_endpoint:
+            return adapter
+
+        map = self.get_tenant_map(request)[0]
+        if map is not None and name in map._rules_by_endpoint:
+            return self.bind_tenant(request, map)
+
+        if adapter is not None and adapter.map is self.map:
+            return adapter
+
+        return self.bind(request)
+
+
+class Tenant(object):
+    """The rules of a host or host pattern registered in a
+    :class:`TenantRouter`.
+    """
+    def __init__(self, key, rules, variable=None, defaults=None):
+        """Initializes the tenant.
+
+        :param key:
+            The host name, or ``*.`` followed by the domain for a pattern.
+        :param rules:
+            A list of :class:`Rule` definitions, or a callable or import
+            string of a callable that returns them.
+        :param variable:
+            Name of the handler argument set to the subdomain, or None.
+        :param defaults:
+            A dictionary of arguments passed to the tenant handlers.
+        """
+        self.key = key
+        self.rules = rules
+        self.variable = variable
+        self.defaults = defaults or {}
+
+    def get_rules(self, args):
+        """Returns the tenant rules.
+
+        :param args:
+            The arguments for the tenant handlers, passed to a rules
+            callable.
+        :returns:
+            A list of :class:`Rule` definitions.
+        """
+        rules = self.rules
+        if isinstance(rules, basestring):
+            rules = self.rules = import_string(rules)
+
+        if callable(rules):
+            rules = rules(**args)
+
+        return rules
+
+
+class Map(BaseMap):
+    """A ``werkzeug.routing.Map`` that keeps a :class:`RuleIndex` of its
+    rules, so that matching a path doesn't test every rule.
+    """
+    #: Maximum number of compiled builder lists kept. See
+    #: :meth:`get_builders`.
+    builder_cache_size = 1000
+
+    def __init__(self, *args, **kwargs):
+        #: Lock held while rules are added or sorted. See :meth:`update`.
+        self.lock = threading.RLock()
+        #: A :class:`RuleIndex` of the sorted rules, built by :meth:`update`.
+        self._index = None
+        #: Compiled builders, cleared by :meth:`update`.
+        self._builders = {}
+        #: Incremented each time the rules are sorted by :meth:`update`.
+        self.generation = 0
+        #: Match counts by rule id used to order the rules. See
+        #: :meth:`reorder`.
+        self.hits = None
+        self._sorted_rules = []
+        self._conflicts = None
+        super(Map, self).__init__(*args, **kwargs)
+
+    def add(self, rulefactory):
+        """Adds a rule or rule factory to the map. See
+        ``werkzeug.routing.Map.add``.
+        """
+        self.lock.acquire()
+        try:
+            super(Map, self).add(rulefactory)
+        finally:
+            self.lock.release()
+
+    def update(self):
+        """Sorts the rules and rebuilds the index after rules were added.
+
+        Werkzeug sorts the rule lists in place, and a request matched by
+        another thread at the same time would see them empty. Here sorted
+        copies and a new index are built first and then replace the current
+        ones, so requests being matched keep using the old ones. The map is
+        only marked as updated after that, holding :attr:`lock`, so a
+        request that doesn't see the mark sees the new index.
+        """
+        if not self._remap:
+            return
+
+        self.lock.acquire()
+        try:
+            if not self._remap:
+                # Updated by another thread while waiting for the lock.
+                return
+
+            rules = sorted(self._rules, lambda a, b: a.match_compare(b))
+            rules_by_endpoint = dict((endpoint, sorted(rules,
+                lambda a, b: a.build_compare(b))) for endpoint, rules in
+                self._rules_by_endpoint.items())
+            self._rules_by_endpoint = rules_by_endpoint
+            self._builders = {}
+            self._sorted_rules = rules
+            self.set_rules(rules)
+            self.generation += 1
+            self._remap = False
+        finally:
+            self.lock.release()
+
+    def reorder(self, hits):
+        """Orders the rules by match count, keeping the relative order of
+        rules that can match the same paths. The order is kept when rules
+        are added.
+
+        :param hits:
+            A dictionary mapping rule ids to match counts.
+        """
+        self.lock.acquire()
+        try:
+            self.update()
+            self.hits = hits
+            self.set_rules(self._sorted_rules)
+        finally:
+            self.lock.release()
+
+    def set_rules(self, rules):
+        """Sets the rules used for matching and builds their index. If
+        :attr:`hits` is set, rules are ordered by match count, but a rule is
+        never moved before a rule that precedes it and can match the same
+        paths: ambiguous orderings are left untouched.
+
+        :param rules:
+            The rules sorted by ``match_compare()``.
+        """
+        if self.hits:
+            if self._conflicts is None or self._conflicts[0] is not rules:
+                self._conflicts = (rules, RuleIndex.get_conflicts(rules))
+
+            conflicts = self._conflicts[1]
+
+            # Rules that must be placed before each rule.
+            pending = [len(c) for c in conflicts]
+            followers = [[] for rule in rules]
+            for position, preceding in enumerate(conflicts):
+                for other in preceding:
+                    followers[other].append(position)
+
+            hits = self.hits
+            ready = [(-hits.get(id(rules[p]), 0), p) for p in
+                range(len(rules)) if not pending[p]]
+            heapq.heapify(ready)
+            ordered = []
+            while ready:
+                position = heapq.heappop(ready)[1]
+                ordered.append(rules[position])
+                for follower in followers[position]:
+                    pending[follower] -= 1
+                    if not pending[follower]:
+                        heapq.heappush(ready, (-hits.get(id(rules[follower]),
+                            0), follower))
+
+            rules = ordered
+
+        index = RuleIndex(rules)
+        self._rules = rules
+        # Replaced last: requests being matched only use the index.
+        self._index = index
+
+    def get_builders(self, endpoint, method, default_method, keys):
+        """Returns the builders that can build a URL for an endpoint with
+        the given argument names, in the order Werkzeug tries the rules.
+
+        :param endpoint:
+            The rule endpoint.
+        :param method:
+            The method passed to build the URL, or None.
+        :param default_method:
+            The adapter default method, tried first if `method` is None.
+        :param keys:
+            A frozenset with the names of the values to build the URL.
+        :returns:
+            A list of tuples ``(builder, defaults, has_query)``: a
+            :class:`RuleBuilder`, the rule defaults that must be equal to
+            the values or None, and True if values are appended as query
+            arguments.
+        """
+        cache_key = (endpoint, method, default_method, keys)
+        # Taken before the rules: update() replaces the rules first, so
+        # builders for old rules are never stored in a new cache.
+        cache = self._builders
+        builders = cache.get(cache_key)
+        if builders is not None:
+            return builders
+
+        rules = []
+        methods = [method]
+        if method is None:
+            methods.insert(0, default_method)
+
+        for method in methods:
+            for rule in self._rules_by_endpoint.get(endpoint, ()):
+                # Rules compare equal by path: check identity.
+                if [r for r in rules if r is rule]:
+                    continue
+
+                if method is not None and rule.methods is not None and \
+                    method not in rule.methods:
+                    continue
+
+                required = rule.arguments - set(rule.defaults or ())
+                if required.issubset(keys):
+                    rules.append(rule)
+
+        builders = []
+        for rule in rules:
+            defaults = None
+            if rule.defaults is not None and rule.arguments.issubset(keys):
+                defaults = rule.defaults.items()
+
+            builders.append((RuleBuilder(rule), defaults,
+                bool(keys - rule.arguments)))
+
+        if len(cache) < self.builder_cache_size:
+            cache[cache_key] = builders
+
+        return builders
+
+    def bind(self, server_name, script_name=None, subdomain=None,
+        url_scheme='http', default_method='GET', path_info=None):
+        """Returns a :class:`MapAdapter` for the given details. See
+        ``werkzeug.routing.Map.bind``.
+        """
+        if subdomain is None:
+            subdomain = self.default_subdomain
+
+        if script_name is None:
+            script_name = '/'
+
+        return MapAdapter(self, server_name, script_name, subdomain,
+            url_scheme, path_info, default_method)
+
+    def bind_to_environ(self, environ, server_name=None, subdomain=None):
+        """Returns a :class:`MapAdapter` for a WSGI environment. See
+        ``werkzeug.routing.Map.bind_to_environ``.
+        """
+        adapter = super(Map, self).bind_to_environ(environ,
+            server_name=server_name, subdomain=subdomain)
+        return MapAdapter(self, adapter.server_name, adapter.script_name,
+            adapter.subdomain, adapter.url_scheme, adapter.path_info,
+            adapter.default_method)
+
+
+class MapAdapter(BaseMapAdapter):
+    """A ``werkzeug.routing.MapAdapter`` that only tests the rules that the
+    :class:`RuleIndex` of the map selected for the path. Matching otherwise
+    works exactly like in Werkzeug, including strict slashes, redirects and
+    ``MethodNotAllowed``.
+    """
+    def match(self, path_info=None, method=None, return_rule=False):
+        map = self.map
+        if not isinstance(map, Map):
+            return super(MapAdapter, self).match(path_info, method,
+                return_rule)
+
+        map.update()
+        index = map._index
+
+        if path_info is None:
+            path_info = self.path_info
+
+        if not isinstance(path_info, unicode):
+            path_info = path_info.decode(map.charset, 'ignore')
+
+        method = (method or self.default_method).upper()
+        path = u'%s|/%s' % (self.subdomain, path_info.lstrip('/'))
+        have_match_for = set()
+        for position, rule in index.get_rules(path):
+            try:
+                rv = rule.match(path)
+            except RequestSlash:
+                raise RequestRedirect(str('%s://%s%s%s/%s/' % (
+                    self.url_scheme,
+                    self.subdomain and self.subdomain + '.' or '',
+                    self.server_name,
+                    self.script_name[:-1],
+                    url_quote(path_info.lstrip('/'), map.charset)
+                )))
+
+            if rv is None:
+                continue
+
+            if rule.methods is not None and method not in rule.methods:
+                have_match_for.update(rule.methods)
+                continue
+
+            if map.redirect_defaults:
+                for r in map._rules_by_endpoint[rule.endpoint]:
+                    if r.provides_defaults_for(rule) and \
+                        r.suitable_for(rv, method):
+                        rv.update(r.defaults)
+                        subdomain, path = r.build(rv)
+                        raise RequestRedirect(str('%s://%s%s%s/%s' % (
+                            self.url_scheme,
+                            subdomain and subdomain + '.' or '',
+                            self.server_name,
+                            self.script_name[:-1],
+                            url_quote(path.lstrip('/'), map.charset)
+                        )))
+
+            if rule.redirect_to is not None:
+                if isinstance(rule.redirect_to, basestring):
+                    def _handle_match(match):
+                        value = rv[match.group(1)]
+                        return rule._converters[match.group(1)].to_url(value)
+
+                    redirect_url = _simple_rule_re.sub(_handle_match,
+                        rule.redirect_to)
+                else:
+                    redirect_url = rule.redirect_to(self, **rv)
+
+                raise RequestRedirect(str(urljoin('%s://%s%s%s' % (
+                    self.url_scheme,
+                    self.subdomain and self.subdomain + '.' or '',
+                    self.server_name,
+                    self.script_name
+                ), redirect_url)))
+
+            if return_rule:
+                return rule, rv
+            else:
+                return rule.endpoint, rv
+
+        if have_match_for:
+            raise MethodNotAllowed(valid_methods=list(have_match_for))
+
+        raise NotFound()
+
+    def build(self, endpoint, values=None, method=None, force_external=False,
+        append_unknown=True):
+        """Builds a URL using the compiled builders of the map. The URL is
+        the same that Werkzeug builds. See
+        ``werkzeug.routing.MapAdapter.build``.
+        """
+        if not append_unknown or getattr(self.map, '_index', None) is None:
+            return super(MapAdapter, self).build(endpoint, values, method,
+                force_external, append_unknown)
+
+        return self.build_many(endpoint, [values], method, force_external)[0]
+
+    def build_many(self, endpoint, values, method=None, force_external=False):
+        """Builds a URL for an endpoint for each set of values.
+
+        :param endpoint:
+            The rule endpoint.
+        :param values:
+            A list of dictionaries with the values for each URL.
+        :param method:
+            The method of the rule, if there are different URLs for different
+            methods on the same endpoint.
+        :param force_external:
+            True to build absolute URLs.
+        :returns:
+            A list of URLs.
+        """
+        map = self.map
+        map.update()
+        default_method = method is None and self.default_method or None
+        script_name = self.script_name
+        urls = []
+        for items in values:
+            if items:
+                if isinstance(items, MultiDict):
+                    items = dict((k, v) for k, v in
+                        items.iteritems(multi=True) if v is not None)
+                else:
+                    items = dict((k, v) for k, v in items.iteritems()
+                        if v is not None)
+            else:
+                items = {}
+
+            for builder, defaults, has_query in map.get_builders(endpoint,
+                method, default_method, frozenset(items)):
+                if defaults is not None and [key for key, value in defaults
+                    if value != items[key]]:
+                    continue
+
+                rv = builder.build(items)
+                if rv is not None:
+                    break
+            else:
+                raise BuildError(endpoint, items, method)
+
+            subdomain, path = rv
+            if has_query:
+                query_vars = MultiDict(items)
+                for key in builder.rule.arguments:
+                    if key in query_vars:
+                        del query_vars[key]
+
+                path += '?' + url_encode(query_vars, map.charset,
+                    sort=map.sort_parameters, key=map.sort_key)
+
+            path = path.lstrip('/')
+            if not force_external and subdomain == self.subdomain:
+                if script_name == '/' and not _URLJOIN_CHARS.intersection(
+                    path.split('?', 1)[0]):
+                    # Same result as urljoin(), which is slow.
+                    urls.append(str('/' + path))
+                else:
+                    urls.append(str(urljoin(script_name, path)))
+            else:
+                urls.append(str('%s://%s%s%s/%s' % (
+                    self.url_scheme,
+                    subdomain and subdomain + '.' or '',
+                    self.server_name,
+                    script_name[:-1],
+                    path
+                )))
+
+        return urls
+
+
+class RuleBuilder(object):
+    """Builds the path of a rule from a format string compiled from the
+    rule definition, with the converters of each argument.
+    """
+    def __init__(self, rule):
+        """Compiles the rule.
+
+        :param rule:
+            A bound :class:`Rule`.
+        """
+        self.rule = rule
+        #: Tuples ``(name, converter)`` for the rule variables, in order.
+        self.converters = []
+        parts = []
+        for is_dynamic, data in rule._trace:
+            if is_dynamic:
+                parts.append(u'%s')
+                self.converters.append((data, rule._converters[data]))
+            else:
+                parts.append(data.replace(u'%', u'%%'))
+
+        #: Format string for ``subdomain|path``.
+        self.template = u''.join(parts)
+
+    def build(self, values):
+        """Returns the subdomain and path for the given values.
+
+        :param values:
+            A dictionary with the rule variables.
+        :returns:
+            A list ``[subdomain, path]``, or None if a value is not valid
+            for its converter.
+        """
+        try:
+            args = tuple([converter.to_url(values[name]) for name, converter
+                in self.converters])
+        except ValidationError:
+            return None
+
+        return (self.template % args).split(u'|', 1)
+
+
+class RuleIndex(object):
+    """Selects the rules that can match a path, so that only their regular
+    expressions are tested instead of the ones of all rules in the map.
+
+    Rules without converters are stored in a dictionary by the paths they
+    match, so they are found with a single lookup. Other rules are stored in
+    a tree of path segments by the static part of their path before the
+    first converter: rules defined in a :class:`Submount` share a branch and
+    are only tested for paths under it. Rules with a converter in the
+    subdomain are stored in the tree root and tested for all paths.
+    """
+    def __init__(self, rules):
+        """Builds the index.
+
+        :param rules:
+            The bound rules, in match order.
+        """
+        #: Rules without converters by path, as ``subdomain|/path``.
+        self.static = {}
+        #: Tree of rules with converters: a tuple ``(children, rules)``.
+        self.tree = ({}, [])
+        #: All rules that can match, for paths the index can't narrow.
+        self.rules = []
+
+        for position, rule in enumerate(rules):
+            if rule.build_only:
+                continue
+
+            item = (position, rule)
+            self.rules.append(item)
+            paths, prefix = self.get_paths(rule)
+            if paths is not None:
+                for path in paths:
+                    self.static.setdefault(path, []).append(item)
+
+                continue
+
+            node = self.tree
+            for segment in prefix.split(u'/')[:-1]:
+                node = node[0].setdefault(segment, ({}, []))
+
+            node[1].append(item)
+
+    @staticmethod
+    def get_paths(rule):
+        """Returns the paths a rule matches, if it has no converters, or
+        the static beginning of the paths it matches.
+
+        :param rule:
+            A bound :class:`Rule`.
+        :returns:
+            A tuple ``(paths, prefix)``: a list of paths as
+            ``subdomain|/path`` and None, or None and a prefix.
+        """
+        if not rule._converters:
+            path = u'%s|%s' % (rule.subdomain, rule.is_leaf and rule.rule or
+                rule.rule.rstrip('/'))
+            if not rule.is_leaf or not rule.strict_slashes:
+                # Also matches with a trailing slash, or redirects to it.
+                return [path, path + u'/'], None
+
+            return [path], None
+
+        prefix = []
+        for is_dynamic, data in rule._trace:
+            if is_dynamic:
+                break
+
+            prefix.append(data)
+
+        return None, u''.join(prefix)
+
+    @classmethod
+    def get_conflicts(cls, rules):
+        """Returns, for each rule, the preceding rules that may match the
+        same paths. The check is conservative: rules with converters are
+        considered to conflict if the static beginning of one is the
+        beginning of the other, or of a path of a rule without converters.
+
+        :param rules:
+            The bound rules, in match order.
+        :returns:
+            A list with a set of positions for each rule.
+        """
+        static = {}
+        prefixes = {}
+        for position, rule in enumerate(rules):
+            if rule.build_only:
+                continue
+
+            paths, prefix = cls.get_paths(rule)
+            if paths is not None:
+                for path in paths:
+                    static.setdefault(path, []).append(position)
+            else:
+                prefixes.setdefault(prefix, []).append(position)
+
+        res = [set() for rule in rules]
+
+        def add(positions, others):
+            for position in positions:
+                for other in others:
+                    if other < position:
+                        res[position].add(other)
+                    elif other > position:
+                        res[other].add(position)
+
+        for path, positions in static.iteritems():
+            add(positions, positions)
+            for i in xrange(len(path) + 1):
+                others = prefixes.get(path[:i])
+                if others is not None:
+                    add(positions, others)
+
+        for prefix, positions in prefixes.iteritems():
+            for i in xrange(len(prefix) + 1):
+                others = prefixes.get(prefix[:i])
+                if others is not None:
+                    add(positions, others)
+
+        return res
+
+    def get_rules(self, path):
+        """Returns the rules that can match a path.
+
+        :param path:
+            The path to be matched, as ``subdomain|/path``.
+        :returns:
+            A list of tuples ``(position, rule)``, in match order.
+        """
+        if path.endswith(u'\n'):
+            # A rule regex also matches before a trailing newline.
+            return self.rules
+
+        node = self.tree
+        rules = self.static.get(path, []) + node[1]
+        for segment in path.split(u'/')[:-1]:
+            node = node[0].get(segment)
+            if node is None:
+                break
+
+            rules.extend(node[1])
+
+        rules.sort()
+        return rules
+
+
 class Rule(BaseRule):
     """A Rule represents one URL pattern. Tipfy extends Werkzeug's Rule
     to support handler and name definitions. Handler is the
@@ -245,7 +1450,8 @@ class Rule(BaseRule):
 
         url = self.url_for('user-list')
     """
-    def __init__(self, path, name=None, handler=None, **kwargs):
+    def __init__(self, path, name=None, handler=None, validator=None,
+        deadline=None, **kwargs):
         """There are some options for `Rule` that change the way it behaves
         and are passed to the `Rule` constructor. Note that besides the
         rule-string all arguments *must* be keyword arguments in order to not
@@ -270,6 +1476,15 @@ class Rule(BaseRule):
             The handler class used to handle requests when this rule matches.
             Can be a class or a class defined as a string to be lazily
             imported.
+        :param validator:
+            A function ``validator(handler, **kwargs)`` that returns a tuple
+            ``(etag, last_modified)`` for conditional GET requests, evaluated
+            before the handler method is called. Can be a function or a
+            function defined as a string to be lazily imported.
+            See :attr:`tipfy.RequestHandler.validator`.
+        :param deadline:
+            Seconds available to requests matching this rule, overriding the
+            ``request_deadline`` config key. See :mod:`tipfy.deadline`.
         :param defaults:
             An optional dict with defaults for other rules with the same
             endpoint. This is a bit tricky but useful if you want to have
@@ -336,6 +1551,8 @@ class Rule(BaseRule):
         self.name = kwargs.pop('endpoint', name)
         self.handler = handler or self.name
         self.handler_method = None
+        self.validator = validator
+        self.deadline = deadline
         super(Rule, self).__init__(path, endpoint=self.name, **kwargs)
 
     def empty(self):
@@ -349,7 +1566,8 @@ class Rule(BaseRule):
         return Rule(self.rule, name=self.name, handler=self.handler,
             defaults=defaults, subdomain=self.subdomain, methods=self.methods,
             build_only=self.build_only, strict_slashes=self.strict_slashes,
-            redirect_to=self.redirect_to)
+            redirect_to=self.redirect_to, validator=self.validator,
+            deadline=self.deadline)
 
 
 class HandlerPrefix(RuleFactory):
@@ -418,6 +1636,36 @@ class NamePrefix(RuleFactory):
                 yield rule
 
 
+def _parse_host(host):
+    """Parses a host name or host pattern passed to a :class:`TenantRouter`.
+
+    :param host:
+        A host name or a host pattern like ``<tenant>.example.com``.
+    :returns:
+        A tuple ``(key, variable, domain)``. For host names, `variable` and
+        `domain` are None.
+    """
+    match = _host_pattern_re.match(host)
+    if match is None:
+        return host.lower(), None, None
+
+    domain = match.group(2).lower()
+    return '*.' + domain, match.group(1), domain
+
+
+def _add_copies(map, rules):
+    """Adds unbound copies of rules to a map.
+
+    :param map:
+        A :class:`Map` instance.
+    :param rules:
+        A list of :class:`Rule` or rule factory instances.
+    """
+    for rulefactory in rules:
+        for rule in rulefactory.get_rules(map):
+            map.add(rule.empty())
+
+
 class RegexConverter(BaseConverter):
     """A :class:`Rule` converter that matches a regular expression::
 
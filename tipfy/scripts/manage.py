@@ -1,10 +1,12 @@
 #!/usr/bin/env python
+import __builtin__
 import argparse
 import ConfigParser
 import os
 import runpy
 import shutil
 import sys
+import time
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -169,6 +171,126 @@ class DeployAction(Action):
         pass
 
 
+class ProfileImportsAction(Action):
+    """Imports an app module and reports the time spent importing each
+    module it loads, to keep the cold start cost of an app under control.
+    Usage::
+
+        tipfy profile_imports [-n 30] main
+
+    For each module two times are reported: the cumulative time, including
+    modules imported by it, and the time spent in the module itself.
+    """
+    description = 'Reports the import time of each module loaded by an app.'
+
+    def __init__(self):
+        self.argparser = ArgumentParser(description=self.description)
+        self.argparser.add_argument('module', help='Module that builds the '
+            'app, e.g., main.')
+        self.argparser.add_argument('-n', '--limit', dest='limit', type=int,
+            default=30, help='Number of modules to report, slowest first. '
+            'Use 0 to report all. Default is 30.')
+        self.argparser.add_argument('-s', '--sort', dest='sort',
+            choices=['cumulative', 'self'], default='cumulative',
+            help='Sort by cumulative or self time. Default is cumulative.')
+
+    def __call__(self, manager, argv):
+        args = self.argparser.parse_args(args=argv)
+        if os.getcwd() not in sys.path:
+            sys.path.insert(0, os.getcwd())
+
+        try:
+            timings = profile_imports(args.module)
+        except ImportError, e:
+            self.error('Could not import %s: %s' % (args.module, e))
+
+        if args.sort == 'self':
+            timings.sort(key=lambda t: t[2], reverse=True)
+
+        total = sum(t[2] for t in timings)
+        sys.stdout.write('%12s %12s  %s\n' % ('cumulative', 'self',
+            'module'))
+        for module, cumulative, own in timings[:args.limit or None]:
+            sys.stdout.write('%9.2f ms %9.2f ms  %s\n' % (cumulative * 1000,
+                own * 1000, module))
+
+        sys.stdout.write('%d modules imported in %.2f ms.\n' %
+            (len(timings), total * 1000))
+
+
+def profile_imports(name):
+    """Imports a module and measures the time spent importing each module
+    loaded by it.
+
+    :param name:
+        The module name.
+    :returns:
+        A list of tuples ``(module, cumulative, self)`` with times in
+        seconds, sorted by cumulative time, slowest first. When a single
+        import loads several modules, e.g., a package and a submodule, the
+        time is reported for the module requested by the import.
+    """
+    timings = []
+    # Time spent in nested imports and modules they loaded, per import level.
+    children = [[0.0, set()]]
+    original_import = __builtin__.__import__
+
+    def timed_import(name, globals=None, locals=None, fromlist=None,
+        level=-1):
+        before = set(sys.modules)
+        children.append([0.0, set()])
+        start = time.time()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            nested, claimed = children.pop()
+            loaded = set(m for m in sys.modules if m not in before and
+                sys.modules[m] is not None)
+            if loaded:
+                children[-1][0] += elapsed
+                children[-1][1].update(loaded)
+                # Modules loaded by nested imports were already reported.
+                module = _requested_module(name, fromlist,
+                    loaded - claimed or loaded)
+                timings.append((module, elapsed, elapsed - nested))
+
+    __builtin__.__import__ = timed_import
+    try:
+        __import__(name)
+    finally:
+        __builtin__.__import__ = original_import
+
+    timings.sort(key=lambda t: t[1], reverse=True)
+    return timings
+
+
+def _requested_module(name, fromlist, loaded):
+    """Returns the module an import statement asked for, among the modules
+    loaded by it.
+
+    :param name:
+        The module name passed to ``__import__``.
+    :param fromlist:
+        The names imported from the module, if any.
+    :param loaded:
+        A set with the modules loaded by the import.
+    :returns:
+        The requested module, or the innermost loaded one if it can't be
+        resolved, e.g., for explicit relative imports.
+    """
+    names = ['.'.join(filter(None, (name, f))) for f in fromlist or ()
+        if f != '*']
+    names.append(name)
+    for requested in filter(None, names):
+        for module in sorted(loaded):
+            # Implicit relative imports are loaded with the package prefix.
+            if module == requested or module.endswith('.' + requested):
+                return module
+
+    return max(sorted(loaded), key=len)
+
+
 class TipfyScript(object):
     description = 'Tipfy Management Utilities'
 
@@ -183,6 +305,7 @@ class TipfyScript(object):
         'create_gae_app':   CreateAppengineAppAction(),
         'runserver':        RunserverAction(),
         'deploy':           DeployAction(),
+        'profile_imports':  ProfileImportsAction(),
     }
 
     def __init__(self):
@@ -0,0 +1,690 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.serving
+    ~~~~~~~~~~~~~
+
+    A multi-threaded WSGI server to run tipfy apps outside of App Engine.
+
+    The server keeps the application in a long-lived process, so the app
+    registry, compiled URL map, translations and templates stay loaded
+    between requests. Two modes are available:
+
+    threaded
+        A single process with a fixed pool of worker threads.
+
+    prefork
+        A parent process that binds the socket and forks worker processes,
+        each one with its own pool of worker threads.
+
+    Both modes speak HTTP/1.1 with keep-alive, use a bounded queue of
+    accepted connections (connections that don't fit are rejected with
+    ``503 Service Unavailable``), call an optional warm-up function before
+    the first connection is accepted and restart gracefully on ``SIGHUP``,
+    re-executing the process so that code changes are loaded. ``SIGTERM``
+    and ``SIGINT`` stop the server after in-flight requests are finished.
+
+    The server requires Python 2.6 or later.
+
+    Use it through :meth:`tipfy.Tipfy.run`::
+
+        app.run(mode='threaded', host='0.0.0.0', port=8080, workers=20)
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import errno
+import logging
+import os
+import Queue
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from werkzeug import LimitedStream
+
+from tipfy import __version__
+
+__all__ = [
+    'PreforkServer', 'ThreadPoolServer', 'WSGIRequestHandler', 'run_server',
+]
+
+#: Environment variable used to pass the listening socket to a re-executed
+#: process during a graceful restart.
+LISTEN_FD_ENV = 'TIPFY_SERVER_FD'
+
+
+class WSGIRequestHandler(BaseHTTPRequestHandler):
+    """Handles HTTP/1.1 requests for a WSGI application. Connections are
+    kept alive while the client requests it, the response length is known
+    or can be sent using chunked transfer encoding, and the server has a
+    free keep-alive slot (see :class:`ThreadPoolServer`).
+    """
+    protocol_version = 'HTTP/1.1'
+    server_version = 'tipfy/%s' % __version__
+    #: True while the connection holds a keep-alive slot of the server.
+    keep_alive_slot = False
+
+    def setup(self):
+        # Idle keep-alive connections are closed after this timeout.
+        self.timeout = self.server.keep_alive_timeout
+        BaseHTTPRequestHandler.setup(self)
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        finally:
+            if self.keep_alive_slot:
+                self.keep_alive_slot = False
+                self.server.release_keep_alive()
+
+    def handle_one_request(self):
+        """Handles a single HTTP request."""
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower() \
+            and 'Content-Length' not in self.headers:
+            # The body can't be read, so it can't be skipped either.
+            self.send_error(411)
+            self.close_connection = 1
+            return
+
+        self.run_wsgi()
+
+        try:
+            self.wfile.flush()
+        except socket.error:
+            self.close_connection = 1
+
+    def get_environ(self):
+        """Returns a WSGI environment for the current request.
+
+        :returns:
+            A dictionary with the WSGI environment.
+        """
+        path, _, query = self.path.partition('?')
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = 0
+
+        server_name, server_port = self.server.server_address[:2]
+        environ = {
+            'wsgi.version':      (1, 0),
+            'wsgi.url_scheme':   'http',
+            'wsgi.input':        LimitedStream(self.rfile, content_length),
+            'wsgi.errors':       sys.stderr,
+            'wsgi.multithread':  True,
+            'wsgi.multiprocess': self.server.multiprocess,
+            'wsgi.run_once':     False,
+            'SERVER_SOFTWARE':   self.server_version,
+            'SERVER_NAME':       server_name,
+            'SERVER_PORT':       str(server_port),
+            'SERVER_PROTOCOL':   self.request_version,
+            'REQUEST_METHOD':    self.command,
+            'SCRIPT_NAME':       '',
+            'PATH_INFO':         urllib.unquote(path),
+            'QUERY_STRING':      query,
+            'CONTENT_TYPE':      self.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH':    self.headers.get('Content-Length', ''),
+            'REMOTE_ADDR':       self.client_address[0],
+            'REMOTE_PORT':       str(self.client_address[1]),
+        }
+
+        for key, value in self.headers.items():
+            key = 'HTTP_' + key.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = value
+
+        return environ
+
+    def run_wsgi(self):
+        """Calls the WSGI application and writes the response."""
+        environ = self.get_environ()
+        state = {
+            'status':  None,
+            'headers': None,
+            'sent':    False,
+            'chunked': False,
+        }
+        send_body = self.command != 'HEAD'
+
+        def send_headers():
+            status = state['status']
+            code, _, message = status.partition(' ')
+            self.send_response(int(code), message)
+            header_keys = set()
+            for key, value in state['headers']:
+                self.send_header(key, value)
+                header_keys.add(key.lower())
+
+            if 'content-length' not in header_keys and code[0] != '1' \
+                and code not in ('204', '304'):
+                if self.request_version == 'HTTP/1.1' and send_body:
+                    state['chunked'] = True
+                    self.send_header('Transfer-Encoding', 'chunked')
+                elif send_body:
+                    # Body length is unknown: only closing ends it.
+                    self.close_connection = 1
+
+            if self.server.stopping:
+                # Don't keep connections alive while shutting down.
+                self.close_connection = 1
+            elif not self.close_connection and not self.keep_alive_slot:
+                # An idle keep-alive connection holds a worker thread.
+                self.keep_alive_slot = self.server.acquire_keep_alive()
+                if not self.keep_alive_slot:
+                    self.close_connection = 1
+
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+
+            self.end_headers()
+            state['sent'] = True
+
+        def write(data):
+            assert state['status'] is not None, 'write() before start_response'
+            if not state['sent']:
+                send_headers()
+
+            if data and send_body:
+                if state['chunked']:
+                    self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+                else:
+                    self.wfile.write(data)
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info:
+                try:
+                    if state['sent']:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            elif state['status'] is not None:
+                raise AssertionError('Headers already set')
+
+            state['status'] = status
+            state['headers'] = response_headers
+            return write
+
+        try:
+            result = self.server.app(environ, start_response)
+            try:
+                for data in result:
+                    write(data)
+
+                if not state['sent']:
+                    write('')
+
+                if state['chunked']:
+                    self.wfile.write('0\r\n\r\n')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except (socket.error, socket.timeout), e:
+            self.close_connection = 1
+            return
+        except Exception, e:
+            logging.exception(e)
+            self.close_connection = 1
+            if not state['sent']:
+                self.send_error(500)
+
+            return
+
+        # Discard unread request body so that the next request on this
+        # connection starts at the right place.
+        environ['wsgi.input'].exhaust()
+
+    def log_request(self, code='-', size='-'):
+        logging.debug('%s - "%s" %s', self.client_address[0],
+            self.requestline, code)
+
+    def log_error(self, format, *args):
+        logging.warning('%s - %s', self.client_address[0], format % args)
+
+
+class ThreadPoolServer(SocketServer.TCPServer):
+    """A TCP server that hands accepted connections to a fixed pool of worker
+    threads through a bounded queue.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, app, host='127.0.0.1', port=8080, workers=10,
+        queue_size=64, keep_alive_timeout=15, max_keep_alive=None,
+        handler_class=WSGIRequestHandler, fd=None, multiprocess=False):
+        """Initializes the server.
+
+        :param app:
+            A WSGI application.
+        :param host:
+            Host to bind.
+        :param port:
+            Port to bind.
+        :param workers:
+            Number of worker threads.
+        :param queue_size:
+            Maximum number of accepted connections waiting for a worker. It
+            is also used as the listen backlog. Connections beyond this limit
+            are rejected with ``503 Service Unavailable``.
+        :param keep_alive_timeout:
+            Seconds an idle keep-alive connection is kept open.
+        :param max_keep_alive:
+            Maximum number of connections kept alive at the same time. A
+            kept-alive connection holds a worker thread while it is idle, so
+            this must be lower than `workers` to leave threads for new
+            connections. Other connections are closed after each response,
+            as are all of them while connections are waiting in the queue.
+            Default is half of `workers`.
+        :param handler_class:
+            The request handler class.
+        :param fd:
+            File descriptor of an already bound and listening socket. If set,
+            `host` and `port` are ignored.
+        :param multiprocess:
+            True if other processes are serving the same socket.
+        """
+        self.app = app
+        self.workers = workers
+        self.keep_alive_timeout = keep_alive_timeout
+        if max_keep_alive is None:
+            max_keep_alive = workers // 2
+
+        self.max_keep_alive = max_keep_alive
+        #: Number of connections holding a keep-alive slot.
+        self.keep_alive = 0
+        self.keep_alive_lock = threading.Lock()
+        self.multiprocess = multiprocess
+        self.request_queue_size = queue_size
+        self.stopping = False
+        self.threads = []
+        self.queue = Queue.Queue(queue_size)
+
+        if fd is None:
+            SocketServer.TCPServer.__init__(self, (host, port), handler_class)
+        else:
+            SocketServer.TCPServer.__init__(self, (host, port), handler_class,
+                bind_and_activate=False)
+            self.socket.close()
+            # fromfd() returns a bare socket: wrap it to get the full API.
+            self.socket = socket.socket(_sock=socket.fromfd(fd,
+                socket.AF_INET, socket.SOCK_STREAM))
+            self.server_address = self.socket.getsockname()
+
+    def start_workers(self):
+        """Starts the worker threads."""
+        for i in range(self.workers - len(self.threads)):
+            thread = threading.Thread(target=self.process_queue)
+            thread.setDaemon(self.daemon_threads)
+            thread.start()
+            self.threads.append(thread)
+
+    def serve_forever(self, poll_interval=0.5):
+        """Starts the worker threads and accepts connections until
+        :meth:`stop` is called.
+        """
+        self.start_workers()
+        SocketServer.TCPServer.serve_forever(self, poll_interval)
+
+    def acquire_keep_alive(self):
+        """Takes a keep-alive slot for a connection. Slots are not given
+        while connections are waiting in the queue.
+
+        :returns:
+            True if the connection can be kept alive, False otherwise.
+        """
+        if not self.queue.empty():
+            return False
+
+        self.keep_alive_lock.acquire()
+        try:
+            if self.keep_alive >= self.max_keep_alive:
+                return False
+
+            self.keep_alive += 1
+            return True
+        finally:
+            self.keep_alive_lock.release()
+
+    def release_keep_alive(self):
+        """Frees a slot taken by :meth:`acquire_keep_alive`."""
+        self.keep_alive_lock.acquire()
+        try:
+            self.keep_alive -= 1
+        finally:
+            self.keep_alive_lock.release()
+
+    def shutdown_request(self, request):
+        """Shuts down and closes a connection. ``SocketServer`` only has
+        this method since Python 2.7.
+        """
+        try:
+            request.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+        self.close_request(request)
+
+    def process_request(self, request, client_address):
+        """Queues an accepted connection to be handled by a worker thread.
+        If the queue is full, the connection is rejected.
+        """
+        try:
+            self.queue.put_nowait((request, client_address))
+        except Queue.Full:
+            self.reject_request(request, client_address)
+
+    def reject_request(self, request, client_address):
+        """Responds ``503 Service Unavailable`` and closes a connection that
+        could not be queued.
+        """
+        logging.warning('Request queue is full: rejecting connection from '
+            '%s.', client_address[0])
+        try:
+            request.sendall('HTTP/1.1 503 Service Unavailable\r\n'
+                'Content-Length: 0\r\nRetry-After: 1\r\n'
+                'Connection: close\r\n\r\n')
+        except socket.error:
+            pass
+
+        self.shutdown_request(request)
+
+    def process_queue(self):
+        """Worker thread loop: handles queued connections until a ``None``
+        marker is received.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+
+            self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        logging.exception('Error handling connection from %s.',
+            client_address[0])
+
+    def stop(self, timeout=None):
+        """Stops accepting connections and waits for in-flight requests to
+        finish. This must be called from a thread other than the one running
+        :meth:`serve_forever`.
+
+        :param timeout:
+            Maximum seconds to wait for each worker thread.
+        """
+        self.stopping = True
+        self.shutdown()
+        for thread in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join(timeout)
+
+        self.threads = []
+
+
+class PreforkServer(object):
+    """Binds a socket and forks worker processes, each one running a
+    :class:`ThreadPoolServer` on the shared socket. Dead workers are replaced.
+    On ``SIGHUP`` the workers are stopped gracefully and the parent process
+    is re-executed, so that the new workers load the current code.
+    """
+    def __init__(self, app, host='127.0.0.1', port=8080, processes=2,
+        fd=None, **kwargs):
+        """Initializes the server.
+
+        :param app:
+            A WSGI application.
+        :param host:
+            Host to bind.
+        :param port:
+            Port to bind.
+        :param processes:
+            Number of worker processes.
+        :param fd:
+            File descriptor of an already bound and listening socket. If set,
+            `host` and `port` are ignored.
+        :param kwargs:
+            Keyword arguments for each process :class:`ThreadPoolServer`.
+        """
+        self.app = app
+        self.processes = processes
+        self.kwargs = kwargs
+        self.children = set()
+        self.running = False
+        if fd is None:
+            self.socket = _get_listening_socket(host, port,
+                kwargs.get('queue_size', 64))
+        else:
+            # Inherited from the process before a restart. fromfd()
+            # duplicates the descriptor, so the original is closed.
+            self.socket = socket.socket(_sock=socket.fromfd(fd,
+                socket.AF_INET, socket.SOCK_STREAM))
+            os.close(fd)
+
+        self.server_address = self.socket.getsockname()
+
+    def spawn(self):
+        """Forks a worker process.
+
+        :returns:
+            The worker process id.
+        """
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+
+        # Worker process.
+        exit_code = 0
+        try:
+            for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, signal.SIG_DFL)
+
+            server = ThreadPoolServer(self.app, fd=self.socket.fileno(),
+                multiprocess=True, **self.kwargs)
+            _serve_until_signal(server)
+        except Exception, e:
+            logging.exception(e)
+            exit_code = 1
+
+        os._exit(exit_code)
+
+    def restart(self):
+        """Stops the current workers gracefully and re-executes the parent
+        process. Forking again from the running parent would start workers
+        with the code it loaded when it started. The new process inherits
+        the listening socket, so connections wait in the backlog instead of
+        being refused, and it collects the old workers as they exit.
+        """
+        self.kill(list(self.children))
+        _reexec(self.socket)
+
+    def kill(self, pids, signum=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+            self.children.discard(pid)
+
+    def serve_forever(self):
+        """Starts the workers and replaces the ones that die until a stop
+        signal is received.
+        """
+        self.running = True
+        restart = []
+
+        def on_stop(signum, frame):
+            self.running = False
+
+        def on_restart(signum, frame):
+            restart.append(True)
+
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_restart)
+
+        for i in range(self.processes):
+            self.spawn()
+
+        try:
+            while self.running:
+                if restart:
+                    del restart[:]
+                    logging.info('Restarting worker processes.')
+                    self.restart()
+
+                self._reap()
+                while len(self.children) < self.processes:
+                    self.spawn()
+
+                time.sleep(0.5)
+        finally:
+            children = list(self.children)
+            self.kill(children)
+            for pid in children:
+                _waitpid(pid, 0)
+
+            self.socket.close()
+
+    def _reap(self):
+        for pid in list(self.children):
+            if _waitpid(pid, os.WNOHANG) != 0:
+                self.children.discard(pid)
+
+        # Collect finished processes from previous generations.
+        while _waitpid(-1, os.WNOHANG) > 0:
+            pass
+
+
+def run_server(app, mode='threaded', host='127.0.0.1', port=8080,
+    warmup=None, **kwargs):
+    """Runs a WSGI application in a long-lived process.
+
+    :param app:
+        A WSGI application.
+    :param mode:
+        `threaded` for a single process with a pool of threads, or `prefork`
+        for multiple processes with a pool of threads each.
+    :param host:
+        Host to bind.
+    :param port:
+        Port to bind.
+    :param warmup:
+        A callable called with the app before the first connection is
+        accepted. In `prefork` mode it is called in the parent process, so
+        forked workers start warm.
+    :param kwargs:
+        Extra keyword arguments for :class:`ThreadPoolServer`: `workers`,
+        `queue_size`, `keep_alive_timeout` and `max_keep_alive`. `prefork`
+        mode also accepts `processes`.
+    """
+    if warmup is not None:
+        warmup(app)
+
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        fd = int(fd)
+
+    if mode == 'prefork':
+        server = PreforkServer(app, host=host, port=port, fd=fd, **kwargs)
+        logging.info('Serving on http://%s:%d/ (prefork)' %
+            server.server_address[:2])
+        server.serve_forever()
+    elif mode == 'threaded':
+        server = ThreadPoolServer(app, host=host, port=port, fd=fd, **kwargs)
+        logging.info('Serving on http://%s:%d/ (threaded)' %
+            server.server_address[:2])
+        if _serve_until_signal(server, restart_signal=signal.SIGHUP):
+            _reexec(server.socket)
+
+        server.server_close()
+    else:
+        raise ValueError('Invalid server mode %r.' % mode)
+
+
+def _serve_until_signal(server, restart_signal=None):
+    """Serves in a background thread until a stop or restart signal is
+    received, then stops the server gracefully.
+
+    :returns:
+        True if the restart signal was received, False otherwise.
+    """
+    received = []
+
+    def on_signal(signum, frame):
+        received.append(signum)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    if restart_signal is not None:
+        signal.signal(restart_signal, on_signal)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+    while not received and thread.isAlive():
+        time.sleep(0.5)
+
+    server.stop(timeout=server.keep_alive_timeout)
+    return bool(received) and received[0] == restart_signal
+
+
+def _get_listening_socket(host, port, backlog):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def _reexec(sock):
+    """Replaces the current process by a fresh one that inherits the
+    listening socket, so no connections are refused during a restart.
+    """
+    logging.info('Restarting server process.')
+    fd = os.dup(sock.fileno())
+    os.environ[LISTEN_FD_ENV] = str(fd)
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def _waitpid(pid, options):
+    try:
+        return os.waitpid(pid, options)[0]
+    except OSError, e:
+        if e.errno == errno.ECHILD:
+            return -1
+
+        raise
@@ -18,7 +18,7 @@ import time
 from . import APPENGINE, DEFAULT_VALUE, REQUIRED_VALUE
 from .utils import json_b64encode, json_b64decode
 
-from werkzeug import cached_property
+from werkzeug import cached_property, import_string
 from werkzeug.contrib.sessions import ModificationTrackingDict
 
 #: Default configuration values for this module. Keys are:
@@ -230,7 +230,8 @@ class SecureCookieStore(object):
 
 
 class SessionStore(object):
-    #: A dictionary with the default supported backends.
+    #: A dictionary with the default supported backends. Backends can be
+    #: defined as strings, to be imported on first use.
     default_backends = {
         'securecookie': SecureCookieSession,
     }
@@ -257,6 +258,21 @@ class SessionStore(object):
         """
         return SecureCookieStore(self.config['secret_key'])
 
+    def get_backend(self, name):
+        """Returns a session backend class, importing it if it is defined
+        as a string.
+
+        :param name:
+            The backend name, a key in :attr:`backends`.
+        :returns:
+            A session backend class.
+        """
+        backend = self.backends[name]
+        if isinstance(backend, basestring):
+            backend = self.backends[name] = import_string(backend)
+
+        return backend
+
     def get_session(self, key=None, backend=None, **kwargs):
         """Returns a session for a given key. If the session doesn't exist, a
         new session is returned.
@@ -281,7 +297,8 @@ class SessionStore(object):
 
         if key not in sessions:
             kwargs = self.get_cookie_args(**kwargs)
-            value = self.backends[backend].get_session(self, key, **kwargs)
+            value = self.get_backend(backend).get_session(self, key,
+                **kwargs)
             sessions[key] = (value, kwargs)
 
         return sessions[key][0]
@@ -302,7 +319,7 @@ class SessionStore(object):
         assert isinstance(value, dict), 'Session value must be a dict.'
         backend = backend or self.default_backend
         sessions = self._sessions.setdefault(backend, {})
-        session = self.backends[backend].get_session(self, **kwargs)
+        session = self.get_backend(backend).get_session(self, **kwargs)
         session.update(value)
         kwargs = self.get_cookie_args(**kwargs)
         sessions[key] = (session, kwargs)
@@ -447,8 +464,8 @@ class SessionMiddleware(object):
 
 
 if APPENGINE:
-    from tipfy.appengine.sessions import DatastoreSession, MemcacheSession
+    # The datastore API is only imported if these backends are used.
     SessionStore.default_backends.update({
-        'datastore': DatastoreSession,
-        'memcache':  MemcacheSession,
+        'datastore': 'tipfy.appengine.sessions.DatastoreSession',
+        'memcache':  'tipfy.appengine.sessions.MemcacheSession',
     })
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.sse
+    ~~~~~~~~~
+
+    Server-Sent Events. A :class:`Hub` is an in-process publish/subscribe
+    hub: messages published to a channel are sent to all connections that
+    subscribed to it, as an event stream that stays open::
+
+        from tipfy import RequestHandler
+        from tipfy.sse import Hub
+
+        class NotificationsHandler(RequestHandler):
+            def get(self, **kwargs):
+                hub = Hub.factory(self.app, 'sse')
+                return hub.stream(self, 'user:%s' % kwargs['user_id'])
+
+        # Anywhere else in the same process.
+        Hub.factory(app, 'sse').publish('user:42', {'unread': 3})
+
+    Streams send a comment as heartbeat when there are no events, so that
+    proxies keep the connection open. Published events are kept in a
+    bounded replay buffer per channel, so clients that reconnect with the
+    ``Last-Event-ID`` header receive the events they missed. A subscriber
+    that doesn't read its events fast enough is dropped when its queue is
+    full: its stream ends and the client reconnects and resumes from the
+    replay buffer, instead of making the hub buffer without limit.
+
+    Each open stream occupies a server worker while it waits for events.
+    Waiting uses ``threading`` primitives, so with a greenlet based server
+    (e.g., gevent with monkey patching) idle streams don't take a thread.
+    Streams also end before the request deadline, if there is one: see
+    :mod:`tipfy.deadline`.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import threading
+from collections import deque
+
+from .tracing import timer
+from .utils import json_encode
+
+__all__ = [
+    'Event', 'Hub', 'Subscription',
+]
+
+
+class Event(object):
+    """A server-sent event."""
+    __slots__ = ('data', 'event', 'id', '_encoded')
+
+    def __init__(self, data, event=None, id=None):
+        """Initializes the event.
+
+        :param data:
+            The event data. If it is not a string, it is encoded as JSON.
+        :param event:
+            The event type, or None for the default `message` type.
+        :param id:
+            The event id.
+        """
+        if not isinstance(data, basestring):
+            data = json_encode(data)
+
+        self.data = data
+        self.event = event
+        self.id = id
+        self._encoded = None
+
+    def encode(self):
+        """Returns the event in the ``text/event-stream`` format.
+
+        :returns:
+            A UTF-8 encoded string.
+        """
+        if self._encoded is None:
+            lines = []
+            if self.id is not None:
+                lines.append(u'id: %s' % self.id)
+
+            if self.event is not None:
+                lines.append(u'event: %s' % self.event)
+
+            for line in self.data.splitlines() or [u'']:
+                lines.append(u'data: %s' % line)
+
+            value = u'\n'.join(lines) + u'\n\n'
+            self._encoded = value.encode('utf-8')
+
+        return self._encoded
+
+
+class Subscription(object):
+    """A queue of events for a connection subscribed to a channel."""
+    def __init__(self, channel, queue_size):
+        """Initializes the subscription.
+
+        :param channel:
+            The channel name.
+        :param queue_size:
+            Maximum number of events waiting to be sent.
+        """
+        self.channel = channel
+        self.queue_size = queue_size
+        self.events = deque()
+        #: True if the subscriber was dropped because its queue was full.
+        self.dropped = False
+        #: True if the subscription was closed.
+        self.closed = False
+        self._condition = threading.Condition()
+
+    def put(self, event):
+        """Adds an event to the queue.
+
+        :param event:
+            An :class:`Event` instance.
+        :returns:
+            False if the queue is full, True otherwise.
+        """
+        condition = self._condition
+        condition.acquire()
+        try:
+            if len(self.events) >= self.queue_size:
+                return False
+
+            self.events.append(event)
+            condition.notify()
+            return True
+        finally:
+            condition.release()
+
+    def get(self, timeout):
+        """Returns the queued events, waiting for one if the queue is empty.
+
+        :param timeout:
+            Maximum time to wait, in seconds.
+        :returns:
+            A list of :class:`Event` instances, empty if none arrived before
+            the timeout or if the subscription was closed.
+        """
+        condition = self._condition
+        condition.acquire()
+        try:
+            if not self.events and not self.closed:
+                condition.wait(timeout)
+
+            events = list(self.events)
+            self.events.clear()
+            return events
+        finally:
+            condition.release()
+
+    def close(self, dropped=False):
+        """Closes the subscription, waking up a waiting stream.
+
+        :param dropped:
+            True if the subscriber is being dropped.
+        """
+        condition = self._condition
+        condition.acquire()
+        try:
+            self.closed = True
+            self.dropped = self.dropped or dropped
+            condition.notifyAll()
+        finally:
+            condition.release()
+
+
+class Hub(object):
+    """An in-process publish/subscribe hub for server-sent events."""
+    def __init__(self, replay_size=100, queue_size=100, heartbeat=15,
+        retry=None):
+        """Initializes the hub.
+
+        :param replay_size:
+            Number of recent events kept per channel to be sent to clients
+            that reconnect with ``Last-Event-ID``.
+        :param queue_size:
+            Maximum number of events waiting to be sent to a subscriber. A
+            subscriber with a full queue is dropped.
+        :param heartbeat:
+            Seconds without events after which a stream sends a heartbeat.
+        :param retry:
+            Reconnection time in milliseconds sent to clients, or None to
+            use the client default.
+        """
+        self.replay_size = replay_size
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.retry = retry
+        #: Id of the last published event.
+        self.last_id = 0
+        #: Number of published events.
+        self.published = 0
+        #: Number of dropped subscribers.
+        self.dropped = 0
+        self.subscribers = {}
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def publish(self, channel, data, event=None):
+        """Sends an event to all subscribers of a channel.
+
+        :param channel:
+            The channel name.
+        :param data:
+            The event data. If it is not a string, it is encoded as JSON.
+        :param event:
+            The event type, or None for the default `message` type.
+        :returns:
+            The published :class:`Event`.
+        """
+        self.lock.acquire()
+        try:
+            self.last_id += 1
+            self.published += 1
+            event = Event(data, event=event, id=self.last_id)
+            buffer = self.buffers.get(channel)
+            if buffer is None:
+                buffer = self.buffers[channel] = deque()
+
+            buffer.append(event)
+            # Bounded by hand: deque's maxlen requires Python 2.6.
+            while len(buffer) > self.replay_size:
+                buffer.popleft()
+            subscribers = list(self.subscribers.get(channel, ()))
+        finally:
+            self.lock.release()
+
+        for subscription in subscribers:
+            if not subscription.put(event):
+                # Too slow: drop it instead of buffering without limit.
+                self.unsubscribe(subscription, dropped=True)
+
+        return event
+
+    def subscribe(self, channel, last_event_id=None):
+        """Subscribes to a channel.
+
+        :param channel:
+            The channel name.
+        :param last_event_id:
+            If set, events in the replay buffer published after this id are
+            queued in the subscription.
+        :returns:
+            A :class:`Subscription` instance.
+        """
+        subscription = Subscription(channel, self.queue_size)
+        self.lock.acquire()
+        try:
+            if last_event_id is not None:
+                for event in self.buffers.get(channel, ()):
+                    if event.id > last_event_id:
+                        subscription.events.append(event)
+
+            self.subscribers.setdefault(channel, set()).add(subscription)
+        finally:
+            self.lock.release()
+
+        return subscription
+
+    def unsubscribe(self, subscription, dropped=False):
+        """Removes a subscription from the hub and closes it.
+
+        :param subscription:
+            A :class:`Subscription` instance.
+        :param dropped:
+            True if the subscriber is being dropped.
+        """
+        self.lock.acquire()
+        try:
+            subscribers = self.subscribers.get(subscription.channel)
+            if subscribers is not None and subscription in subscribers:
+                subscribers.remove(subscription)
+                if dropped:
+                    self.dropped += 1
+
+                if not subscribers:
+                    del self.subscribers[subscription.channel]
+        finally:
+            self.lock.release()
+
+        subscription.close(dropped=dropped)
+
+    def close(self):
+        """Closes all subscriptions, ending their streams."""
+        self.lock.acquire()
+        try:
+            subscriptions = [s for channel in self.subscribers.values() for
+                s in channel]
+            self.subscribers = {}
+        finally:
+            self.lock.release()
+
+        for subscription in subscriptions:
+            subscription.close()
+
+    def stream(self, handler, channel, max_duration=None):
+        """Returns a streamed ``text/event-stream`` response with the events
+        published to a channel. The stream resumes after the id set in the
+        request ``Last-Event-ID`` header or `lastEventId` query argument.
+
+        :param handler:
+            The :class:`tipfy.RequestHandler` instance.
+        :param channel:
+            The channel name.
+        :param max_duration:
+            Maximum time in seconds to keep the stream open, or None.
+        :returns:
+            A :attr:`tipfy.Tipfy.response_class` instance.
+        """
+        request = handler.request
+        response = handler.app.response_class(mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # Disable buffering by nginx.
+        response.headers['X-Accel-Buffering'] = 'no'
+        if request.method == 'HEAD':
+            return response
+
+        last_event_id = request.headers.get('Last-Event-ID',
+            request.args.get('lastEventId'))
+        try:
+            last_event_id = int(last_event_id)
+        except (TypeError, ValueError):
+            last_event_id = None
+
+        deadline = request.deadline
+        if max_duration is not None:
+            expires = timer() + max_duration
+            if deadline is None or expires < deadline.expires:
+                deadline = _Expiration(expires)
+
+        response.response = self.iter_events(self.subscribe(channel,
+            last_event_id), deadline)
+        return response
+
+    def iter_events(self, subscription, deadline=None):
+        """Yields encoded events for a subscription until it is closed or
+        dropped, or the deadline passes. The subscription is removed from
+        the hub when the stream ends or the client disconnects.
+
+        :param subscription:
+            A :class:`Subscription` instance.
+        :param deadline:
+            A :class:`tipfy.deadline.Deadline` instance, or None.
+        :returns:
+            A generator of strings.
+        """
+        try:
+            if self.retry is not None:
+                yield 'retry: %d\n\n' % self.retry
+            else:
+                # Send the headers right away.
+                yield ':\n\n'
+
+            while not subscription.closed:
+                timeout = self.heartbeat
+                if deadline is not None:
+                    remaining = deadline.remaining()
+                    if remaining <= 0:
+                        break
+
+                    timeout = min(timeout, remaining)
+
+                events = subscription.get(timeout)
+                if events:
+                    yield ''.join(event.encode() for event in events)
+                elif not subscription.closed and (deadline is None or
+                    deadline.remaining() > 0):
+                    yield ': heartbeat\n\n'
+        finally:
+            self.unsubscribe(subscription, dropped=subscription.dropped)
+
+    def get_stats(self):
+        """Returns the hub counters.
+
+        :returns:
+            A dictionary with the keys `channels` (number of channels with
+            subscribers), `subscribers`, `published`, `dropped` and
+            `last_id`.
+        """
+        self.lock.acquire()
+        try:
+            return {
+                'channels':    len(self.subscribers),
+                'subscribers': sum(len(s) for s in self.subscribers.values()),
+                'published':   self.published,
+                'dropped':     self.dropped,
+                'last_id':     self.last_id,
+            }
+        finally:
+            self.lock.release()
+
+    @classmethod
+    def factory(cls, _app, _name, **kwargs):
+        """Returns the hub stored in the app registry with the given name,
+        creating it if needed.
+
+        :param _app:
+            A :class:`tipfy.Tipfy` instance.
+        :param _name:
+            The hub name.
+        :param kwargs:
+            Keyword arguments to create the hub.
+        :returns:
+            A :class:`Hub` instance.
+        """
+        res = _app.registry.get(_name)
+        if res is None:
+            res = _app.registry.setdefault(_name, cls(**kwargs))
+
+        return res
+
+
+class _Expiration(object):
+    """A deadline for :meth:`Hub.iter_events` set by `max_duration`."""
+    def __init__(self, expires):
+        self.expires = expires
+
+    def remaining(self):
+        return max(self.expires - timer(), 0.0)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.stats
+    ~~~~~~~~~~~
+
+    A handler that returns the rule match statistics recorded by the router
+    as JSON. Enable the ``rule_stats`` config key and map the handler to a
+    URL restricted to administrators, e.g., using ``login: admin`` in
+    *app.yaml*::
+
+        Rule('/_admin/rule-stats', name='rule-stats',
+            handler='tipfy.stats.RuleStatsHandler')
+
+    A ``GET`` request returns the statistics, and a ``POST`` request with an
+    `action` form argument set to `reorder` or `reset` reorders the URL map
+    by hits or discards the statistics.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+from .app import RequestHandler, abort
+from .utils import render_json_response
+
+__all__ = [
+    'RuleStatsHandler',
+]
+
+
+class RuleStatsHandler(RequestHandler):
+    """Returns the statistics from
+    :meth:`tipfy.routing.Router.get_rule_stats` as JSON.
+    """
+    def get(self, **kwargs):
+        router = self.app.router
+        return render_json_response({
+            'enabled': router.rule_stats is not None,
+            'rules':   router.get_rule_stats(),
+        })
+
+    def post(self, **kwargs):
+        router = self.app.router
+        action = self.request.form.get('action')
+        if action == 'reorder':
+            router.reorder_rules()
+        elif action == 'reset':
+            router.reset_rule_stats()
+        else:
+            abort(400)
+
+        return self.get(**kwargs)
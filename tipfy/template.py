@@ -86,6 +86,7 @@ import datetime
 import logging
 import os.path
 import re
+import threading
 import zipfile
 
 import tipfy.utils as escape
@@ -187,12 +188,19 @@ class Loader(object):
 
     def load(self, name, parent_path=None):
         name = self.resolve_path(name, parent_path=parent_path)
-        if name not in self.templates:
+        # Concurrent requests may compile the same template; all use the
+        # first one stored. reset() can replace the dict at any time.
+        templates = self.templates
+        template = templates.get(name)
+        if template is None:
             path = os.path.join(self.root, name)
             f = open(path, "r")
-            self.templates[name] = Template(f.read(), name=name, loader=self)
-            f.close()
-        return self.templates[name]
+            try:
+                template = templates.setdefault(name, Template(f.read(),
+                    name=name, loader=self))
+            finally:
+                f.close()
+        return template
 
 
 class ZipLoader(Loader):
@@ -206,14 +214,20 @@ class ZipLoader(Loader):
         self.zipfile = zipfile.ZipFile(zip_path, 'r')
         self.root = os.path.join(root_directory)
         self.templates = {}
+        # ZipFile reads are not thread-safe.
+        self.lock = threading.Lock()
 
     def load(self, name, parent_path=None):
         name = self.resolve_path(name, parent_path=parent_path)
-        if name not in self.templates:
+        templates = self.templates
+        template = templates.get(name)
+        if template is None:
             path = os.path.join(self.root, name)
-            tpl = self.zipfile.read(path)
-            self.templates[name] = Template(tpl, name=name, loader=self)
-        return self.templates[name]
+            with self.lock:
+                tpl = self.zipfile.read(path)
+            template = templates.setdefault(name, Template(tpl, name=name,
+                loader=self))
+        return template
 
 
 class _Node(object):
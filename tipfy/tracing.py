@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.tracing
+    ~~~~~~~~~~~~~
+
+    Per-phase request timings. When the ``enable_tracing`` config key for
+    ``tipfy`` is True, each request records how long request construction,
+    URL matching, handler import, middleware hooks, the handler method and
+    response conversion took. Timings are sent in a ``Server-Timing``
+    response header and collected by :class:`TraceAggregator`, available as
+    :attr:`tipfy.Tipfy.trace_aggregator`.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+from collections import deque
+
+try:
+    from time import monotonic as timer
+except ImportError:
+    # Python 2 doesn't have a monotonic clock. The wall clock can be set back
+    # while a request is running, so durations are never less than zero.
+    from time import time as timer
+
+__all__ = [
+    'RequestTrace', 'TraceAggregator', 'timer',
+]
+
+
+class RequestTrace(object):
+    """Timings recorded for the phases of a single request."""
+    def __init__(self):
+        #: Start time of the request.
+        self.start = timer()
+        #: Total duration, in seconds. Set by :meth:`finish`.
+        self.total = None
+        #: A list of tuples ``(phase, duration)``, with durations in seconds.
+        self.phases = []
+
+    def add(self, phase, start):
+        """Records a phase that started at the given time and ends now.
+
+        :param phase:
+            Phase name. It must be a valid HTTP token.
+        :param start:
+            Start time, as returned by :func:`timer`.
+        """
+        self.phases.append((phase, max(timer() - start, 0.0)))
+
+    def wrap(self, phase, func):
+        """Returns a function that calls `func` recording it as a phase.
+
+        :param phase:
+            Phase name.
+        :param func:
+            The function to be timed.
+        :returns:
+            A function with the same signature of `func`.
+        """
+        def traced(*args, **kwargs):
+            start = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(phase, start)
+
+        return traced
+
+    def finish(self):
+        """Marks the end of the request."""
+        self.total = max(timer() - self.start, 0.0)
+
+    def get_server_timing(self):
+        """Returns the value for a ``Server-Timing`` header, with durations in
+        milliseconds.
+
+        :returns:
+            A header value.
+        """
+        metrics = ['%s;dur=%.3f' % (phase, duration * 1000) for phase,
+            duration in self.phases]
+        if self.total is not None:
+            metrics.append('total;dur=%.3f' % (self.total * 1000))
+
+        return ', '.join(metrics)
+
+
+class TraceAggregator(object):
+    """Keeps the latest phase timings per rule name, to calculate rolling
+    percentiles.
+    """
+    def __init__(self, size=1000):
+        """Initializes the aggregator.
+
+        :param size:
+            Number of samples to keep per rule and phase.
+        """
+        self.size = size
+        self.samples = {}
+
+    def add(self, name, trace):
+        """Adds the timings from a request.
+
+        :param name:
+            The matched rule name, or None if no rule matched.
+        :param trace:
+            A :class:`RequestTrace` instance.
+        """
+        phases = self.samples.get(name)
+        if phases is None:
+            phases = self.samples.setdefault(name, {})
+
+        values = list(trace.phases)
+        if trace.total is not None:
+            values.append(('total', trace.total))
+
+        for phase, duration in values:
+            samples = phases.get(phase)
+            if samples is None:
+                samples = phases.setdefault(phase, deque())
+
+            samples.append(duration)
+            # Bounded by hand: deque's maxlen requires Python 2.6.
+            while len(samples) > self.size:
+                try:
+                    samples.popleft()
+                except IndexError:
+                    # Emptied by another thread.
+                    break
+
+    def get_percentiles(self, name, phase='total', percentiles=(50, 90, 99)):
+        """Returns percentiles for a rule and phase, in milliseconds.
+
+        :param name:
+            The rule name.
+        :param phase:
+            The phase name. Default is `total`, the whole request.
+        :param percentiles:
+            A sequence of percentiles to calculate.
+        :returns:
+            A dictionary mapping percentiles to durations in milliseconds,
+            or None if there are no samples.
+        """
+        samples = self.samples.get(name, {}).get(phase)
+        if not samples:
+            return None
+
+        samples = sorted(samples)
+        count = len(samples)
+        res = {}
+        for percentile in percentiles:
+            index = min(count - 1, int(round(percentile / 100.0 * count)) - 1)
+            res[percentile] = samples[max(index, 0)] * 1000
+
+        return res
+
+    def get_stats(self, percentiles=(50, 90, 99)):
+        """Returns sample counts and percentiles for all rules and phases.
+
+        :param percentiles:
+            A sequence of percentiles to calculate.
+        :returns:
+            A dictionary ``{rule_name: {phase: {'count': n, 50: ms, ...}}}``.
+        """
+        stats = {}
+        for name, phases in self.samples.items():
+            stats[name] = {}
+            for phase, samples in phases.items():
+                values = self.get_percentiles(name, phase, percentiles) or {}
+                values['count'] = len(samples)
+                stats[name][phase] = values
+
+        return stats
+
+    def clear(self):
+        """Discards all samples."""
+        self.samples = {}
@@ -22,7 +22,7 @@ import unicodedata
 import urllib
 import xml.sax.saxutils
 
-from .app import current_handler
+from .app import get_current_handler
 
 try:
     # Preference for installed library with updated fixes.
@@ -132,8 +132,8 @@ def render_json_response(*args, **kwargs):
         A :class:`Response` object with a JSON string in the body and
         mimetype set to ``application/json``.
     """
-    return current_handler.app.response_class(json_encode(*args, **kwargs),
-        mimetype='application/json')
+    return get_current_handler().app.response_class(json_encode(*args,
+        **kwargs), mimetype='application/json')
 
 
 def squeeze(value):
@@ -203,7 +203,15 @@ def url_for(_name, **kwargs):
 
     .. seealso:: :meth:`Router.build`.
     """
-    return current_handler.url_for(_name, **kwargs)
+    return get_current_handler().url_for(_name, **kwargs)
+
+
+def url_for_many(_name, _values, **kwargs):
+    """A proxy to :meth:`RequestHandler.url_for_many`.
+
+    .. seealso:: :meth:`Router.build_many`.
+    """
+    return get_current_handler().url_for_many(_name, _values, **kwargs)
 
 
 def slugify(value, max_length=None, default=None):
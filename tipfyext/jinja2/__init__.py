@@ -10,12 +10,14 @@
     :copyright: 2010 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
-from jinja2 import Environment, FileSystemLoader, ModuleLoader
-
 from werkzeug import cached_property, import_string
 
-from tipfy import current_handler
-from tipfy.utils import url_for
+from tipfy import get_current_handler
+from tipfy.lazy import LazyModule
+from tipfy.utils import url_for, url_for_many
+
+# Jinja2 is imported when the first environment is created.
+jinja2 = LazyModule('jinja2')
 
 #: Default configuration values for this module. Keys are:
 #:
@@ -67,13 +69,15 @@ class Jinja2(object):
 
             if templates_compiled_target and use_compiled:
                 # Use precompiled templates loaded from a module or zip.
-                kwargs['loader'] = ModuleLoader(templates_compiled_target)
+                kwargs['loader'] = jinja2.ModuleLoader(
+                    templates_compiled_target)
             else:
                 # Parse templates for every new environment instances.
-                kwargs['loader'] = FileSystemLoader(config['templates_dir'])
+                kwargs['loader'] = jinja2.FileSystemLoader(
+                    config['templates_dir'])
 
         # Initialize the environment.
-        env = Environment(**kwargs)
+        env = jinja2.Environment(**kwargs)
 
         if _globals:
             env.globals.update(_globals)
@@ -85,9 +89,8 @@ class Jinja2(object):
             # Install i18n.
             from tipfy import i18n
             env.install_gettext_callables(
-                lambda x: current_handler.i18n.translations.ugettext(x),
-                lambda s, p, n: current_handler.i18n.translations.ungettext(s,
-                    p, n),
+                lambda x: get_current_handler().i18n.gettext(x),
+                lambda s, p, n: get_current_handler().i18n.ngettext(s, p, n),
                 newstyle=True)
             format_functions = {
                 'format_date':      i18n.format_date,
@@ -99,6 +102,7 @@ class Jinja2(object):
             env.filters.update(format_functions)
 
         env.globals['url_for'] = url_for
+        env.globals['url_for_many'] = url_for_many
 
         after_creation_func = config['after_environment_created']
         if after_creation_func:
@@ -146,8 +150,8 @@ class Jinja2(object):
             Keyword arguments used as variables in the rendered template.
             These will override values set in the request context.
         """
-        res = self.render_template(_handler, _filename, **context)
-        return self.app.response_class(res)
+        return _handler.make_deferred_response(self.render_template,
+            _handler, _filename, **context)
 
     def get_template_attribute(self, filename, attribute):
         """Loads a macro (or variable) a template exports.  This can be used to
@@ -175,10 +179,11 @@ class Jinja2(object):
 
     @classmethod
     def factory(cls, _app, _name, **kwargs):
-        if _name not in _app.registry:
-            _app.registry[_name] = cls(_app, **kwargs)
+        res = _app.registry.get(_name)
+        if res is None:
+            res = _app.registry.setdefault(_name, cls(_app, **kwargs))
 
-        return _app.registry[_name]
+        return res
 
 
 class Jinja2Mixin(object):
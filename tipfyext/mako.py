@@ -13,11 +13,14 @@
 from __future__ import absolute_import
 from cStringIO import StringIO
 
-from mako.lookup import TemplateLookup
-from mako.runtime import Context
-
 from werkzeug import cached_property
 
+from tipfy.lazy import LazyModule
+
+# Mako is imported when the first template lookup is created.
+lookup = LazyModule('mako.lookup')
+runtime = LazyModule('mako.runtime')
+
 #: Default configuration values for this module. Keys are:
 #:
 #: templates_dir
@@ -35,7 +38,7 @@ class Mako(object):
         if isinstance(dirs, basestring):
             dirs = [dirs]
 
-        self.environment = TemplateLookup(directories=dirs,
+        self.environment = lookup.TemplateLookup(directories=dirs,
             output_encoding='utf-8', encoding_errors='replace')
 
     def render(self, _filename, **context):
@@ -51,7 +54,7 @@ class Mako(object):
         """
         template = self.environment.get_template(_filename)
         buf = StringIO()
-        template.render_context(Context(buf, **context))
+        template.render_context(runtime.Context(buf, **context))
         return buf.getvalue()
 
     def render_template(self, _handler, _filename, **context):
@@ -78,15 +81,16 @@ class Mako(object):
             Keyword arguments used as variables in the rendered template.
             These will override values set in the request context.
         """
-        res = self.render_template(_handler, _filename, **context)
-        return self.app.response_class(res)
+        return _handler.make_deferred_response(self.render_template,
+            _handler, _filename, **context)
 
     @classmethod
     def factory(cls, _app, _name, **kwargs):
-        if _name not in _app.registry:
-            _app.registry[_name] = cls(_app, **kwargs)
+        res = _app.registry.get(_name)
+        if res is None:
+            res = _app.registry.setdefault(_name, cls(_app, **kwargs))
 
-        return _app.registry[_name]
+        return res
 
 
 class MakoMixin(object):